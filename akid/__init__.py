@@ -12,7 +12,9 @@ from akid.core.kongfus import *
 from akid.core.kids import *
 from akid.core.sensors import *
 from akid.core.jokers import *
+from akid.core.feed_jokers import *
 from akid.core.common import *
+from akid.core.summaries import *
 from akid.core.brains import *
 from akid.core import common
 try:
@@ -42,6 +42,14 @@ from .common import (
     VALID_SUMMARY_COLLECTION,
     SPARSITY_SUMMARY_SUFFIX
 )
+from .summaries import (
+    ACTIVATION_SUMMARY,
+    SPARSITY_SUMMARY,
+    VARIABLE_SUMMARY,
+    LOSS_SUMMARY,
+    EVAL_SUMMARY,
+    kind_collection
+)
 
 
 class Block(object):
@@ -68,7 +76,11 @@ class Block(object):
     """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, do_summary=True, name=None, bag=None):
+    def __init__(self,
+                 do_summary=True,
+                 name=None,
+                 bag=None,
+                 summary_policy=None):
         """
         Create a layer and name it.
 
@@ -84,6 +96,9 @@ class Block(object):
                 A dictionary that holds any further ad hoc information one
                 wants to keep in this block, such as a list of filters you want
                 to visualize later.
+            summary_policy: akid.core.summaries.SummaryPolicy
+                Which summaries to gather when `do_summary` is True. If None,
+                all summaries are gathered.
         """
         if not name:
             raise Exception(
@@ -93,6 +108,7 @@ class Block(object):
 
         self.name = name
         self.do_summary = do_summary
+        self.summary_policy = summary_policy
         log.info("{} has bag: {}".format(name, bag))
         self.bag = bag
 
@@ -320,8 +336,18 @@ class ProcessingLayer(ShadowableBlock):
             self.moving_averages = tf.train.ExponentialMovingAverage(
                 self.moving_average_decay, step)
 
+    def _do_summary_on(self, kind):
+        """
+        Whether to gather summaries of `kind` on this layer, according to
+        `do_summary` and `summary_policy`.
+        """
+        if not self.do_summary:
+            return False
+        if self.summary_policy is None:
+            return True
+        return self.summary_policy.allows(self.name, kind)
+
     def _post_setup(self):
-        # TODO: ideally, we want to control how many summaries we gather.
         if self.do_summary:
             log.info("Do tensorboard summary on outputs of {}".format(
                 self.name))
@@ -330,20 +356,20 @@ class ProcessingLayer(ShadowableBlock):
             if self.data is not None:
                 if type(self.data) is not list:
                     self._data_summary(self.data, collection_to_add)
-            if self.loss is not None:
-                tf.summary.scalar(self.loss.op.name,
-                                  self.loss,
-                                  collections=[collection_to_add])
-            if self.eval is not None:
-                if type(self.eval) is list:
-                    for e in self.eval:
-                        tf.summary.scalar(e.op.name,
-                                          e,
-                                          collections=[collection_to_add])
-                else:
-                    tf.summary.scalar(self.eval.op.name,
-                                      self.eval,
-                                      collections=[collection_to_add])
+            if self.loss is not None and self._do_summary_on(LOSS_SUMMARY):
+                tf.summary.scalar(
+                    self.loss.op.name,
+                    self.loss,
+                    collections=[collection_to_add,
+                                 kind_collection(LOSS_SUMMARY)])
+            if self.eval is not None and self._do_summary_on(EVAL_SUMMARY):
+                evals = self.eval if type(self.eval) is list else [self.eval]
+                for e in evals:
+                    tf.summary.scalar(
+                        e.op.name,
+                        e,
+                        collections=[collection_to_add,
+                                     kind_collection(EVAL_SUMMARY)])
 
     def _data_summary(self, data, collection=TRAIN_SUMMARY_COLLECTION):
         """
@@ -357,12 +383,16 @@ class ProcessingLayer(ShadowableBlock):
         assert collection is TRAIN_SUMMARY_COLLECTION or \
             collection is VALID_SUMMARY_COLLECTION, \
             "{} is not one of those defined in common.py. Some thing is wrong"
-        tf.summary.histogram(data.op.name + '/activations',
-                             data,
-                             collections=[collection])
-        tf.summary.scalar(data.op.name + '/' + SPARSITY_SUMMARY_SUFFIX,
-                          tf.nn.zero_fraction(data),
-                          collections=[collection])
+        if self._do_summary_on(ACTIVATION_SUMMARY):
+            tf.summary.histogram(
+                data.op.name + '/activations',
+                data,
+                collections=[collection, kind_collection(ACTIVATION_SUMMARY)])
+        if self._do_summary_on(SPARSITY_SUMMARY):
+            tf.summary.scalar(
+                data.op.name + '/' + SPARSITY_SUMMARY_SUFFIX,
+                tf.nn.zero_fraction(data),
+                collections=[collection, kind_collection(SPARSITY_SUMMARY)])
 
     def _post_setup_shared(self):
         # Maintain moving averages of variables.
@@ -376,11 +406,13 @@ class ProcessingLayer(ShadowableBlock):
                     # dependency.
                     name=self._data.op.name.split('/')[-1] + "_")
 
-        if self.do_summary:
+        if self._do_summary_on(VARIABLE_SUMMARY):
             log.info("Do tensorboard summary on variables of {}".format(
                 self.name))
             for var in self.var_list:
                 self._var_summary(var.op.name, var)
+        # Moving averages are always summarized, whatever the summary policy
+        # is.
         if self.moving_average_decay:
             for var in self.var_list:
                 var_average = self.moving_averages.average(var)
@@ -397,12 +429,12 @@ class ProcessingLayer(ShadowableBlock):
         log.info("This layer has {} parameters.".format(total_para_num))
 
     def _var_summary(self, tag, var):
+        collections = [TRAIN_SUMMARY_COLLECTION,
+                       kind_collection(VARIABLE_SUMMARY)]
         if len(var.get_shape().as_list()) is 0:
-            tf.summary.scalar(tag, var, collections=[TRAIN_SUMMARY_COLLECTION])
+            tf.summary.scalar(tag, var, collections=collections)
         else:
-            tf.summary.histogram(tag,
-                                 var,
-                                 collections=[TRAIN_SUMMARY_COLLECTION])
+            tf.summary.histogram(tag, var, collections=collections)
 
     def _skip_pre_post_shared_setup(self):
         """
@@ -99,7 +99,8 @@ class Brain(GraphSystem, ProcessingLayer):
     configuration and that shares any variables original brain has.
 
     Note if `do_summary` and `moving_average_decay` are specified, it would
-    override that option of any layers attached to this brain.
+    override that option of any layers attached to this brain. So would
+    `summary_policy` if it is not None, see `akid.core.summaries`.
     """
     def __init__(self, do_stat_on_norm=False, **kwargs):
         """
@@ -7,6 +7,7 @@ supposed to hold all information needed.
 import tensorflow as tf
 
 from ..utils import glog as log
+from . import sensors
 
 
 def on_train_log_step(kid):
@@ -14,19 +15,19 @@ def on_train_log_step(kid):
     evals = kid.evals
     duration = kid.forward_backward_time
     step = kid.step
-    sess = kid.sess
-    feed_dict = kid.feed_dict
 
     name_to_print = [g.op.name for g in kid.engine.eval()]
     eval_value_to_print = ["%0.04f" % v for v in evals]
     eval_to_print = dict(zip(name_to_print, eval_value_to_print))
 
-    num_examples_per_step = kid.sensor.batch_size
+    # A step runs `accum_steps` batches if gradients are accumulated.
+    num_examples_per_step = kid.sensor.batch_size * kid.engine.accum_steps
     examples_per_sec = num_examples_per_step / duration
-    sec_per_batch = float(duration)
+    sec_per_batch = float(duration) / kid.engine.accum_steps
 
     from akid import LearningRateScheme
-    lr = kid.sess.run(kid.kongfu.learning_rate) \
+    # The learning rate is fetched along with the training step.
+    lr = kid.learning_rate_value \
         if kid.kongfu.lr_scheme["name"] is LearningRateScheme.exp_decay\
         else kid.kongfu.lr_value
 
@@ -39,14 +40,78 @@ def on_train_log_step(kid):
                  examples_per_sec,
                  sec_per_batch))
 
+    from akid import FeedSensor
+    prefetch_stats = None
+    if type(kid.sensor) is FeedSensor and kid.sensor.is_prefetching:
+        prefetch_stats = kid.sensor.prefetch_stats
+        log.info("Prefetch queue: {}/{} feed dicts; stalled {} of {} steps"
+                 " for {:.3f} sec in total".format(
+                     prefetch_stats["depth"],
+                     prefetch_stats["capacity"],
+                     prefetch_stats["stalls"],
+                     prefetch_stats["gets"],
+                     prefetch_stats["stall_time"]))
+
+    from akid import IntegratedSensor
+    queue_stats = None
+    if type(kid.sensor) is IntegratedSensor:
+        queue_stats = kid.sensor.queue_stats
+        wait_to_print = "waited {:.3f} sec on dequeue in {} steps".format(
+            queue_stats["wait_time"], queue_stats["dequeues"]) \
+            if queue_stats["wait_time"] is not None else "wait not measured"
+        log.info("Input queue: {}/{} examples ({:.1f}% full); {}".format(
+            queue_stats["size"],
+            queue_stats["capacity"],
+            100 * queue_stats["fraction"],
+            wait_to_print))
+
     if kid.do_summary:
         # Update the events file.
         summary = tf.Summary()
         summary.value.add(tag="Training Loss",
                           simple_value=float(loss_value))
+        if prefetch_stats:
+            summary.value.add(tag="Prefetch Queue Depth",
+                              simple_value=float(prefetch_stats["depth"]))
+            summary.value.add(tag="Prefetch Stall Time",
+                              simple_value=float(
+                                  prefetch_stats["stall_time"]))
+        if queue_stats:
+            summary.value.add(tag="Input Queue Fraction",
+                              simple_value=float(queue_stats["fraction"]))
+            if queue_stats["wait_time"] is not None:
+                summary.value.add(tag="Dequeue Wait Time",
+                                  simple_value=float(
+                                      queue_stats["wait_time"]))
         kid.summary_writer.add_summary(summary, step)
-        summary_str = sess.run(kid.summary_op, feed_dict=feed_dict)
-        kid.summary_writer.add_summary(summary_str, step)
+        # Other summaries are collected along with training steps. See
+        # `Kid.summary_steps`.
+
+
+def on_train_log_step_profile(kid):
+    """
+    Log and summarize the breakdown of time of the training loop recorded by
+    `kid.profiler`.
+    """
+    stats = kid.profiler.stats()
+    for phase, s in sorted(stats.items(),
+                           key=lambda item: -item[1]["fraction"]):
+        log.info("  {}: {:.1f}% of time; p50 {:.2f} ms p90 {:.2f} ms"
+                 " p99 {:.2f} ms over {} calls".format(
+                     phase,
+                     100 * s["fraction"],
+                     1000 * s["p50"],
+                     1000 * s["p90"],
+                     1000 * s["p99"],
+                     s["count"]))
+
+    if kid.do_summary:
+        summary = tf.Summary()
+        for phase, s in stats.items():
+            for k in ["p50", "p90", "p99", "fraction"]:
+                summary.value.add(tag="Profile/{}/{}".format(phase, k),
+                                  simple_value=float(s[k]))
+        kid.summary_writer.add_summary(summary, kid.step)
 
 
 def on_val_log_step(kid):
@@ -92,22 +157,30 @@ def on_train_begin(kid):
     log.info("Total parameters: {}".format(total_parameters))
 
     # Run ops once to show initial training loss and save initial
-    # summaries.
+    # summaries. The batch is not counted as consumed, so training starts
+    # from where the source is, such as the state restored from a checkpoint.
+    source_state = None
+    if type(kid.sensor) is sensors.FeedSensor:
+        source_state = kid.sensor.get_source_state()
     kid.fill_train_feed_dict()
     fetch = [kid.engine.loss()]
     fetch.extend(kid.engine.eval())
+    num_fetch = len(fetch)
+    # Summaries are collected at their own steps, see `Kid.summary_steps`.
+    fetch.extend(kid._due_summary_ops(kid.step))
     result = kid.sess.run(fetch, feed_dict=kid.feed_dict)
     kid.loss_value = result[0]
-    kid.evals = result[1:]
+    kid.evals = result[1:num_fetch]
+    if source_state is not None:
+        kid.sensor.set_source_state(source_state)
 
     if kid.do_summary:
         summary = tf.Summary()
         summary.value.add(tag="Training Loss",
                           simple_value=float(kid.loss_value))
         kid.summary_writer.add_summary(summary, kid.step)
-        summary_str = kid.sess.run(kid.summary_op,
-                                   feed_dict=kid.feed_dict)
-        kid.summary_writer.add_summary(summary_str, kid.step)
+        for summary_str in result[num_fetch:]:
+            kid.summary_writer.add_summary(summary_str, kid.step)
 
     name_to_print = [g.op.name for g in kid.engine.eval()]
     eval_value_to_print = ["%0.04f" % v for v in kid.evals]
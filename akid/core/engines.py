@@ -18,8 +18,30 @@ As an example, we could do data parallelism on multiple computing towers using::
         engine={"name": "data_parallel", "num_gpu": 2},
         log_dir="log",
         max_epoch=200)
+
+Training could also be distributed across processes, or machines, by
+parameter servers. Each process runs the same script, with the same cluster,
+and its own role in it::
+
+    cluster = {"ps": ["localhost:2222"],
+               "worker": ["localhost:2223", "localhost:2224"]}
+    kid = kids.Kid(
+        sensor,
+        brain,
+        MomentumKongFu(),
+        engine={"name": "ps_sync",
+                "cluster": cluster,
+                "job_name": FLAGS.job_name,
+                "task_index": FLAGS.task_index},
+        log_dir="log_{}_{}".format(FLAGS.job_name, FLAGS.task_index),
+        max_steps=20000)
+    kid.setup()
+    kid.practice()
 """
 import abc
+import time
+import contextlib
+import multiprocessing
 
 import tensorflow as tf
 
@@ -49,6 +71,8 @@ class Engine(object):
         self.brain = kid.brain
         self.kongfu = kid.kongfu
         self.val_brain = kid.val_brain
+        # Set if gradients are accumulated, see `_setup_grad_accumulators`.
+        self.accum_op = None
 
     @abc.abstractmethod
     def loss(self, get_val=False):
@@ -68,15 +92,161 @@ class Engine(object):
         raise NotImplementedError("Each engine should implement the interface"
                                   " to provide evaluation.")
 
+    # Whether the process runs a parameter server, which only serves
+    # variables, and does not train.
+    is_ps = False
+    # Whether the process is responsible to initialize, restore and save
+    # variables, and to validate.
+    is_chief = True
+    # The execution engine the session of `Kid` connects to. An empty string
+    # means an in-process one.
+    master = ""
+
+    def session_config(self, config):
+        """
+        Update `config`, a `tf.ConfigProto`, with what the engine needs of the
+        session it runs in. By default, nothing is needed.
+        """
+        pass
+
+    def on_session_init(self, sess):
+        """
+        Called by `Kid` after variables are initialized or restored in `sess`.
+        By default, nothing is needed.
+        """
+        pass
+
+    def on_train_end(self, sess):
+        """
+        Called by `Kid.practice` after the training loop finishes. By default,
+        nothing is needed.
+        """
+        pass
+
+    @contextlib.contextmanager
+    def device_scope(self):
+        """
+        The scope the whole graph of `Kid` is built in. By default, it does
+        nothing.
+        """
+        yield
+
+    @contextlib.contextmanager
+    def local_device_scope(self):
+        """
+        The scope local variables of the engine, such as accumulators, are
+        created in. By default, it does nothing.
+        """
+        yield
+
     def setup(self):
         grads = self._setup_train_towers()
         self._post_setup_train(grads)
         self._setup_val_towers()
+        self._setup_val_remainder_tower()
+        if self.kid.accumulate_val_on_device:
+            self._setup_val_accumulators()
+
+    def _setup_val_remainder_tower(self):
+        """
+        If the sensor supplies the remainder of validation data in a smaller
+        batch, set up a shadow copy of the validation brain on it, which is
+        run as a whole on one device. Otherwise, nothing is set up.
+        """
+        self.val_remainder_brain = None
+        if not self.sensor.val_remainder \
+           or self.sensor.val_remainder_data is None:
+            return
+
+        log.info("Setting up tower for the remainder of validation data")
+        data = self.sensor.val_remainder_data
+        label = self.sensor.val_remainder_labels
+        system_in = [data]
+        system_in.extend(label) if type(label) is list \
+            else system_in.append(label)
+        self.val_remainder_brain = self.val_brain.get_shadow_copy()
+        self.val_remainder_brain.setup(system_in)
+
+    def _setup_val_accumulators(self):
+        """
+        Set up local variables that accumulate sample weighted sums of the
+        validation loss and evaluation metrics in the graph, and ops to reset,
+        update and read them. It is only called if `accumulate_val_on_device`
+        of the kid is True.
+
+        `val_accum_update_op` adds the values of a validation batch weighted
+        by `val_accum_weight`, a placeholder defaulting to the validation
+        batch size, and `val_remainder_accum_update_op` adds those of the
+        remainder batch. `val_accum_values` holds the means of loss and
+        evaluation metrics, in the order of `loss` and `eval`.
+        """
+        def accumulator(name):
+            return tf.Variable(0.,
+                               trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                               name=name)
+
+        def update_op(values, weight):
+            updates = [s.assign_add(tf.cast(v, tf.float32) * weight)
+                       for s, v in zip(sums, values)]
+            updates.append(count.assign_add(weight))
+            return tf.group(*updates)
+
+        values = [self.loss(get_val=True)]
+        values.extend(self.eval(get_val=True))
+        with self.local_device_scope(), \
+                tf.variable_scope("val_accumulators"):
+            sums = [accumulator("sum_{}".format(i))
+                    for i in xrange(0, len(values))]
+            count = accumulator("count")
+            self.val_accum_weight = tf.placeholder_with_default(
+                float(self.sensor.val_batch_size), [], name="weight")
+            self.val_accum_update_op = update_op(values, self.val_accum_weight)
+            if self.val_remainder_brain:
+                remainder_values = [self.val_remainder_loss()]
+                remainder_values.extend(self.val_remainder_eval())
+                self.val_remainder_accum_update_op = update_op(
+                    remainder_values, float(self.sensor.val_remainder))
+            else:
+                self.val_remainder_accum_update_op = None
+            self.val_accum_reset_op = tf.group(
+                *[v.assign(0.) for v in sums + [count]])
+            self.val_accum_values = [tf.div(s, count) for s in sums]
+
+    def val_remainder_loss(self):
+        """
+        Return the validation loss on the remainder of validation data.
+        """
+        return self.val_remainder_brain.loss
+
+    def val_remainder_eval(self):
+        """
+        Return the evaluation list on the remainder of validation data.
+        """
+        return self.val_remainder_brain.eval
+
+    @property
+    def accum_steps(self):
+        """
+        The number of batches whose gradients are accumulated before applied,
+        see `KongFu`.
+        """
+        return self.kongfu.accum_steps
 
     def _post_setup_train(self, grads):
-        apply_grad_op = self.kongfu.opt.apply_gradients(
+        # Gradients of a batch, as (gradient, variable) pairs, as if no
+        # parallelism exists.
+        self.grads = grads
+        if self.accum_steps > 1:
+            grads, reset_op = self._setup_grad_accumulators(grads)
+
+        apply_grad_op = self._optimizer().apply_gradients(
             grads, global_step=common.global_step_tensor)
 
+        if self.accum_steps > 1:
+            with tf.control_dependencies([apply_grad_op]):
+                apply_grad_op = tf.group(reset_op)
+
         with tf.control_dependencies([apply_grad_op]):
             self.brain.on_batch_finishes()
             if self.brain.max_norm_clip_op:
@@ -91,6 +261,50 @@ class Engine(object):
                     grad,
                     collections=[TRAINING_DYNAMICS_COLLECTION])
 
+    def _optimizer(self):
+        """
+        Return the optimizer applying gradients.
+        """
+        return self.kongfu.opt
+
+    def _setup_grad_accumulators(self, grads):
+        """
+        Set up local variables accumulating gradients `grads` over
+        `accum_steps` batches.
+
+        `accum_op` adds gradients of a batch to the accumulators. The returned
+        gradients add those of the last batch, and average all accumulated,
+        so applying them finishes a step; the returned op resets accumulators,
+        and should be run after the gradients are applied.
+        """
+        accum_grads = []
+        accum_ops = []
+        reset_ops = []
+        with self.local_device_scope(), \
+                tf.variable_scope("grad_accumulators"):
+            for grad, var in grads:
+                if grad is None:
+                    accum_grads.append((grad, var))
+                    continue
+                # Sparse gradients are accumulated densely.
+                grad = tf.convert_to_tensor(grad)
+                accumulator = tf.Variable(
+                    tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    name=var.op.name.replace("/", "_"))
+                accum_ops.append(accumulator.assign_add(grad))
+                # The value returned by `assign_add` is read after the add.
+                average = tf.mul(accumulator.assign_add(grad),
+                                 1. / self.accum_steps)
+                accum_grads.append((average, var))
+                reset_ops.append(accumulator.assign(
+                    tf.zeros_like(accumulator)))
+            self.accum_op = tf.group(*accum_ops)
+            reset_op = tf.group(*reset_ops)
+
+        return accum_grads, reset_op
+
 
 class SingleGPUEngine(Engine):
     def _setup_train_towers(self):
@@ -177,12 +391,75 @@ class DataParallelEngine(Engine):
     network. It splits the batch, and train a fraction of them in an individual
     computing devices.
 
-    Due to the known fact that communication between GPUs are slow, the average
-    of gradient is done on CPU.
+    Gradients of towers are reduced in buckets: gradients of each tower are
+    packed into a few large flat buffers, each holding gradients of about
+    `bucket_size` bytes, which are summed across towers, and split back into
+    gradients of variables. Buffers are summed by one of the following
+    `reduce_method`:
+
+        * "central": all buffers are summed by `add_n` on `reduce_device`.
+        * "tree": buffers are summed pairwise in a binary tree, each sum on
+          the device of one of the pair.
+        * "ring": buffers are split into a chunk per tower, and each chunk is
+          summed along a ring of towers starting from a different one, so the
+          summing and the traffic are spread evenly over devices.
+
+    The sum is then averaged on `reduce_device`, where losses and evaluation
+    metrics are averaged as well. Due to the known fact that communication
+    between GPUs are slow, it is CPU by default.
+
+    Batches are split by `split_ratios` across towers, so faster devices could
+    take larger shares, and the batch size does not need to be divisible by
+    the number of towers. Losses, evaluation metrics and gradients of towers
+    are averaged weighted by the number of samples each tower takes, which
+    gives the same results as if the batch is processed as a whole.
     """
-    def __init__(self, num_gpu, **kwargs):
+    REDUCE_METHODS = ["central", "tree", "ring"]
+
+    def __init__(self,
+                 num_gpu=2,
+                 reduce_device="/cpu:0",
+                 reduce_method="central",
+                 bucket_size=32 * 2**20,
+                 split_ratios=None,
+                 **kwargs):
+        """
+        Args:
+            num_gpu: int
+                The number of towers.
+            reduce_device: str
+                The device to average gradients, losses and evaluation
+                metrics on.
+            reduce_method: str
+                How to sum gradients, see the class docstring.
+            bucket_size: int
+                The maximal number of bytes of a bucket of gradients. A
+                gradient larger than it takes a bucket alone.
+            split_ratios: list of numbers
+                The share of a batch each tower takes. They are normalized,
+                so only their ratios matter. If None, batches are split as
+                evenly as possible.
+        """
         super(DataParallelEngine, self).__init__(**kwargs)
+        assert reduce_method in DataParallelEngine.REDUCE_METHODS,\
+            "reduce_method should be one of {}".format(
+                DataParallelEngine.REDUCE_METHODS)
         self.num_gpu = num_gpu
+        self.reduce_device = reduce_device
+        self.reduce_method = reduce_method
+        self.bucket_size = bucket_size
+        if split_ratios is not None:
+            assert len(split_ratios) == num_gpu,\
+                "A split ratio is needed for each of {} towers.".format(
+                    num_gpu)
+            assert min(split_ratios) > 0, "Split ratios should be positive."
+        self.split_ratios = split_ratios
+
+    def _tower_device(self, i):
+        """
+        Return the device the `i`th tower is placed on.
+        """
+        return '/gpu:{}'.format(i)
 
     def get_layer_data(self, name, get_val=False):
         if get_val:
@@ -206,21 +483,57 @@ class DataParallelEngine(Engine):
 
         return data
 
+    def _split_sizes(self, batch_size):
+        """
+        Return the number of samples each tower takes from a batch of
+        `batch_size`, according to `split_ratios`. Remainders of rounding go
+        to towers with the largest fractional parts.
+        """
+        ratios = self.split_ratios if self.split_ratios \
+            else [1] * self.num_gpu
+        shares = [batch_size * r / float(sum(ratios)) for r in ratios]
+        sizes = [int(share) for share in shares]
+        by_fraction = sorted(xrange(0, self.num_gpu),
+                             key=lambda i: sizes[i] - shares[i])
+        for i in by_fraction[:batch_size - sum(sizes)]:
+            sizes[i] += 1
+        assert min(sizes) > 0,\
+            "Batch size {} is too small to split by {}.".format(
+                batch_size, ratios)
+
+        return sizes
+
+    def _split(self, tensor, sizes):
+        """
+        Split `tensor` along the first dimension into pieces of `sizes`.
+        """
+        rank = len(tensor.get_shape().as_list())
+        pieces = []
+        offset = 0
+        for size in sizes:
+            pieces.append(tf.slice(tensor,
+                                   [offset] + [0] * (rank - 1),
+                                   [size] + [-1] * (rank - 1)))
+            offset += size
+        return pieces
+
     def _split_input(self, data, label):
         """
-        Given data and labels, split them and return.
+        Given data and labels, split them and return, along with the number
+        of samples of each split.
         """
+        sizes = self._split_sizes(data.get_shape().as_list()[0])
         with tf.variable_scope("data_split"):
-            splitted_data = tf.split(0, self.num_gpu, data)
+            splitted_data = self._split(data, sizes)
             if type(label) is list:
                 splitted_labels = []
                 for i in xrange(0, len(label)):
-                    splitted_labels.append(tf.split(0, self.num_gpu, label[i]))
+                    splitted_labels.append(self._split(label[i], sizes))
                 splitted_labels = zip(*splitted_labels)
             else:
-                splitted_labels = tf.split(0, self.num_gpu, label)
+                splitted_labels = self._split(label, sizes)
 
-        return splitted_data, splitted_labels
+        return splitted_data, splitted_labels, sizes
 
     def _setup_system_in(self, data, label):
         """
@@ -242,28 +555,39 @@ class DataParallelEngine(Engine):
             else system_in.append(label)
         return system_in
 
-    def _average_loss(self, towers):
+    def _weighted_average(self, values, sizes, name):
+        """
+        Average `values` of towers weighted by `sizes`, the number of samples
+        of each tower.
+        """
+        total = float(sum(sizes))
+        return tf.add_n([tf.mul(v, n / total) for v, n in zip(values, sizes)],
+                        name=name)
+
+    def _average_loss(self, towers, sizes):
         """
-        Given a list of computing towers, average their loss, and return.
+        Given a list of computing towers and the number of samples of each,
+        average their loss, and return.
         """
         with tf.variable_scope("loss_average"):
-            sum_of_loss = tf.add_n([t.loss for t in towers])
-            loss = tf.div(sum_of_loss, self.num_gpu, name="avg")
+            loss = self._weighted_average([t.loss for t in towers],
+                                          sizes,
+                                          name="avg")
 
         return loss
 
-    def _average_eval(self, towers):
+    def _average_eval(self, towers, sizes):
         """
-        Given a list of computing towers, average their evaluation metrics and
-        return.
+        Given a list of computing towers and the number of samples of each,
+        average their evaluation metrics and return.
         """
         with tf.variable_scope("eval_average"):
             eval_list = []
             for i in xrange(0, len(towers[0].eval)):
-                sum_of_eval = tf.add_n([t.eval[i] for t in towers])
-                eval = tf.div(sum_of_eval,
-                              self.num_gpu,
-                              name="{}_avg".format(towers[0].eval[i].op.name))
+                eval = self._weighted_average(
+                    [t.eval[i] for t in towers],
+                    sizes,
+                    name="{}_avg".format(towers[0].eval[i].op.name))
                 eval_list.append(eval)
 
         return eval_list
@@ -272,7 +596,8 @@ class DataParallelEngine(Engine):
         # Split the data.
         data = self.sensor.data()
         label = self.sensor.labels()
-        splitted_data, splitted_labels = self._split_input(data, label)
+        splitted_data, splitted_labels, self._train_sizes \
+            = self._split_input(data, label)
 
         # Set up brains according to the number of gpus used.
 
@@ -285,7 +610,7 @@ class DataParallelEngine(Engine):
         kongfu = self.kongfu
         for i in xrange(0, self.num_gpu):
             log.info("Setting up tower {} for training".format(i))
-            with tf.device('/gpu:{}'.format(i)):
+            with tf.device(self._tower_device(i)):
                 # Set up a tower
                 system_in = self._setup_system_in(splitted_data[i],
                                                   splitted_labels[i])
@@ -308,24 +633,27 @@ class DataParallelEngine(Engine):
                 tower_grads.append(kongfu.data)
 
         # Gather and reduce.
-        with tf.device('/cpu:0'):
-            grads = self._average_grads(tower_grads)
-            self._train_loss = self._average_loss(self.train_towers)
-            self._train_eval = self._average_eval(self.train_towers)
+        grads = self._average_grads(tower_grads)
+        with tf.device(self.reduce_device):
+            self._train_loss = self._average_loss(self.train_towers,
+                                                  self._train_sizes)
+            self._train_eval = self._average_eval(self.train_towers,
+                                                  self._train_sizes)
 
         return grads
 
     def _setup_val_towers(self):
         data = self.sensor.data(get_val=True)
         label = self.sensor.labels(get_val=True)
-        splitted_data, splitted_labels = self._split_input(data, label)
+        splitted_data, splitted_labels, val_sizes \
+            = self._split_input(data, label)
 
         # Set up val brains according to the number of gpus used.
         self.val_towers = []
         tower = self.val_brain
         for i in xrange(0, self.num_gpu):
             log.info("Setting up tower {} for validation".format(i))
-            with tf.device('/gpu:{}'.format(i)):
+            with tf.device(self._tower_device(i)):
                 system_in = self._setup_system_in(splitted_data[i],
                                                   splitted_labels[i])
                 tower.setup(system_in)
@@ -333,9 +661,9 @@ class DataParallelEngine(Engine):
                 if i is not self.num_gpu - 1:
                     tower = tower.get_shadow_copy()
 
-        with tf.device('/cpu:0'):
-            self._val_loss = self._average_loss(self.val_towers)
-            self._val_eval = self._average_eval(self.val_towers)
+        with tf.device(self.reduce_device):
+            self._val_loss = self._average_loss(self.val_towers, val_sizes)
+            self._val_eval = self._average_eval(self.val_towers, val_sizes)
 
     def loss(self, get_val=False):
         if not get_val:
@@ -352,7 +680,7 @@ class DataParallelEngine(Engine):
     def _average_grads(self, tower_grads):
         """
         Calculate the average gradient for each shared variable across all
-        towers.
+        towers, by reducing buckets of gradients. See the class docstring.
 
         Note that this function provides a synchronization point across all
         towers.
@@ -366,28 +694,324 @@ class DataParallelEngine(Engine):
             averaged across all towers.
         """
         with tf.variable_scope("gradient_average"):
-            average_grads = []
-            for grad_and_vars in zip(*tower_grads):
-                # Note that each grad_and_vars looks like the following:
-                #   ((grad0_gpu0, var0_gpu0), ... , (grad0_gpuN, var0_gpuN))
-                grads = []
-                for g, _ in grad_and_vars:
-                    # Add 0 dimension to the gradients to represent the tower.
-                    expanded_g = tf.expand_dims(g, 0)
-
-                    # Append on a 'tower' dimension which we will average over
-                    # below.
-                    grads.append(expanded_g)
-
-                # Average over the 'tower' dimension.
-                grad = tf.concat(0, grads)
-                grad = tf.reduce_mean(grad, 0)
-
-                # Keep in mind that the Variables are redundant because they
-                # are shared across towers. So .. we will just return the first
-                # tower's pointer to the Variable.
-                v = grad_and_vars[0][1]
-                grad_and_var = (grad, v)
-                average_grads.append(grad_and_var)
-
-        return average_grads
+            # Keep in mind that the Variables are redundant because they are
+            # shared across towers. So .. we will just return the first
+            # tower's pointer to the Variable.
+            variables = [v for _, v in tower_grads[0]]
+            average_grads = [None] * len(variables)
+
+            dense_idxs = []
+            for i, grad_and_vars in enumerate(zip(*tower_grads)):
+                grads = [g for g, _ in grad_and_vars]
+                if grads[0] is None:
+                    continue
+                if isinstance(grads[0], tf.Tensor):
+                    dense_idxs.append(i)
+                else:
+                    # Sparse gradients are not packed.
+                    with tf.device(self.reduce_device):
+                        average_grads[i] = self._scale_sum(tf.add_n(
+                            [self._weigh_tower(t, tf.convert_to_tensor(g))
+                             for t, g in enumerate(grads)]))
+
+            for b, bucket in enumerate(self._bucket(tower_grads, dense_idxs)):
+                with tf.name_scope("bucket_{}".format(b)):
+                    flats = []
+                    for t, grads in enumerate(tower_grads):
+                        with tf.device(self._tower_device(t)):
+                            flats.append(self._weigh_tower(t, tf.concat(
+                                0, [tf.reshape(grads[i][0], [-1])
+                                    for i in bucket])))
+                    flat = self._reduce(flats)
+                    with tf.device(self.reduce_device):
+                        flat = self._scale_sum(flat)
+                        offset = 0
+                        for i in bucket:
+                            shape = variables[i].get_shape()
+                            size = shape.num_elements()
+                            average_grads[i] = tf.reshape(
+                                tf.slice(flat, [offset], [size]), shape)
+                            offset += size
+
+        return zip(average_grads, variables)
+
+    def _is_even_split(self):
+        return len(set(self._train_sizes)) == 1
+
+    def _weigh_tower(self, t, grad):
+        """
+        Weigh the gradient of the `t`th tower by its share of samples, if
+        towers take different numbers of samples.
+        """
+        if self._is_even_split():
+            return grad
+        return tf.mul(grad,
+                      self._train_sizes[t] / float(sum(self._train_sizes)))
+
+    def _scale_sum(self, grad_sum):
+        """
+        Turn the sum of gradients of all towers into their average. Gradients
+        are already weighted if the split is uneven.
+        """
+        if not self._is_even_split():
+            return grad_sum
+        return tf.mul(grad_sum, 1. / self.num_gpu)
+
+    def _bucket(self, tower_grads, idxs):
+        """
+        Group indices `idxs` of gradients into buckets of no more than
+        `bucket_size` bytes. Gradients in a bucket have the same dtype, and
+        keep their order.
+        """
+        buckets = []
+        open_buckets = {}
+        for i in idxs:
+            g, v = tower_grads[0][i]
+            size = v.get_shape().num_elements() * g.dtype.size
+            bucket, bucket_size = open_buckets.get(g.dtype, (None, 0))
+            if bucket is None or bucket_size + size > self.bucket_size:
+                bucket, bucket_size = [], 0
+                buckets.append(bucket)
+            bucket.append(i)
+            open_buckets[g.dtype] = (bucket, bucket_size + size)
+
+        return buckets
+
+    def _reduce(self, flats):
+        """
+        Sum flat buffers `flats` of towers by `reduce_method`.
+        """
+        if self.reduce_method == "central" or len(flats) == 1:
+            with tf.device(self.reduce_device):
+                return tf.add_n(flats)
+
+        if self.reduce_method == "tree":
+            # Pairs of (tower index, partial sum on the tower).
+            sums = list(enumerate(flats))
+            while len(sums) > 1:
+                next_sums = []
+                for j in xrange(0, len(sums) - 1, 2):
+                    t, a = sums[j]
+                    _, b = sums[j + 1]
+                    with tf.device(self._tower_device(t)):
+                        next_sums.append((t, tf.add(a, b)))
+                if len(sums) % 2 == 1:
+                    next_sums.append(sums[-1])
+                sums = next_sums
+            return sums[0][1]
+
+        # Ring. Chunk j is summed along the ring from tower j + 1 to tower j.
+        num = len(flats)
+        size = flats[0].get_shape().num_elements()
+        bounds = [size * j // num for j in xrange(0, num + 1)]
+        chunk_sums = []
+        for j in xrange(0, num):
+            begin, chunk_size = bounds[j], bounds[j + 1] - bounds[j]
+            chunk_sum = None
+            for k in xrange(1, num + 1):
+                t = (j + k) % num
+                with tf.device(self._tower_device(t)):
+                    chunk = tf.slice(flats[t], [begin], [chunk_size])
+                    chunk_sum = chunk if chunk_sum is None \
+                        else tf.add(chunk_sum, chunk)
+            chunk_sums.append(chunk_sum)
+        with tf.device(self.reduce_device):
+            return tf.concat(0, chunk_sums)
+
+
+class CPUDataParallelEngine(DataParallelEngine):
+    """
+    A `DataParallelEngine` whose towers are placed on CPU devices, so data
+    parallelism scales across cores of machines without GPUs.
+
+    The session is configured with `num_cpu` virtual CPU devices, and
+    `intra_op_threads` threads to parallelize a single op. Note that the pool
+    of those threads is shared by the whole session, not owned by a tower.
+    It only applies to the session created by `Kid`, so no session should be
+    passed to the kid.
+    """
+    def __init__(self, num_cpu=2, intra_op_threads=None, **kwargs):
+        """
+        Args:
+            num_cpu: int
+                The number of towers, each on a CPU device.
+            intra_op_threads: int
+                The size of the session wide thread pool an op is
+                parallelized in, see `intra_op_parallelism_threads` of
+                `tf.ConfigProto`. By default, the number of cores divided by
+                the number of towers, since towers run their ops at the same
+                time.
+        """
+        super(CPUDataParallelEngine, self).__init__(num_gpu=num_cpu, **kwargs)
+        if intra_op_threads is None:
+            intra_op_threads = max(multiprocessing.cpu_count() // num_cpu, 1)
+        self.intra_op_threads = intra_op_threads
+
+    def _tower_device(self, i):
+        return '/cpu:{}'.format(i)
+
+    def session_config(self, config):
+        config.device_count["CPU"] = self.num_gpu
+        config.intra_op_parallelism_threads = self.intra_op_threads
+        # Leave room for ops of all towers to run at the same time.
+        config.inter_op_parallelism_threads = self.num_gpu * 2
+
+
+class ParameterServerEngine(SingleGPUEngine):
+    """
+    An engine training asynchronously across processes by parameter servers.
+
+    A cluster is made of "ps" tasks, which hold variables, and "worker" tasks,
+    each of which trains the brain on its own batches, and applies its
+    gradients to variables on parameter servers without waiting for other
+    workers. Variables are placed on "ps" tasks in a round-robin fashion, and
+    other ops, as well as local variables, on the worker itself.
+
+    Each task runs in its own process, with the same cluster, and a
+    `job_name` and `task_index` telling its role. A "ps" task only serves
+    variables: `Kid.practice` blocks forever on it. The worker of task 0 is
+    the chief, which initializes or restores variables, validates and saves
+    checkpoints, while other workers wait till variables are initialized, and
+    then only train.
+
+    Note that global step is shared by workers, while each worker counts its
+    own steps, starting from the global step when it starts, till `max_steps`
+    of its `Kid`.
+    """
+    def __init__(self, kid, cluster, job_name="worker", task_index=0):
+        """
+        Args:
+            cluster: dict or tf.train.ClusterSpec
+                The cluster, where a dict maps "ps" and "worker" to lists of
+                "hostname:port" of tasks.
+            job_name: str
+                "ps" or "worker", the job of this process.
+            task_index: int
+                The index of the task of this process in its job.
+        """
+        super(ParameterServerEngine, self).__init__(kid)
+        if job_name not in ["ps", "worker"]:
+            raise ValueError('Job name should be "ps" or "worker", not'
+                             ' {}.'.format(job_name))
+        self.cluster = tf.train.ClusterSpec(cluster)
+        self.job_name = job_name
+        self.task_index = task_index
+        self.num_workers = self.cluster.num_tasks("worker")
+        self.worker_device = "/job:worker/task:{}".format(task_index)
+
+        self.server = tf.train.Server(self.cluster,
+                                      job_name=job_name,
+                                      task_index=task_index)
+        log.info("Server of task {} of job {} started.".format(task_index,
+                                                               job_name))
+
+    @property
+    def is_ps(self):
+        return self.job_name == "ps"
+
+    @property
+    def is_chief(self):
+        return self.job_name == "worker" and self.task_index == 0
+
+    @property
+    def master(self):
+        return self.server.target
+
+    def join(self):
+        """
+        Serve variables till the process is killed.
+        """
+        self.server.join()
+
+    def device_scope(self):
+        return tf.device(tf.train.replica_device_setter(
+            worker_device=self.worker_device,
+            cluster=self.cluster))
+
+    def local_device_scope(self):
+        return tf.device(self.worker_device)
+
+    def session_config(self, config):
+        # Only talk to parameter servers and the worker itself, so workers
+        # do not wait for each other to start.
+        config.device_filters.extend(["/job:ps", self.worker_device])
+
+    def setup(self):
+        super(ParameterServerEngine, self).setup()
+        # Local variables are initialized by each worker itself.
+        self.ready_op = tf.report_uninitialized_variables(
+            tf.global_variables())
+
+    def wait_for_variables(self, sess, poll_interval=1):
+        """
+        Block till all global variables are initialized by the chief.
+        """
+        while True:
+            uninitialized = sess.run(self.ready_op)
+            if uninitialized.size == 0:
+                return
+            log.info("Waiting for the chief to initialize variables, such as"
+                     " {}.".format(uninitialized[0]))
+            time.sleep(poll_interval)
+
+
+class SyncParameterServerEngine(ParameterServerEngine):
+    """
+    A `ParameterServerEngine` training synchronously: gradients of workers
+    are aggregated by `tf.train.SyncReplicasOptimizer`, and applied once every
+    `replicas_to_aggregate` of them are received, where stale gradients are
+    dropped. Global step increases once an aggregated update is applied.
+
+    The chief runs the queue runner that aggregates gradients, so after its
+    training loop, it waits till other workers finish.
+    """
+    def __init__(self, kid, replicas_to_aggregate=None, **kwargs):
+        """
+        Args:
+            replicas_to_aggregate: int
+                The number of gradients to aggregate for an update. By
+                default, one from each worker.
+        """
+        super(SyncParameterServerEngine, self).__init__(kid, **kwargs)
+        if replicas_to_aggregate is None:
+            replicas_to_aggregate = self.num_workers
+        self.replicas_to_aggregate = replicas_to_aggregate
+        self.sync_opt = None
+
+    def _optimizer(self):
+        if self.sync_opt is None:
+            self.sync_opt = tf.train.SyncReplicasOptimizer(
+                self.kongfu.opt,
+                replicas_to_aggregate=self.replicas_to_aggregate,
+                total_num_replicas=self.num_workers)
+        return self.sync_opt
+
+    def setup(self):
+        super(SyncParameterServerEngine, self).setup()
+        self.chief_queue_runner = self.sync_opt.get_chief_queue_runner()
+        self.init_tokens_op = self.sync_opt.get_init_tokens_op()
+        # Other workers report to the chief through a queue on a parameter
+        # server when they finish, since they need tokens from the queue
+        # runner of the chief till then.
+        with tf.device("/job:ps/task:0"):
+            done_queue = tf.FIFOQueue(self.num_workers,
+                                      tf.int32,
+                                      shared_name="done_queue")
+            self.done_op = done_queue.enqueue(self.task_index)
+            self.wait_done_op = done_queue.dequeue_many(self.num_workers - 1)
+
+    def on_session_init(self, sess):
+        sess.run(self.sync_opt.local_step_init_op)
+        if self.is_chief:
+            # Tokens let workers start the first step.
+            sess.run(self.init_tokens_op)
+            self.chief_queue_runner.create_threads(sess,
+                                                   daemon=True,
+                                                   start=True)
+
+    def on_train_end(self, sess):
+        if not self.is_chief:
+            sess.run(self.done_op)
+        elif self.num_workers > 1:
+            log.info("Waiting for other workers to finish.")
+            sess.run(self.wait_done_op)
@@ -0,0 +1,394 @@
+"""
+This module contains `FeedJoker`s, the numpy counterparts of `Joker`s, which
+do data augmentation on batches supplied by `FeedSource` in form of
+numpy.array, and `AugmentationPool`, which runs them in worker processes.
+
+`Joker`s live in the computational graph, so only `IntegratedSensor` could use
+them. `FeedJoker`s are attached to a `FeedSensor` in the similar way::
+
+    sensor = FeedSensor(source_in=cifar_source,
+                        batch_size=128,
+                        num_augment_processes=4,
+                        name='data')
+    sensor.attach(FeedCropJoker(height=24, width=24, name="crop"))
+    sensor.attach(FeedFlipJoker(name="left_right_flip"))
+    sensor.attach(FeedWhitenJoker(name="whiten"))
+
+Batches are augmented by a pool of processes, so the augmentation scales
+across cores without contending the GIL. Batches are passed between processes
+through shared memory instead of being pickled.
+"""
+from __future__ import absolute_import, division, print_function
+
+import abc
+import inspect
+import multiprocessing
+import traceback
+from collections import deque
+
+import numpy as np
+
+from ..utils import glog as log
+
+
+class FeedJoker(object):
+    """
+    A top level abstract class to do data augmentation on a batch of images of
+    shape [N, H, W, C] in numpy.
+
+    A `FeedJoker` is sent to worker processes, so it should be picklable, and
+    keep no states other than its parameters.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def out_shape(self, shape):
+        """
+        Given the shape of an input image, [H, W, C], return the shape of the
+        output image. By default, the shape does not change.
+        """
+        return list(shape)
+
+    @abc.abstractmethod
+    def augment(self, batch, rng):
+        """
+        Augment `batch` and return the augmented batch. The batch passed in
+        could be modified in place.
+
+        Args:
+            batch: numpy.array of shape [N, H, W, C] of float32.
+            rng: numpy.random.RandomState
+                Source of randomness. No global random state should be used.
+        """
+        raise NotImplementedError("Each `FeedJoker` should implement"
+                                  " `augment` to do actual data augmentation!")
+
+
+class FeedCropJoker(FeedJoker):
+    """
+    The counterpart of `CropJoker`.
+    """
+    def __init__(self,
+                 height=None, width=None,
+                 center=False, central_fraction=None,
+                 **kwargs):
+        """
+        Args:
+            See `CropJoker`. When cropping centrally to a size larger than the
+            image, the image is padded evenly with zeros.
+        """
+        super(FeedCropJoker, self).__init__(**kwargs)
+        self.height = height
+        self.width = width
+        self.center = center
+        self.central_fraction = central_fraction
+        if not (self.center and self.central_fraction):
+            assert self.width and self.height,\
+                "crop height and width should not be None."
+
+    def out_shape(self, shape):
+        if self.center and self.central_fraction:
+            return [int(shape[0] * self.central_fraction),
+                    int(shape[1] * self.central_fraction),
+                    shape[2]]
+        return [self.height, self.width, shape[2]]
+
+    def augment(self, batch, rng):
+        num, height, width, depth = batch.shape
+        out_height, out_width, _ = self.out_shape(batch.shape[1:])
+
+        if self.center:
+            out = np.zeros([num, out_height, out_width, depth],
+                           dtype=batch.dtype)
+            # Negative offsets mean padding.
+            offset_h = (height - out_height) // 2
+            offset_w = (width - out_width) // 2
+            src_h, dst_h = max(offset_h, 0), max(-offset_h, 0)
+            src_w, dst_w = max(offset_w, 0), max(-offset_w, 0)
+            h = min(height, out_height)
+            w = min(width, out_width)
+            out[:, dst_h:dst_h+h, dst_w:dst_w+w, :] \
+                = batch[:, src_h:src_h+h, src_w:src_w+w, :]
+            return out
+
+        assert out_height <= height and out_width <= width,\
+            "Cannot randomly crop {}x{} from {}x{} images.".format(
+                out_height, out_width, height, width)
+        out = np.empty([num, out_height, out_width, depth], dtype=batch.dtype)
+        offsets_h = rng.randint(0, height - out_height + 1, size=num)
+        offsets_w = rng.randint(0, width - out_width + 1, size=num)
+        for i in xrange(0, num):
+            h, w = offsets_h[i], offsets_w[i]
+            out[i] = batch[i, h:h+out_height, w:w+out_width, :]
+        return out
+
+
+class FeedFlipJoker(FeedJoker):
+    """
+    The counterpart of `FlipJoker`.
+    """
+    def __init__(self, flip_left_right=True, **kwargs):
+        """
+        Args:
+            See `FlipJoker`.
+        """
+        super(FeedFlipJoker, self).__init__(**kwargs)
+        self.flip_left_right = flip_left_right
+
+    def augment(self, batch, rng):
+        flipped = rng.rand(batch.shape[0]) < 0.5
+        if self.flip_left_right:
+            batch[flipped] = batch[flipped, :, ::-1, :]
+        else:
+            batch[flipped] = batch[flipped, ::-1, :, :]
+        return batch
+
+
+class FeedLightJoker(FeedJoker):
+    """
+    The counterpart of `LightJoker`, with the same hard coded parameters.
+    """
+    def __init__(self, contrast=True, brightness=True, **kwargs):
+        """
+        Args:
+            See `LightJoker`.
+        """
+        super(FeedLightJoker, self).__init__(**kwargs)
+        self.contrast = contrast
+        self.brightness = brightness
+
+    def augment(self, batch, rng):
+        num = batch.shape[0]
+        if self.contrast:
+            # As `tf.image.adjust_contrast`, the mean is per image per
+            # channel.
+            factors = rng.uniform(0.2, 1.8, size=[num, 1, 1, 1])
+            means = batch.mean(axis=(1, 2), keepdims=True)
+            batch -= means
+            batch *= factors.astype(batch.dtype)
+            batch += means
+        if self.brightness:
+            deltas = rng.uniform(-63, 63, size=[num, 1, 1, 1])
+            batch += deltas.astype(batch.dtype)
+        return batch
+
+
+class FeedWhitenJoker(FeedJoker):
+    """
+    The counterpart of `WhitenJoker`, which does per image whitening.
+    """
+    def augment(self, batch, rng):
+        num_elements = np.prod(batch.shape[1:])
+        means = batch.mean(axis=(1, 2, 3), keepdims=True)
+        stddevs = batch.std(axis=(1, 2, 3), keepdims=True)
+        # The same with `tf.image.per_image_standardization`.
+        stddevs = np.maximum(stddevs, 1.0 / np.sqrt(num_elements))
+        batch -= means
+        batch /= stddevs
+        return batch
+
+
+def _augment(jokers,
+             in_buffers, out_buffers,
+             in_shape, out_shape,
+             task_queue, done_queue):
+    """
+    Loop of worker processes of `AugmentationPool`.
+    """
+    inputs = [np.frombuffer(b, dtype=np.float32).reshape([-1] + in_shape)
+              for b in in_buffers]
+    outputs = [np.frombuffer(b, dtype=np.float32).reshape([-1] + out_shape)
+               for b in out_buffers]
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        slot, num, seed = task
+        try:
+            rng = np.random.RandomState(seed)
+            batch = inputs[slot][:num]
+            for j in jokers:
+                batch = j.augment(batch, rng)
+            outputs[slot][:num] = batch
+            done_queue.put((slot, None))
+        except Exception:
+            done_queue.put((slot, traceback.format_exc()))
+
+
+class AugmentationPool(object):
+    """
+    A pool of processes that applies a list of `FeedJoker`s to batches.
+
+    Raw batches are got by calling `get_batch` in the calling process, and
+    written to shared memory buffers. Worker processes augment them and write
+    the results to shared output buffers. A number of buffer slots are kept in
+    flight, so augmentation is done ahead of time.
+    """
+    def __init__(self,
+                 jokers,
+                 get_batch,
+                 batch_size,
+                 shape,
+                 num_processes=2,
+                 num_slots=None,
+                 seed=None,
+                 get_state=None):
+        """
+        Args:
+            jokers: list of `FeedJoker`
+                Jokers to apply in order.
+            get_batch: callable
+                Called without arguments to get a tuple of (images, labels) of
+                a raw batch.
+            batch_size: int
+                The maximal number of samples in a batch.
+            shape: list
+                Shape of a raw image, [H, W, C].
+            num_processes: int
+                The number of worker processes.
+            num_slots: int
+                The number of batches that could be in flight. By default,
+                two times the number of processes.
+            seed: int
+                Seed to derive seeds of the randomness of each batch.
+            get_state: callable
+                If given, it is called right after each call of `get_batch`,
+                and the returned state is kept along with the batch, which is
+                available as `last_state` after the batch is returned by
+                `next_batch`.
+        """
+        self.jokers = jokers
+        self.get_batch = get_batch
+        self.batch_size = batch_size
+        self.in_shape = list(shape)
+        out_shape = list(shape)
+        for j in jokers:
+            out_shape = j.out_shape(out_shape)
+        self.out_shape = out_shape
+        self.num_processes = num_processes
+        self.num_slots = num_slots if num_slots else 2 * num_processes
+        self.rng = np.random.RandomState(seed)
+        self.get_state = get_state
+        self.last_state = None
+
+        self._processes = []
+        # The slot returned by the last `next_batch`. It is refilled only at
+        # the next call, since the returned arrays are views of it.
+        self._last_slot = None
+
+    def start(self):
+        """
+        Allocate shared buffers, start worker processes, and submit a batch to
+        every slot.
+        """
+        in_size = self.batch_size * int(np.prod(self.in_shape))
+        out_size = self.batch_size * int(np.prod(self.out_shape))
+        in_buffers = [multiprocessing.RawArray('f', in_size)
+                      for _ in xrange(0, self.num_slots)]
+        out_buffers = [multiprocessing.RawArray('f', out_size)
+                       for _ in xrange(0, self.num_slots)]
+        self._inputs = [
+            np.frombuffer(b, dtype=np.float32).reshape([-1] + self.in_shape)
+            for b in in_buffers]
+        self._outputs = [
+            np.frombuffer(b, dtype=np.float32).reshape([-1] + self.out_shape)
+            for b in out_buffers]
+        self._labels = [None] * self.num_slots
+        self._nums = [0] * self.num_slots
+        self._states = [None] * self.num_slots
+
+        self._task_queue = multiprocessing.Queue()
+        self._done_queue = multiprocessing.Queue()
+        for _ in xrange(0, self.num_processes):
+            p = multiprocessing.Process(target=_augment,
+                                        args=(self.jokers,
+                                              in_buffers, out_buffers,
+                                              self.in_shape, self.out_shape,
+                                              self._task_queue,
+                                              self._done_queue))
+            p.daemon = True
+            p.start()
+            self._processes.append(p)
+        log.info("Started {} processes to augment data.".format(
+            self.num_processes))
+
+        self._in_flight = deque()
+        self._done = set()
+        for slot in xrange(0, self.num_slots):
+            self._submit(slot)
+
+    def close(self):
+        """
+        Stop worker processes.
+        """
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for p in self._processes:
+            p.join()
+        self._processes = []
+
+    def _submit(self, slot):
+        images, labels = self.get_batch()
+        num = images.shape[0]
+        assert num <= self.batch_size,\
+            "Got a batch of {} samples, larger than the batch size {}.".format(
+                num, self.batch_size)
+        self._inputs[slot][:num] = images
+        self._labels[slot] = np.array(labels)
+        self._nums[slot] = num
+        if self.get_state:
+            self._states[slot] = self.get_state()
+        self._in_flight.append(slot)
+        self._task_queue.put((slot, num, self.rng.randint(2**31 - 1)))
+
+    def next_batch(self):
+        """
+        Return the next augmented batch, in the order raw batches are got.
+
+        Returns:
+            A tuple (images, labels). The images are a view of a shared
+            buffer, which is overwritten after the next call.
+        """
+        if self._last_slot is not None:
+            self._submit(self._last_slot)
+
+        slot = self._in_flight.popleft()
+        self._wait(slot)
+        self._done.remove(slot)
+        self._last_slot = slot
+        self.last_state = self._states[slot]
+
+        num = self._nums[slot]
+        return self._outputs[slot][:num], self._labels[slot]
+
+    def reset(self):
+        """
+        Drop batches in flight, and submit new batches to every slot. It is
+        used when the position of `get_batch` has been changed, such as when
+        the state of a source is restored.
+        """
+        while self._in_flight:
+            self._wait(self._in_flight.popleft())
+        self._done.clear()
+        self._last_slot = None
+        self.last_state = None
+        for slot in xrange(0, self.num_slots):
+            self._submit(slot)
+
+    def _wait(self, slot):
+        """
+        Wait till the batch in `slot` has been augmented.
+        """
+        while slot not in self._done:
+            done_slot, error = self._done_queue.get()
+            if error:
+                raise Exception("Augmentation failed in worker process:"
+                                "\n{}".format(error))
+            self._done.add(done_slot)
+
+
+__all__ = [name for name, x in locals().items() if
+           not inspect.ismodule(x) and not inspect.isabstract(x)
+           and not name.startswith("_")]
@@ -1,11 +1,18 @@
 """
 This module contains `Joker`s, the classes that make benign jokes to data, aka
 doing data augmentations.
+
+A `Joker` takes either a datum of shape [H, W, C], or a batch of shape [N, H,
+W, C]. On a batch, random parameters are drawn for each sample, and the
+augmentation is done by ops on the whole batch, so its cost scales with the
+batch instead of with launching ops on samples one by one. See `batch_mode`
+of `JokerSystem`.
 """
 from __future__ import absolute_import, division, print_function
 
 import abc
 import sys
+import math
 import inspect
 
 import tensorflow as tf
@@ -54,7 +61,23 @@ class Joker(Block):
 class JokerSystem(LinkedSystem):
     """
     A system consists of linearly linked jokers to do data augmentation.
+
+    If `batch_mode` is True, the system is set up on batches of shape [N, H,
+    W, C] instead of single datum. Jokers attached should support batches,
+    which all jokers in this module do.
     """
+    def __init__(self, batch_mode=False, **kwargs):
+        super(JokerSystem, self).__init__(**kwargs)
+        self.batch_mode = batch_mode
+
+    def _setup(self, data_in):
+        rank = data_in.get_shape().ndims
+        assert rank is None or rank == (4 if self.batch_mode else 3),\
+            "A `JokerSystem` in batch mode takes batches of shape [N, H, W, C]," \
+            " otherwise datum of shape [H, W, C]; got shape {}.".format(
+                data_in.get_shape())
+        super(JokerSystem, self)._setup(data_in)
+
     def attach(self, joker):
         assert issubclass(type(joker), Joker),\
             "A `JokerSystem` should only contain `Joker`s."
@@ -86,6 +109,10 @@ class CropJoker(Joker):
         self.central_fraction = central_fraction
 
     def _setup(self, data_in):
+        if _is_batch(data_in):
+            self._data = self._crop_batch(data_in)
+            return
+
         if self.center:
             log.info("Center crop images.")
             if self.central_fraction:
@@ -102,6 +129,40 @@ class CropJoker(Joker):
             self._data = tf.random_crop(data_in,
                                         [self.height, self.width, shape[-1]])
 
+    def _crop_batch(self, data_in):
+        num, height, width, depth = data_in.get_shape().as_list()
+        if self.center:
+            log.info("Center crop batches.")
+            if self.central_fraction:
+                out_height = int(height * self.central_fraction)
+                out_width = int(width * self.central_fraction)
+            else:
+                out_height, out_width = self.height, self.width
+            return _center_crop_or_pad_batch(data_in, out_height, out_width)
+
+        log.info("Randomly crop batches.")
+        assert self.width and self.height,\
+            "crop height and width should not be None."
+        # Offsets of each sample.
+        offsets_h = _random_ints([num], height - self.height + 1)
+        offsets_w = _random_ints([num], width - self.width + 1)
+        rows = tf.expand_dims(offsets_h, 1) \
+            + tf.expand_dims(tf.range(self.height), 0)
+        cols = tf.expand_dims(offsets_w, 1) \
+            + tf.expand_dims(tf.range(self.width), 0)
+        # Gather pixels of all crops at once by indices of shape [N, height,
+        # width, 3], whose last dimension is (sample, row, col).
+        samples = tf.tile(tf.reshape(tf.range(num), [num, 1, 1]),
+                          [1, self.height, self.width])
+        rows = tf.tile(tf.reshape(rows, [num, self.height, 1]),
+                       [1, 1, self.width])
+        cols = tf.tile(tf.reshape(cols, [num, 1, self.width]),
+                       [1, self.height, 1])
+        indices = tf.pack([samples, rows, cols], axis=3)
+        data = tf.gather_nd(data_in, indices)
+        data.set_shape([num, self.height, self.width, depth])
+        return data
+
 
 class FlipJoker(Joker):
     def __init__(self, flip_left_right=True, **kwargs):
@@ -117,6 +178,16 @@ class FlipJoker(Joker):
         self.flip_left_right = flip_left_right
 
     def _setup(self, data_in):
+        if _is_batch(data_in):
+            log.info("Randomly flip samples of batches.")
+            dims = [False, False, True, False] if self.flip_left_right \
+                else [False, True, False, False]
+            flipped = tf.reverse(data_in, dims)
+            num = data_in.get_shape().as_list()[0]
+            mask = _random_mask(num, data_in.dtype)
+            self._data = mask * flipped + (1 - mask) * data_in
+            return
+
         if self.flip_left_right:
             log.info("Randomly flip image left right.")
             self._data = tf.image.random_flip_left_right(data_in)
@@ -142,6 +213,10 @@ class LightJoker(Joker):
 
     def _setup(self, data_in):
         data = data_in
+        if _is_batch(data):
+            self._data = self._light_batch(data)
+            return
+
         # TODO(Shuai): The parameters should not be hard coded.
         if self.contrast:
             log.info("Randomly change contrast.")
@@ -152,13 +227,41 @@ class LightJoker(Joker):
 
         self._data = data
 
+    def _light_batch(self, data):
+        num = data.get_shape().as_list()[0]
+        if self.contrast:
+            log.info("Randomly change contrast of samples of batches.")
+            # As `tf.image.adjust_contrast`, the mean is per image per
+            # channel.
+            factors = tf.random_uniform([num, 1, 1, 1], 0.2, 1.8)
+            means = tf.reduce_mean(data, [1, 2], keep_dims=True)
+            data = (data - means) * factors + means
+        if self.brightness:
+            log.info("Randomly change brightness of samples of batches.")
+            data = data + tf.random_uniform([num, 1, 1, 1], -63, 63)
+        return data
+
 
 class WhitenJoker(Joker):
     """
     Per image whitening joke.
     """
     def _setup(self, data_in):
-        self._data = tf.image.per_image_standardization(data_in)
+        if not _is_batch(data_in):
+            self._data = tf.image.per_image_standardization(data_in)
+            return
+
+        # The same with `tf.image.per_image_standardization` on each sample,
+        # which works in float32 whatever the dtype of images is.
+        data_in = tf.cast(data_in, tf.float32)
+        num_elements = data_in.get_shape()[1:].num_elements()
+        means = tf.reduce_mean(data_in, [1, 2, 3], keep_dims=True)
+        variances = tf.reduce_mean(tf.square(data_in - means),
+                                   [1, 2, 3],
+                                   keep_dims=True)
+        stddevs = tf.maximum(tf.sqrt(variances),
+                             1.0 / math.sqrt(num_elements))
+        self._data = (data_in - means) / stddevs
 
 
 class RescaleJoker(Joker):
@@ -166,7 +269,12 @@ class RescaleJoker(Joker):
     Rescale images to $[0, 1]$.
     """
     def _setup(self, data_in):
-        self._data = akid.image.rescale_image(data_in)
+        if not _is_batch(data_in):
+            self._data = akid.image.rescale_image(data_in)
+            return
+
+        data = tf.cast(data_in, tf.float32)
+        self._data = data / tf.reduce_max(data, [1, 2, 3], keep_dims=True)
 
 
 class ResizeJoker(Joker):
@@ -194,9 +302,13 @@ class ResizeJoker(Joker):
         self.resize_method = resize_method
 
     def _setup(self, data_in):
-        shape = data_in.get_shape().as_list()
-        if len(shape) == 3:
-            data = tf.expand_dims(data_in, 0)
+        if _is_batch(data_in):
+            self._data = tf.image.resize_images(data_in,
+                                                [self.height, self.width],
+                                                method=self.resize_method)
+            return
+
+        data = tf.expand_dims(data_in, 0)
         resized_image = tf.image.resize_images(data,
                                                [self.height, self.width],
                                                method=self.resize_method)
@@ -204,5 +316,52 @@ class ResizeJoker(Joker):
         self._data = resized_image
 
 
+def _is_batch(data):
+    return len(data.get_shape().as_list()) == 4
+
+
+def _random_ints(shape, maxval):
+    """
+    Return int32 tensor of `shape` uniformly drawn from [0, maxval).
+    """
+    return tf.minimum(
+        tf.cast(tf.floor(tf.random_uniform(shape) * maxval), tf.int32),
+        maxval - 1)
+
+
+def _random_mask(num, dtype):
+    """
+    Return a tensor of shape [num, 1, 1, 1] of `dtype`, each element of which
+    is 1 or 0 with equal probability.
+    """
+    return tf.cast(tf.random_uniform([num, 1, 1, 1]) < 0.5, dtype)
+
+
+def _center_crop_or_pad_batch(data, height, width):
+    """
+    Centrally crop or evenly pad with zeros samples of batch `data` to
+    `height` and `width`, the same with `tf.image.resize_image_with_crop_or_pad`
+    on each sample.
+    """
+    _, in_height, in_width, _ = data.get_shape().as_list()
+    # Crop the dimensions larger than the target.
+    offset_h = max((in_height - height) // 2, 0)
+    offset_w = max((in_width - width) // 2, 0)
+    data = data[:,
+                offset_h:offset_h + min(in_height, height),
+                offset_w:offset_w + min(in_width, width),
+                :]
+    # Pad the dimensions smaller than the target.
+    pad_h = max(height - in_height, 0)
+    pad_w = max(width - in_width, 0)
+    if pad_h or pad_w:
+        data = tf.pad(data, [[0, 0],
+                             [pad_h // 2, pad_h - pad_h // 2],
+                             [pad_w // 2, pad_w - pad_w // 2],
+                             [0, 0]])
+    return data
+
+
 __all__ = [name for name, x in locals().items() if
-           not inspect.ismodule(x) and not inspect.isabstract(x)]
+           not inspect.ismodule(x) and not inspect.isabstract(x) and
+           not name.startswith("_")]
@@ -6,13 +6,17 @@ from __future__ import absolute_import, division, print_function
 import os
 import time
 import sys
+import json
 import inspect
+import multiprocessing
 
 import tensorflow as tf
 
 from ..utils import glog as log
 from . import sensors
 from . import engines
+from . import savers
+from . import profilers
 from .kongfus import LearningRateScheme
 from . import common
 from .common import (
@@ -70,7 +74,18 @@ class Kid(object):
                  graph=None,
                  save_chk_point=True,
                  do_summary=True,
-                 summary_on_val=False):
+                 summary_on_val=False,
+                 accumulate_val_on_device=False,
+                 async_chk_point=False,
+                 max_chk_points_in_flight=1,
+                 keep_last_chk_points=5,
+                 keep_best_chk_points=0,
+                 val_in_background=False,
+                 summary_steps=None,
+                 profile=False,
+                 trace_step=None,
+                 summary_dir=None,
+                 evaluate_only=False):
         """
         Assemble a sensor, a brain, and a KongFu to start the survival game.
 
@@ -86,7 +101,8 @@ class Kid(object):
                 to use, which implements parallel scheme. Available engines
                 are:
 
-                    'single', 'data_parallel'
+                    'single', 'data_parallel', 'cpu_data_parallel',
+                    'ps_async', 'ps_sync'
 
                 Default parameters of that scheme will be used.
 
@@ -94,6 +110,12 @@ class Kid(object):
 
                     {"name": "single"}
                     {"name": "data_parallel", "num_gpu": 2}
+                    {"name": "cpu_data_parallel", "num_cpu": 4}
+                    {"name": "ps_async",
+                     "cluster": {"ps": ["localhost:2222"],
+                                 "worker": ["localhost:2223"]},
+                     "job_name": "worker",
+                     "task_index": 0}
 
                where the `name` key indicates the parallel scheme while other
                keys are parameters of that scheme. If parameters are not
@@ -136,6 +158,60 @@ class Kid(object):
                 validation source will reshuffle data after one epoch is
                 finished, some validation may be reused and some may not be
                 seen at all when doing the actual validation.
+            accumulate_val_on_device: Boolean
+                If True, loss and evaluation metrics of validation are summed
+                up by accumulator variables in the graph, so each validation
+                batch only runs an update op, and the results are fetched once
+                for an epoch. It saves the overhead of fetching scalars for
+                each batch, which is noticeable on small models.
+            async_chk_point: Boolean
+                If True, checkpoints are snapshotted into host memory and
+                written by a background thread, so training does not wait for
+                disk. See `savers.AsyncSaver`.
+            max_chk_points_in_flight: int
+                The maximal number of checkpoints being written in background.
+                Saving blocks when it is reached.
+            keep_last_chk_points: int
+                The number of latest checkpoints to keep.
+            keep_best_chk_points: int
+                The number of checkpoints with the lowest validation loss to
+                keep, in addition to the latest ones. Only supported with
+                `async_chk_point`.
+            val_in_background: Boolean
+                If True, `practice` only saves checkpoints at validation steps,
+                and leaves validation to an evaluator process polling
+                `model_dir`, so training never pauses for it. See
+                `run_evaluator` and `evaluate`.
+            summary_steps: dict
+                Every how many steps summaries are collected. Keys are kinds
+                of summaries, which are "scalar", "histogram", "image" and
+                "audio", or names of summary collections, which take priority
+                over kinds. For example::
+
+                    {"scalar": 100, "histogram": 1000, "image": 5000}
+
+                Summaries not covered are collected every `train_log_step`
+                steps. Due summaries are fetched in the same `sess.run` with
+                the training step, so collecting them does not run the
+                brain again. Steps of the `SummaryPolicy` of the brain, if
+                any, are merged in with a lower priority.
+            profile: Boolean
+                If True, time spent in each phase of the training loop is
+                recorded by a `profilers.StepProfiler`, and its rolling
+                percentiles are logged by a hook at `on_train_log_step`.
+            trace_step: int
+                If given along with `profile`, a full trace of the training
+                step is captured every `trace_step` steps, and written to
+                `log_dir/traces` as a chrome trace file.
+            summary_dir: str
+                The folder to save tensorboard events to. If not given,
+                `log_dir` is used. An evaluator sharing `log_dir` with a
+                training kid uses `log_dir/eval` by default, see
+                `run_evaluator`.
+            evaluate_only: Boolean
+                If True, the kid only evaluates checkpoints by `evaluate`, so
+                training data are neither prefetched nor augmented. Kids
+                started by `run_evaluator` set it.
             Other args are self-evident.
         """
         self.sensor = sensor_in
@@ -156,6 +232,9 @@ class Kid(object):
             self.log_dir = os.path.normpath(log_dir)
         self.log_filepath = self.log_dir + "/training.log"
         self.model_dir = self.log_dir + "/model"
+        self.summary_dir = os.path.normpath(summary_dir) if summary_dir \
+            else self.log_dir
+        self.evaluate_only = evaluate_only
         self.log_to_file = log_to_file
 
         self.max_steps = max_steps
@@ -170,6 +249,25 @@ class Kid(object):
         self.summary_on_val = summary_on_val
         self.do_summary = do_summary
         self.save_chk_point = save_chk_point
+        self.accumulate_val_on_device = accumulate_val_on_device
+        self.async_chk_point = async_chk_point
+        self.max_chk_points_in_flight = max_chk_points_in_flight
+        self.keep_last_chk_points = keep_last_chk_points
+        self.keep_best_chk_points = keep_best_chk_points
+        assert async_chk_point or not keep_best_chk_points,\
+            "Keeping the best checkpoints needs `async_chk_point`."
+        self.val_in_background = val_in_background
+        self.summary_steps = summary_steps if summary_steps else {}
+        assert save_chk_point or not val_in_background,\
+            "Validation in background needs checkpoints to be saved."
+        assert not (keep_best_chk_points and val_in_background),\
+            "Keeping the best checkpoints needs validation in training."
+        if profile:
+            self.profiler = profilers.StepProfiler(
+                trace_step=trace_step,
+                trace_dir=self.log_dir + "/traces")
+        else:
+            self.profiler = None
 
         # A tensorflow computational graph to hold training and validating
         # graphs.
@@ -207,9 +305,15 @@ class Kid(object):
                 self.on_batch_begin.append(on_batch_begin)
 
         self.hooks = hooks()
+        if self.profiler:
+            from .callbacks import on_train_log_step_profile
+            self.hooks.on_training_log.append(on_train_log_step_profile)
 
         # Class members whose value depends on the state of the class.
         self.feed_dict = None
+        self._warned_inexact_val = False
+        # The learning rate of the last step, if it decays by steps.
+        self.learning_rate_value = None
         self.loss_value = None
         self.evals = None
         self.best_val_evals = None
@@ -228,56 +332,142 @@ class Kid(object):
         if not self.initialized:
             self.init(continue_from_chk_point=True)
 
-        # Run one epoch of eval.
+        # Run one epoch of eval. Loss and evaluation metrics are means over
+        # batches, so they are weighted by the number of samples in each
+        # batch.
+        if self.accumulate_val_on_device:
+            loss, eval_metric_values = self._run_val_epoch_on_device()
+        else:
+            loss, eval_metric_values = self._run_val_epoch()
+
+        self.loss_value = loss
+        self.evals = eval_metric_values
+        self.on_val_log_step()
+
+        return loss
+
+    def _run_val_epoch(self):
+        """
+        Run an epoch of validation, fetching loss and evaluation metrics of
+        each batch, and accumulating them in python.
+        """
+        fetch = [self.engine.loss(get_val=True)]
+        fetch.extend(self.engine.eval(get_val=True))
+        if self.engine.val_remainder_brain:
+            remainder_fetch = [self.engine.val_remainder_loss()]
+            remainder_fetch.extend(self.engine.val_remainder_eval())
+
         eval_metric_values = [0] * len(self.engine.eval(get_val=True))
         loss = 0
-        steps_per_epoch = self.sensor.num_batches_per_epoch_val
-
-        for step in xrange(steps_per_epoch):
-            if type(self.sensor) is sensors.FeedSensor:
-                self.feed_dict = self.sensor.fill_feed_dict(get_val=True)
+        num_samples = 0
 
-            fetch = [self.engine.loss(get_val=True)]
-            fetch.extend(self.engine.eval(get_val=True))
-            result = self.sess.run(fetch, feed_dict=self.feed_dict)
+        for feed_dict, is_remainder, num in self._val_batches():
+            result = self.sess.run(remainder_fetch if is_remainder else fetch,
+                                   feed_dict=feed_dict)
 
-            loss += result[0]
+            loss += result[0] * num
             for i, v in enumerate(result[1:]):
-                eval_metric_values[i] += v
+                eval_metric_values[i] += v * num
+            num_samples += num
 
-        loss /= steps_per_epoch
+        loss /= num_samples
         for i, v in enumerate(eval_metric_values):
-            eval_metric_values[i] = v / steps_per_epoch
+            eval_metric_values[i] = v / num_samples
 
-        self.loss_value = loss
-        self.evals = eval_metric_values
-        self.on_val_log_step()
+        return loss, eval_metric_values
 
-        return loss
+    def _run_val_epoch_on_device(self):
+        """
+        Run an epoch of validation, only running update ops of accumulators of
+        the engine on each batch, and fetching the means once at last. See
+        `Engine._setup_val_accumulators`.
+        """
+        self.sess.run(self.engine.val_accum_reset_op)
+        for feed_dict, is_remainder, num in self._val_batches():
+            if is_remainder:
+                self.sess.run(self.engine.val_remainder_accum_update_op,
+                              feed_dict=feed_dict)
+            else:
+                if num != self.sensor.val_batch_size:
+                    feed_dict = dict(feed_dict) if feed_dict else {}
+                    feed_dict[self.engine.val_accum_weight] = num
+                self.sess.run(self.engine.val_accum_update_op,
+                              feed_dict=feed_dict)
+
+        result = self.sess.run(self.engine.val_accum_values)
+
+        return result[0], result[1:]
+
+    def _val_batches(self):
+        """
+        Yield a tuple of (feed dict, whether the batch is the remainder,
+        number of samples) for each batch of an epoch of validation data.
+
+        For a `FeedSensor`, the epoch is exact, and the remainder batch should
+        be run on the remainder tower of the engine. Other sensors dequeue
+        full batches from a validation queue that cycles over shuffled
+        samples, which is not able to supply each sample exactly once, so
+        metrics are only estimates on `num_batches_per_epoch_val` full batches
+        drawn from it.
+        """
+        if type(self.sensor) is sensors.FeedSensor:
+            for feed_dict, num in self.sensor.val_feed_dicts():
+                yield feed_dict, num != self.sensor.val_batch_size, num
+            return
+
+        if not self._warned_inexact_val:
+            log.warning("{} supplies validation data by a queue, so"
+                        " validation metrics are estimates on batches drawn"
+                        " from it, instead of exact ones over each of {}"
+                        " samples. Use a `FeedSensor` for exact"
+                        " metrics.".format(type(self.sensor).__name__,
+                                           self.sensor.source.num_val))
+            self._warned_inexact_val = True
+        for _ in xrange(self.sensor.num_batches_per_epoch_val):
+            yield self.feed_dict, False, self.sensor.val_batch_size
 
     def setup(self):
         """
         Set up logging and the computation graph.
         """
         with self.graph.as_default():
-            common.init()
-            self.global_step_tensor = common.global_step_tensor
-            self._setup_log()
-            self._setup_sensor()
             self._setup_engine()
-            self._setup_summary()
-            # Group train ops.
-            if type(self.brain.train_op) is list:
-                train_op_list = list(self.brain.train_op)
-            else:
-                train_op_list = [self.brain.train_op]
-            train_op_list.append(self.engine.train_op)
-            self.train_op = tf.group(*train_op_list)
-            self.saver = tf.train.Saver(tf.global_variables())
+            if self.engine.is_ps:
+                # A parameter server only serves variables, see `practice`.
+                return
+            with self.engine.device_scope():
+                common.init()
+                self.global_step_tensor = common.global_step_tensor
+                self._setup_log()
+                self._setup_sensor()
+                self.engine.setup()
+                self._setup_summary()
+                # Group train ops.
+                if type(self.brain.train_op) is list:
+                    train_op_list = list(self.brain.train_op)
+                else:
+                    train_op_list = [self.brain.train_op]
+                if self.engine.accum_op is not None:
+                    self.accum_op = tf.group(
+                        *(train_op_list + [self.engine.accum_op]))
+                train_op_list.append(self.engine.train_op)
+                self.train_op = tf.group(*train_op_list)
+                self.saver = tf.train.Saver(
+                    tf.global_variables(),
+                    max_to_keep=self.keep_last_chk_points)
+            if self.async_chk_point:
+                self.async_saver = savers.AsyncSaver(
+                    tf.global_variables(),
+                    max_in_flight=self.max_chk_points_in_flight,
+                    keep_last=self.keep_last_chk_points,
+                    keep_best=self.keep_best_chk_points)
             if self.sess is None:
                 config = tf.ConfigProto(allow_soft_placement=True)
                 config.gpu_options.allow_growth = True
-                self.sess = tf.Session(graph=self.graph, config=config)
+                self.engine.session_config(config)
+                self.sess = tf.Session(self.engine.master,
+                                       graph=self.graph,
+                                       config=config)
 
     def teardown(self):
         """
@@ -286,6 +476,12 @@ class Kid(object):
         This method has not been tested whether it works or not. It stays here
         to remind that any session created by kid may cause memory leak.
         """
+        if type(self.sensor) in [sensors.FeedSensor,
+                                 sensors.DatasetSensor,
+                                 sensors.IntegratedSensor]:
+            self.sensor.teardown()
+        if self.async_chk_point:
+            self.async_saver.close()
         self.sess.close()
         self.sess.reset()
 
@@ -298,9 +494,16 @@ class Kid(object):
             continue_from_chk_point: Boolean
                 Setup configuration. Passed to `setup`
         Return:
-            None
+            The validation loss of the last validation, or None if
+            `val_in_background` is True.
         """
+        if self.engine.is_ps:
+            log.info("Serving variables as a parameter server.")
+            self.engine.join()
+            return None
+
         try:
+            loss = None
             self.init(continue_from_chk_point)
             # And then after everything is built, start the training loop.
             log.info("Begin training brain: " + self.brain.name)
@@ -308,35 +511,98 @@ class Kid(object):
                                                  self.global_step_tensor)
             self.step = previous_step
             # Note the epoch estimation is not accurate if the batch size
-            # cannot divide total number of training samples.
-            self.epoch = previous_step \
+            # cannot divide total number of training samples. A step runs
+            # `accum_steps` batches if gradients are accumulated.
+            self.epoch = previous_step * self.engine.accum_steps \
                 // self.sensor.num_batches_per_epoch_train
 
             self.on_train_begin()
 
             while self.step < self.max_steps + 1:
-                if self.step % self.val_log_step == 0 or\
-                   self.step == self.max_steps:
+                # Only the chief validates and saves checkpoints, if
+                # variables are shared by workers.
+                if self.engine.is_chief and \
+                   (self.step % self.val_log_step == 0 or
+                        self.step == self.max_steps):
                     if self.save_chk_point:
-                        self.save_to_ckpt()
-                    loss = self.validate()
+                        with self._profile("ckpt"):
+                            path = self.save_to_ckpt()
+                    if not self.val_in_background:
+                        with self._profile("val"):
+                            loss = self.validate()
+                        if self.save_chk_point and self.async_chk_point:
+                            self.async_saver.report(path, loss)
 
                 self.forward_backward()
 
                 self.step += 1
 
-                if self.step % self.sensor.num_batches_per_epoch_train is 0:
+                if self.step * self.engine.accum_steps \
+                   // self.sensor.num_batches_per_epoch_train > self.epoch:
                     self.epoch += 1
-                    self.on_epoch_end()
+                    with self._profile("hooks"):
+                        self.on_epoch_end()
 
                 if self.step % self.train_log_step == 0:
-                    self.on_train_log_step()
+                    with self._profile("hooks"):
+                        self.on_train_log_step()
+
+            self.engine.on_train_end(self.sess)
+
+            if self.async_chk_point:
+                self.async_saver.flush()
 
             return loss
         except tf.OpError as e:
             log.info("Tensorflow error when running: {}".format(e.message))
             sys.exit(0)
 
+    def evaluate(self, poll_interval=30, timeout=None):
+        """
+        Act as an evaluator of a kid training with the same `log_dir`: poll
+        `model_dir`, and validate on each new latest checkpoint, till the
+        checkpoint of the last step is validated, or no new checkpoint comes
+        in `timeout` seconds. The kid should have been set up.
+
+        Checkpoints written while a validation is running are skipped, except
+        the latest one.
+
+        Args:
+            poll_interval: float
+                Seconds to wait before polling again.
+            timeout: float
+                If not None, give up after this many seconds without new
+                checkpoints.
+        """
+        last_path = None
+        last_time = time.time()
+        while True:
+            checkpoint = tf.train.get_checkpoint_state(self.model_dir)
+            if checkpoint and checkpoint.model_checkpoint_path != last_path:
+                last_path = checkpoint.model_checkpoint_path
+                try:
+                    if self.initialized:
+                        self.restore_from_ckpt()
+                    else:
+                        self.init(continue_from_chk_point=True)
+                except tf.errors.NotFoundError as e:
+                    # The checkpoint may be deleted by the retention policy
+                    # of the trainer in the mean time.
+                    log.info("Skipped checkpoint {}: {}".format(last_path, e))
+                    continue
+                self.step = tf.train.global_step(self.sess,
+                                                 self.global_step_tensor)
+                self.validate()
+                last_time = time.time()
+                if self.step >= self.max_steps:
+                    return
+            elif timeout is not None and time.time() - last_time > timeout:
+                log.info("No new checkpoint in {} seconds. Stop"
+                         " evaluating.".format(timeout))
+                return
+            else:
+                time.sleep(poll_interval)
+
     def _setup_log(self):
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
@@ -352,27 +618,73 @@ class Kid(object):
     def _setup_summary(self):
         if self.do_summary:
             # SummaryWriter to output summaries and the Graph.
-            self.summary_writer = tf.summary.FileWriter(self.log_dir)
+            self.summary_writer = tf.summary.FileWriter(self.summary_dir)
             log.info("Summary event file will be saved to {}".format(
-                self.log_dir))
-            # Build the summary operation based on the TF collection of
+                self.summary_dir))
+            # Build summary operations based on the TF collections of
             # Summaries.
-            summary_ops = tf.get_collection(TRAIN_SUMMARY_COLLECTION)
-            summary_ops.extend(tf.get_collection(
-                TRAINING_DYNAMICS_COLLECTION))
-            if self.summary_on_val:
-                val_summary_ops = tf.get_collection(
-                    VALID_SUMMARY_COLLECTION)
-                summary_ops.extend(val_summary_ops)
-            self.summary_op = tf.summary.merge(summary_ops)
+            self._setup_periodic_summary_ops()
             # Write the brain to tensorflow event file.
             self.summary_writer.add_graph(self.graph)
 
+    def _setup_periodic_summary_ops(self):
+        """
+        Group summary ops by every how many steps they are collected, and merge
+        each group into one op. See `summary_steps`.
+        """
+        collections = [TRAIN_SUMMARY_COLLECTION, TRAINING_DYNAMICS_COLLECTION]
+        if self.summary_on_val:
+            collections.append(VALID_SUMMARY_COLLECTION)
+
+        summary_steps = {}
+        if self.brain.summary_policy is not None:
+            summary_steps.update(
+                self.brain.summary_policy.step_collections())
+        summary_steps.update(self.summary_steps)
+
+        # Summary ops could be in more collections than those gathered, such
+        # as those of kinds of summaries of `SummaryPolicy`.
+        steps_by_collection = {}
+        for c, step in summary_steps.items():
+            for op in tf.get_collection(c):
+                steps_by_collection[op] = step
+
+        groups = {}
+        for c in collections:
+            for op in tf.get_collection(c):
+                if c in summary_steps:
+                    step = summary_steps[c]
+                elif op in steps_by_collection:
+                    step = steps_by_collection[op]
+                else:
+                    # Types of summary ops are like "HistogramSummary".
+                    kind = op.op.type.replace("Summary", "").lower()
+                    step = summary_steps.get(kind, self.train_log_step)
+                groups.setdefault(step, []).append(op)
+
+        self.periodic_summary_ops = {
+            step: tf.summary.merge(ops) for step, ops in groups.items()}
+
+    def _due_summary_ops(self, step):
+        """
+        Return merged summary ops that should be collected at `step`.
+        """
+        if not self.do_summary:
+            return []
+        return [op for s, op in self.periodic_summary_ops.items()
+                if step % s == 0]
+
     def _setup_sensor(self):
+        if type(self.sensor) is sensors.FeedSensor:
+            self.sensor.val_only = self.evaluate_only
         # Build training graph.
         self.sensor.setup()
 
     def _setup_engine(self):
+        """
+        Create the engine by `engine_para`. The engine is set up later in
+        its device scope, see `setup`.
+        """
         if type(self.engine_para) is str:
             engine_name = self.engine_para
         else:
@@ -385,17 +697,29 @@ class Kid(object):
         if engine_name == "single":
             self.engine = engines.SingleGPUEngine(self)
         elif engine_name == "data_parallel":
-            if type(self.engine_para) is str:
-                # TODO: automatically use the maximal even number of gpus.
-                num_gpu = 2
-            else:
-                num_gpu = self.engine_para["num_gpu"]
-            self.engine = engines.DataParallelEngine(num_gpu, kid=self)
+            # TODO: automatically use the maximal even number of gpus.
+            self.engine = engines.DataParallelEngine(
+                kid=self, **self._engine_kwargs())
+        elif engine_name == "cpu_data_parallel":
+            self.engine = engines.CPUDataParallelEngine(
+                kid=self, **self._engine_kwargs())
+        elif engine_name == "ps_async":
+            self.engine = engines.ParameterServerEngine(
+                kid=self, **self._engine_kwargs())
+        elif engine_name == "ps_sync":
+            self.engine = engines.SyncParameterServerEngine(
+                kid=self, **self._engine_kwargs())
         else:
             raise Exception('No engine "{}". Perhaps you have a typo.'.format(
                 engine_name))
 
-        self.engine.setup()
+    def _engine_kwargs(self):
+        """
+        Return parameters of the engine other than its name.
+        """
+        if type(self.engine_para) is str:
+            return {}
+        return {k: v for k, v in self.engine_para.items() if k != "name"}
 
     def init(self, continue_from_chk_point=None):
         """
@@ -409,34 +733,86 @@ class Kid(object):
                 with saved models.
         """
         # Initialization.
-        if continue_from_chk_point:
+        if not self.engine.is_chief:
+            # Variables are shared, and initialized or restored by the chief.
+            self.engine.wait_for_variables(self.sess)
+        elif continue_from_chk_point:
             # Train from pre-trained model.
             self.restore_from_ckpt()
         else:
             with self.graph.as_default():
                 init = tf.global_variables_initializer()
             self.sess.run(init)
+        # Local variables, such as accumulators of validation, are not saved
+        # in checkpoints, so they are always initialized.
+        with self.graph.as_default():
+            local_init = tf.local_variables_initializer()
+        self.sess.run(local_init)
+        if not self.initialized:
+            self.engine.on_session_init(self.sess)
 
         # Start queue runner if needed.
         if type(self.sensor) is sensors.IntegratedSensor:
             if not self.initialized:
                 tf.train.start_queue_runners(sess=self.sess)
+                self.sensor.start_queue_tuner(self.sess)
+        if type(self.sensor) is sensors.DatasetSensor:
+            if not self.initialized:
+                self.sensor.start(self.sess)
+        # Start prefetching if needed.
+        if type(self.sensor) is sensors.FeedSensor:
+            if not self.initialized and not self.evaluate_only:
+                self.sensor.start_prefetch(with_val=self.summary_on_val)
 
         self.initialized = True
 
         if self.max_epoch:
             # Convert the max epoch number to max steps.
             self.max_steps \
-                = self.sensor.num_batches_per_epoch_train * self.max_epoch
+                = self.sensor.num_batches_per_epoch_train * self.max_epoch \
+                // self.engine.accum_steps
 
     def save_to_ckpt(self):
+        """
+        Save variables to a checkpoint. If the sensor is a `FeedSensor` whose
+        source supports it, the state of the source is saved along with the
+        checkpoint as well, so training could be resumed with the same order of
+        data.
+
+        Return:
+            The path prefix of the checkpoint. If `async_chk_point` is True,
+            the checkpoint may still be being written when it returns.
+        """
         step = tf.train.global_step(self.sess, self.global_step_tensor)
-        self.saver.save(self.sess,
-                        self.model_dir + "/checkpoint",
-                        global_step=step)
+        if self.async_chk_point:
+            path = self.async_saver.save(self.sess,
+                                         self.model_dir + "/checkpoint",
+                                         global_step=step)
+        else:
+            last_checkpoints = self.saver.last_checkpoints
+            path = self.saver.save(self.sess,
+                                   self.model_dir + "/checkpoint",
+                                   global_step=step)
+            # The saver deletes checkpoints beyond `max_to_keep`, but not
+            # files saved along with them. The async saver removes them
+            # itself.
+            for p in set(last_checkpoints) - set(self.saver.last_checkpoints):
+                state_path = self._source_state_path(p)
+                if os.path.exists(state_path):
+                    os.remove(state_path)
+        if type(self.sensor) is sensors.FeedSensor:
+            state = self.sensor.get_source_state()
+            if state is not None:
+                with open(self._source_state_path(path), "w") as f:
+                    json.dump(state, f)
         log.info("Checkpoint at step {} saved to folder:"
                  " {}".format(step, self.model_dir))
 
+        return path
+
+    def _source_state_path(self, checkpoint_path):
+        return checkpoint_path + ".source_state.json"
+
     def restore_from_ckpt(self):
         """
         Restore variables of this net from the latest checkpoint of
@@ -450,6 +826,14 @@ class Kid(object):
             log.info("Recovering net from checkpoint %s."
                      % checkpoint.model_checkpoint_path)
             self.saver.restore(self.sess, checkpoint.model_checkpoint_path)
+            state_path = self._source_state_path(
+                checkpoint.model_checkpoint_path)
+            if type(self.sensor) is sensors.FeedSensor \
+               and os.path.exists(state_path):
+                with open(state_path, "r") as f:
+                    self.sensor.set_source_state(json.load(f))
+                log.info("Restored the state of the source from {}.".format(
+                    state_path))
             filename = checkpoint.model_checkpoint_path.split('/')[-1]
             step = int(filename.split('-')[-1])
             return step
@@ -461,7 +845,8 @@ class Kid(object):
         if type(self.sensor) is sensors.FeedSensor:
             # Placeholder of `FeedSensor` should be filled.
             self.feed_dict = self.sensor.fill_feed_dict()
-            if self.summary_on_val:
+            # Prefetched feed dicts already hold validation data when needed.
+            if self.summary_on_val and not self.sensor.is_prefetching:
                 # Validation data is also needed, so add them in.
                 val_feed_dict = self.sensor.fill_feed_dict(True)
                 self.feed_dict.update(val_feed_dict)
@@ -479,19 +864,103 @@ class Kid(object):
     def forward_backward(self):
         """
         Train for one step.
+
+        If gradients are accumulated, all but the last batch of the step only
+        accumulate gradients, and the loss and evaluation metrics of the step
+        are averaged over its batches.
         """
         # Run one step.
-        self.on_batch_begin()
+        with self._profile("hooks"):
+            self.on_batch_begin()
+
+        step_start_time = time.time()
+        accum_results = self._accumulate_grads()
 
-        self.fill_train_feed_dict()
+        with self._profile("feed"):
+            self.fill_train_feed_dict()
 
         fetch = [self.train_op, self.engine.loss()]
         fetch.extend(self.engine.eval())
+        num_fetch = len(fetch)
+        # Summaries are named by the step after this one, the same with the
+        # step training logs are named by.
+        summary_ops = self._due_summary_ops(self.step + 1)
+        num_summaries = len(summary_ops)
+        fetch.extend(summary_ops)
+        # The learning rate is fetched along, so logging does not need to run
+        # the graph again.
+        fetch_lr = self.kongfu.lr_scheme["name"] \
+            is LearningRateScheme.exp_decay
+        if fetch_lr:
+            fetch.append(self.kongfu.learning_rate)
+        num_step_fetch = len(fetch)
+        if type(self.sensor) is sensors.IntegratedSensor:
+            fetch.extend(self.sensor.queue_fetches())
+        trace = self.profiler and self.profiler.should_trace(self.step + 1)
+        if trace:
+            options = profilers.StepProfiler.trace_run_options()
+            run_metadata = tf.RunMetadata()
+        else:
+            options, run_metadata = None, None
         start_time = time.time()
-        result = self.sess.run(fetch, feed_dict=self.feed_dict)
-        self.forward_backward_time = time.time() - start_time
-        self.loss_value = result[1]
-        self.evals = result[2:]
+        result = self.sess.run(fetch,
+                               feed_dict=self.feed_dict,
+                               options=options,
+                               run_metadata=run_metadata)
+        if self.profiler:
+            self.profiler.record("run", time.time() - start_time)
+        self.forward_backward_time = time.time() - step_start_time
+        batch_results = accum_results + [result[1:num_fetch]]
+        self.loss_value = sum(r[0] for r in batch_results) \
+            / len(batch_results)
+        self.evals = [sum(r[i] for r in batch_results) / len(batch_results)
+                      for i in xrange(1, num_fetch - 1)]
+        if fetch_lr:
+            self.learning_rate_value = result[num_step_fetch - 1]
+        if type(self.sensor) is sensors.IntegratedSensor:
+            self.sensor.record_queue_stats(result[num_step_fetch:],
+                                           start_time)
+        with self._profile("summary"):
+            for summary_str in result[num_fetch:num_fetch + num_summaries]:
+                self.summary_writer.add_summary(summary_str, self.step + 1)
+            if trace:
+                self.profiler.trace(
+                    self.step + 1,
+                    run_metadata,
+                    self.summary_writer if self.do_summary else None)
+
+    def _accumulate_grads(self):
+        """
+        Run all but the last batch of a step if gradients are accumulated,
+        only accumulating their gradients.
+
+        Return:
+            A list of losses and evaluation metrics of each batch run.
+        """
+        results = []
+        if self.engine.accum_op is None:
+            return results
+
+        fetch = [self.accum_op, self.engine.loss()]
+        fetch.extend(self.engine.eval())
+        for _ in xrange(self.engine.accum_steps - 1):
+            with self._profile("feed"):
+                self.fill_train_feed_dict()
+            start_time = time.time()
+            results.append(self.sess.run(fetch, feed_dict=self.feed_dict)[1:])
+            if self.profiler:
+                self.profiler.record("run", time.time() - start_time)
+
+        return results
+
+    def _profile(self, phase):
+        """
+        Return a context manager timing `phase` of the training loop if
+        profiling, otherwise one doing nothing.
+        """
+        if self.profiler:
+            return self.profiler.phase(phase)
+        return profilers.NULL_PHASE
 
     def on_train_log_step(self):
         """
@@ -533,5 +1002,55 @@ class Kid(object):
         for func in self.hooks.on_epoch_end:
             func(self)
 
+
+def _evaluate(kid_factory, poll_interval, timeout, use_gpu):
+    if not use_gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    kid = kid_factory()
+    kid.evaluate_only = True
+    if kid.summary_dir == kid.log_dir:
+        # Keep events of validation apart from those of the training kid.
+        kid.summary_dir = kid.log_dir + "/eval"
+    kid.setup()
+    kid.evaluate(poll_interval=poll_interval, timeout=timeout)
+
+
+def run_evaluator(kid_factory, poll_interval=30, timeout=None, use_gpu=False):
+    """
+    Start a process that evaluates checkpoints of a kid training with
+    `val_in_background` True. See `Kid.evaluate`.
+
+    The process is forked, and forking a process with a running session is
+    not safe, so it should be started before the training kid is set up.
+
+    Args:
+        kid_factory: callable
+            Called without arguments in the evaluator process to build the
+            kid to validate with. It should have the same `log_dir` with the
+            training kid. Not logging to file is recommended, since the log
+            file is shared with the training kid. Summaries are saved to
+            `eval` under `log_dir`, unless `summary_dir` of the kid is
+            given.
+        poll_interval, timeout: See `Kid.evaluate`.
+        use_gpu: Boolean
+            If False, GPUs are hidden from the evaluator process, so it runs
+            on spare CPU cores.
+
+    Returns:
+        The started `multiprocessing.Process`. It is not a daemon, since the
+        kid in it may start processes, such as those of `FeedSensor`, so it
+        should be joined.
+    """
+    p = multiprocessing.Process(target=_evaluate,
+                                args=(kid_factory,
+                                      poll_interval,
+                                      timeout,
+                                      use_gpu))
+    p.start()
+
+    return p
+
+
 __all__ = [name for name, x in locals().items() if
-           not inspect.ismodule(x) and not inspect.isabstract(x)]
+           not inspect.ismodule(x) and not inspect.isabstract(x)
+           and not name.startswith("_")]
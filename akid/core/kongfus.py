@@ -31,6 +31,12 @@ class KongFu(ShadowableBlock):
 
     Any concrete `KongFu` should implement `_get_optimizer` to provide a
     concrete optimizer.
+
+    Gradients could be accumulated over `accum_steps` batches before they are
+    applied, so a large effective batch size could be trained with when a large
+    batch does not fit in memory. The accumulation is done by the `Engine`
+    training the kongfu, and a step of training, which increases the global
+    step, then runs `accum_steps` batches.
     """
     def __init__(self,
                  lr_scheme={"name": LearningRateScheme.exp_decay,
@@ -38,6 +44,7 @@ class KongFu(ShadowableBlock):
                             "decay_rate": 0.95,
                             "num_batches_per_epoch": 468,
                             "decay_epoch_num": 1},
+                 accum_steps=1,
                  **kwargs):
         """
         Only exponential decay policy is supported now. Learning rate decays to
@@ -61,6 +68,13 @@ class KongFu(ShadowableBlock):
                         standalone, you need to feed a value to
                         `KongFu.learning_rate`.
                  See the default value for an example usage.
+
+                 Note that 'num_batches_per_epoch' is the number of batches,
+                 while 'decay_steps' is the number of steps, each of which
+                 runs `accum_steps` batches.
+            accum_steps: int
+                 The number of batches whose gradients are accumulated before
+                 applied once.
         """
         # Since normally we do not care what the name of an optimizer is, just
         # give it a default name.
@@ -69,6 +83,8 @@ class KongFu(ShadowableBlock):
 
         super(KongFu, self).__init__(**kwargs)
         self.lr_scheme = lr_scheme
+        assert accum_steps >= 1, "`accum_steps` should be at least 1."
+        self.accum_steps = accum_steps
 
     def _setup(self, loss):
         """
@@ -81,7 +97,12 @@ class KongFu(ShadowableBlock):
                 decay_epoch_num = self.lr_scheme["decay_epoch_num"]
                 num_batches_per_epoch \
                     = self.lr_scheme["num_batches_per_epoch"]
-                decay_steps = num_batches_per_epoch * decay_epoch_num
+                # Global step only increases when accumulated gradients are
+                # applied.
+                decay_steps = max(
+                    num_batches_per_epoch * decay_epoch_num
+                    // self.accum_steps,
+                    1)
             else:
                 decay_steps = self.lr_scheme["decay_steps"]
 
@@ -0,0 +1,164 @@
+"""
+This module holds `StepProfiler`, which breaks down where wall time of the
+training loop of a `Kid` goes.
+
+Time is recorded by phases of the loop:
+
+* "feed": filling the feed dict of a step.
+* "run": running the training step in the session.
+* "hooks": calling hooks of the kid.
+* "val": validation.
+* "ckpt": saving checkpoints.
+* "summary": writing summaries.
+
+For each phase, a window of latest timings is kept, from which rolling
+percentiles are computed. Optionally, full traces of the session run are
+captured every some steps, and written to a folder as chrome trace files,
+which could be opened in `chrome://tracing`.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+import inspect
+import collections
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from ..utils import glog as log
+
+
+PHASES = ["feed", "run", "hooks", "val", "ckpt", "summary"]
+
+
+class _Phase(object):
+    """
+    Context manager recording the time spent in it to a phase of a profiler.
+    """
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, time.time() - self.start_time)
+        return False
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+class StepProfiler(object):
+    """
+    Record timings of phases of a training loop, and capture traces of
+    session runs.
+
+    Use `phase` to time a block of code::
+
+        with profiler.phase("feed"):
+            feed_dict = sensor.fill_feed_dict()
+    """
+    def __init__(self, window=1000, trace_step=None, trace_dir=None):
+        """
+        Args:
+            window: int
+                The number of latest timings of each phase to compute
+                percentiles on.
+            trace_step: int
+                Every how many steps to capture a trace of the session run. If
+                None, no trace is captured.
+            trace_dir: str
+                The folder to write traces to. It is created if it does not
+                exist.
+        """
+        assert trace_step is None or trace_dir is not None,\
+            "A folder to write traces to is needed."
+        self.window = window
+        self.trace_step = trace_step
+        self.trace_dir = trace_dir
+
+        self.timings = {p: collections.deque(maxlen=window) for p in PHASES}
+        self.total_time = {p: 0. for p in PHASES}
+        self.counts = {p: 0 for p in PHASES}
+
+    def phase(self, name):
+        if name not in self.timings:
+            raise ValueError("Unknown phase {}. It should be one of"
+                             " {}.".format(name, PHASES))
+        return _Phase(self, name)
+
+    def record(self, name, duration):
+        self.timings[name].append(duration)
+        self.total_time[name] += duration
+        self.counts[name] += 1
+
+    def percentiles(self, name, q=(50, 90, 99)):
+        """
+        Return percentiles `q` of timings in the window of phase `name`, in
+        seconds, or None if it has not been recorded.
+        """
+        if not self.timings[name]:
+            return None
+        return list(np.percentile(list(self.timings[name]), q))
+
+    def stats(self):
+        """
+        Return a dict from each recorded phase to a dict of its statistics:
+        the number of times it is recorded, percentiles 50, 90, 99 of its
+        window, and the fraction it takes in total recorded time.
+        """
+        total = sum(self.total_time.values())
+        stats = {}
+        for p in PHASES:
+            if not self.counts[p]:
+                continue
+            p50, p90, p99 = self.percentiles(p)
+            stats[p] = {
+                "count": self.counts[p],
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "fraction": self.total_time[p] / total if total else 0.
+            }
+        return stats
+
+    def should_trace(self, step):
+        return self.trace_step is not None and step % self.trace_step == 0
+
+    def trace(self, step, run_metadata, summary_writer=None):
+        """
+        Write the trace in `run_metadata` of `step` to `trace_dir`, and to
+        `summary_writer` if given, so it shows in tensorboard as well.
+        """
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        path = os.path.join(self.trace_dir, "timeline_{}.json".format(step))
+        trace = timeline.Timeline(step_stats=run_metadata.step_stats)
+        with open(path, "w") as f:
+            f.write(trace.generate_chrome_trace_format())
+        if summary_writer:
+            summary_writer.add_run_metadata(run_metadata,
+                                            "step_{}".format(step))
+        log.info("Trace of step {} written to {}.".format(step, path))
+
+    @staticmethod
+    def trace_run_options():
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+
+
+__all__ = [name for name, x in locals().items() if
+           not inspect.ismodule(x) and not inspect.isabstract(x) and
+           not name.startswith("_")]
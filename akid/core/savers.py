@@ -0,0 +1,222 @@
+"""
+This module holds `AsyncSaver`, which saves checkpoints in the background, so
+training is not blocked by writing to disk.
+
+The values of variables are first snapshotted into host memory by the training
+session, which is fast. Then they are loaded into a separate graph holding a
+mirror of the variables, and saved by a `tf.train.Saver` of that graph in a
+background thread. Checkpoints written are the same with those written by a
+`tf.train.Saver` of the original variables, so they could be restored as
+usual.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import threading
+import inspect
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import tensorflow as tf
+
+from ..utils import glog as log
+
+
+class AsyncSaver(object):
+    """
+    Save checkpoints of variables in a background thread, with a bounded
+    number of saves in flight and a retention policy.
+
+    Checkpoints are retained if they are one of the last `keep_last` ones, or
+    one of the `keep_best` ones with the best metric reported by `report`.
+    Other checkpoints are deleted, and the checkpoint state file of the folder
+    only lists retained ones.
+    """
+    def __init__(self,
+                 var_list,
+                 max_in_flight=1,
+                 keep_last=5,
+                 keep_best=0,
+                 higher_is_better=False):
+        """
+        Args:
+            var_list: list of tf.Variable
+                Variables to save.
+            max_in_flight: int
+                The maximal number of checkpoints snapshotted but not written
+                yet. `save` blocks when it is reached.
+            keep_last: int
+                The number of latest checkpoints to keep.
+            keep_best: int
+                The number of checkpoints with the best metric to keep.
+            higher_is_better: Boolean
+                Whether a higher reported metric is better. By default, the
+                metric is assumed to be a loss.
+        """
+        self.var_list = var_list
+        self.max_in_flight = max_in_flight
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.higher_is_better = higher_is_better
+
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # Paths of checkpoints written, in order.
+        self._checkpoints = []
+        self._metrics = {}
+        self._error = None
+        self._thread = None
+
+        self._setup_writer()
+
+    def _setup_writer(self):
+        """
+        Build the graph holding a mirror of variables to save, whose values
+        are loaded by running their initializers.
+        """
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._placeholders = []
+            mirrors = {}
+            initializers = []
+            for v in self.var_list:
+                p = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                mirror = tf.Variable(p, trainable=False, name=v.op.name)
+                self._placeholders.append(p)
+                mirrors[v.op.name] = mirror
+                initializers.append(mirror.initializer)
+            self._load_op = tf.group(*initializers)
+            # Retention is done by this class, so the saver keeps all.
+            self._saver = tf.train.Saver(mirrors, max_to_keep=0)
+        self._sess = tf.Session(graph=self._graph)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write, name="async_saver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, sess, save_path, global_step):
+        """
+        Snapshot the values of variables by `sess`, and queue them to be
+        written.
+
+        Returns:
+            The path prefix of the checkpoint that will be written.
+        """
+        self._raise_if_failed()
+        if not self._thread:
+            self.start()
+
+        self._in_flight.acquire()
+        try:
+            values = sess.run(self.var_list)
+        except:
+            # Nothing is queued, so the slot would never be released by the
+            # writing thread.
+            self._in_flight.release()
+            raise
+        path = "{}-{}".format(save_path, global_step)
+        self._queue.put((path, values))
+
+        return path
+
+    def report(self, path, metric):
+        """
+        Report the validation metric of the checkpoint `path`, which is used
+        to keep the best checkpoints.
+        """
+        with self._lock:
+            self._metrics[path] = metric
+            if path in self._checkpoints:
+                self._retain()
+
+    def flush(self):
+        """
+        Wait till all queued checkpoints are written.
+        """
+        self._queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        """
+        Flush, then stop the writing thread.
+        """
+        if self._thread:
+            self.flush()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._sess.close()
+
+    def _raise_if_failed(self):
+        if self._error:
+            raise self._error
+
+    def _write(self):
+        """
+        Loop of the writing thread.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            path, values = item
+            try:
+                self._sess.run(self._load_op,
+                               feed_dict=dict(zip(self._placeholders, values)))
+                self._saver.save(self._sess, path, write_meta_graph=False)
+                with self._lock:
+                    self._checkpoints.append(path)
+                    self._retain()
+                log.info("Checkpoint {} written.".format(path))
+            except Exception as e:
+                log.error("Failed to write checkpoint {}: {}".format(path, e))
+                self._error = e
+            finally:
+                self._in_flight.release()
+                self._queue.task_done()
+
+    def _retain(self):
+        """
+        Delete checkpoints that are not retained, and update the checkpoint
+        state file. It should be called with the lock held.
+        """
+        if not self._checkpoints:
+            return
+
+        kept = set(self._checkpoints[-self.keep_last:]
+                   if self.keep_last > 0 else [])
+        if self.keep_best > 0:
+            reported = [p for p in self._checkpoints if p in self._metrics]
+            reported.sort(key=lambda p: self._metrics[p],
+                          reverse=self.higher_is_better)
+            kept.update(reported[:self.keep_best])
+        # The latest checkpoint is always kept, so training could resume.
+        kept.add(self._checkpoints[-1])
+
+        for path in self._checkpoints:
+            if path not in kept:
+                self._delete(path)
+        self._checkpoints = [p for p in self._checkpoints if p in kept]
+
+        tf.train.update_checkpoint_state(
+            os.path.dirname(self._checkpoints[-1]),
+            self._checkpoints[-1],
+            all_model_checkpoint_paths=self._checkpoints)
+
+    def _delete(self, path):
+        # Files of a checkpoint are the prefix itself (V1), or with suffixes
+        # (V2 and files saved along with it). Matching with a dot prevents
+        # matching checkpoints of steps that share the prefix.
+        for f in tf.gfile.Glob(path) + tf.gfile.Glob(path + ".*"):
+            tf.gfile.Remove(f)
+        self._metrics.pop(path, None)
+
+
+__all__ = [name for name, x in locals().items() if
+           not inspect.ismodule(x) and not inspect.isabstract(x)]
@@ -22,9 +22,10 @@ for the MNIST dataset. Taking a `Source`, we could make a sensor::
 
 The type of a sensor must match that of a source.
 
-For `IntegratedSensor`, it is supported to add `Joker` to augment data. The way
-to augment data is similar with building blocks using `Brain`, but simpler,
-since data augmentation is added sequentially, shown in the following::
+For `IntegratedSensor` and `DatasetSensor`, it is supported to add `Joker` to
+augment data. The way to augment data is similar with building blocks using
+`Brain`, but simpler, since data augmentation is added sequentially, shown in
+the following::
 
     sensor = IntegratedSensor(source_in=cifar_source,
                             batch_size=128,
@@ -38,10 +39,18 @@ from __future__ import absolute_import, division, print_function
 import sys
 import abc
 import inspect
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
+import numpy as np
 import tensorflow as tf
 
 from .jokers import JokerSystem
+from .feed_jokers import FeedJoker, AugmentationPool
 from .blocks import Block
 from ..utils import glog as log
 from . import sources
@@ -70,14 +79,21 @@ class Sensor(Block):
                 The number of samples a time the sensor would provide.
             val_batch_size: int
                 The number of samples a time the sensor would provide when
-                doing validation. It is supposed to evenly divide the number of
-                validation samples.
+                doing validation. It does not need to divide the number of
+                validation samples. The remainder is kept in
+                `val_remainder`. See `FeedSensor` on how it is handled.
         """
         super(Sensor, self).__init__(self, **kwargs)
         self.batch_size = batch_size
         self.val_batch_size = val_batch_size
         self.source = source_in
 
+        self.val_remainder = 0
+        # Sensors that could supply the remainder of validation data in a
+        # smaller batch set up these.
+        self.val_remainder_data = None
+        self.val_remainder_labels = None
+
     def data(self, get_val=False):
         """
         Args:
@@ -142,6 +158,7 @@ class Sensor(Block):
                 = (self.source.num_train - 1) // self.batch_size + 1
             self.num_batches_per_epoch_val \
                 = (self.source.num_val - 1) // self.val_batch_size + 1
+            self.val_remainder = self.source.num_val % self.val_batch_size
             log.info("A epoch of training set contains {} batches".format(
                 self.num_batches_per_epoch_train))
             log.info("A epoch of validation set contains {} batches".format(
@@ -210,6 +227,194 @@ class ShuffleQueueSensor(Sensor):
             = min_fraction_of_examples_in_queue
 
 
+class QueueAutoTuner(object):
+    """
+    Run threads enqueuing examples to a queue, and tune the number of active
+    threads and the capacity of the queue by the throughput observed during
+    the beginning of training.
+
+    Since the number of threads and the capacity of a queue are fixed once the
+    graph is built, the queue is built with the maximal capacity allowed, and
+    `max_threads` threads are started, while only `num_threads` of them
+    enqueue, and they stop when the queue holds `capacity` examples. The
+    capacity follows the number of threads by the same formula
+    `IntegratedSensor` uses, `min_after_dequeue + 2 * num_threads *
+    batch_size`.
+
+    Statistics of each training step are passed in by `observe`. Every
+    `window` steps, the queue is taken as drained if training has waited on
+    dequeuing for more than `wait_threshold` of the wall time. The number of
+    threads is doubled till the queue does not drain, then decreased one by
+    one till it drains, after which the smallest number that did not drain is
+    kept. Tuning stops after `tune_steps` steps.
+    """
+    def __init__(self,
+                 queue,
+                 enqueue_op,
+                 batch_size,
+                 min_after_dequeue,
+                 max_capacity,
+                 num_threads=4,
+                 max_threads=16,
+                 tune_steps=300,
+                 window=50,
+                 wait_threshold=0.05):
+        """
+        Args:
+            queue: tf.QueueBase
+                The queue to fill. It is closed by `stop`.
+            enqueue_op: tf.Operation
+                The op enqueuing one example.
+            max_capacity: int
+                The capacity the queue is built with.
+            num_threads: int
+                The number of threads to start tuning with.
+            Other args are explained in the class docstring.
+        """
+        self.enqueue_op = enqueue_op
+        # Pending enqueues are cancelled, so threads blocked on a full queue
+        # wake up when stopped.
+        self.close_op = queue.close(cancel_pending_enqueues=True)
+        self.batch_size = batch_size
+        self.min_after_dequeue = min_after_dequeue
+        self.max_capacity = max_capacity
+        self.max_threads = max_threads
+        self.tune_steps = tune_steps
+        self.window = window
+        self.wait_threshold = wait_threshold
+
+        self.is_tuning = True
+        self._growing = True
+        self._best_num_threads = None
+        self._set_num_threads(min(num_threads, max_threads))
+
+        # The number of examples enqueued since the size of the queue is
+        # observed last.
+        self._lock = threading.Lock()
+        self._queue_size = 0
+        self._enqueued = 0
+
+        self._num_steps = 0
+        self._window_wait = 0
+        self._window_start = None
+
+        self._stop = threading.Event()
+        self._sess = None
+        self._threads = []
+
+    def _set_num_threads(self, num_threads):
+        self.num_threads = num_threads
+        self.capacity = min(
+            self.min_after_dequeue + 2 * num_threads * self.batch_size,
+            self.max_capacity)
+
+    def start(self, sess):
+        self._sess = sess
+        for i in xrange(self.max_threads):
+            t = threading.Thread(target=self._run,
+                                 args=(sess, i),
+                                 name="enqueue_{}".format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        """
+        Close the queue and join enqueuing threads.
+        """
+        self._stop.set()
+        if self._sess is not None:
+            try:
+                self._sess.run(self.close_op)
+            except (tf.errors.CancelledError, RuntimeError):
+                # The session is closed, so no enqueue is pending.
+                pass
+            self._sess = None
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _run(self, sess, i):
+        while not self._stop.is_set():
+            with self._lock:
+                idle = i >= self.num_threads \
+                    or self._queue_size + self._enqueued >= self.capacity
+            if idle:
+                time.sleep(0.005)
+                continue
+            try:
+                sess.run(self.enqueue_op)
+            except (tf.errors.CancelledError, tf.errors.OutOfRangeError,
+                    RuntimeError):
+                # The session or the queue is closed.
+                return
+            with self._lock:
+                self._enqueued += 1
+
+    def observe(self, queue_size, wait_time):
+        """
+        Observe the size of the queue fetched along with a training step, and
+        the time the step waited on dequeuing.
+        """
+        with self._lock:
+            self._queue_size = queue_size
+            self._enqueued = 0
+
+        if not self.is_tuning:
+            return
+
+        self._num_steps += 1
+        now = time.time()
+        if self._num_steps <= self.window:
+            # The first window is skipped, since the queue is still being
+            # filled.
+            self._window_start = now
+            return
+        self._window_wait += wait_time
+        if self._num_steps % self.window == 0:
+            drained = self._window_wait \
+                > self.wait_threshold * (now - self._window_start)
+            self._tune(drained)
+            self._window_wait = 0
+            self._window_start = now
+            if self._num_steps >= self.tune_steps and self.is_tuning:
+                self._finish(self._best_num_threads or self.num_threads)
+
+    def _tune(self, drained):
+        if not drained:
+            self._best_num_threads = self.num_threads
+
+        if self._growing:
+            if not drained:
+                self._growing = False
+            elif self.num_threads < self.max_threads:
+                self._set_num_threads(
+                    min(2 * self.num_threads, self.max_threads))
+                log.info("Input queue drained. Grow to {} threads with"
+                         " capacity {}.".format(self.num_threads,
+                                                self.capacity))
+                return
+            else:
+                log.warning("Input queue drains even with {} threads."
+                            " The input pipeline is the bottleneck.".format(
+                                self.num_threads))
+                self._finish(self.num_threads)
+                return
+
+        if drained:
+            self._finish(self._best_num_threads or self.num_threads)
+        elif self.num_threads > 1:
+            self._set_num_threads(self.num_threads - 1)
+        else:
+            self._finish(self.num_threads)
+
+    def _finish(self, num_threads):
+        self._set_num_threads(num_threads)
+        self.is_tuning = False
+        log.info("Tuned input queue: {} threads with capacity {}.".format(
+            self.num_threads, self.capacity))
+
+
 class IntegratedSensor(ShuffleQueueSensor):
     """
     A concrete `Sensor` uses Reader Op of tensorflow to read data directly as a
@@ -219,42 +424,130 @@ class IntegratedSensor(ShuffleQueueSensor):
     Optionally, it could also do data augmentation. It holds two
     `LinkedSystem`s, `training_jokers` and `val_jokers`, which do data
     processing on training datum and validation datum respectively.
+
+    To tell whether training is starved by the input pipeline, the size,
+    capacity and fraction full of the training queue are exposed as
+    `queue_size`, `queue_capacity` and `queue_fraction`. If
+    `measure_dequeue_wait` is True, `dequeue_time` is the wall time right
+    after a training batch is dequeued, from which the time a step has waited
+    on the queue is derived. A `Kid` fetches them along with training steps
+    and records them by `record_queue_stats`, whose accumulation is available
+    through `queue_stats`.
+
+    If `auto_tune` is True, the number of threads enqueuing training examples
+    and the capacity of the training queue are tuned during the beginning of
+    training by a `QueueAutoTuner`, within `queue_memory_budget`.
+
+    If `batch_jokers` is True, jokers are applied to batches dequeued instead
+    of to each example before enqueued, see `JokerSystem`. Augmentation is
+    then done in the training step by ops on whole batches, instead of by
+    preprocessing threads launching ops on examples one by one.
     """
-    def __init__(self, num_preprocess_threads=4,  **kwargs):
+    def __init__(self,
+                 num_preprocess_threads=4,
+                 measure_dequeue_wait=False,
+                 auto_tune=False,
+                 max_preprocess_threads=16,
+                 queue_memory_budget=None,
+                 tune_steps=300,
+                 batch_jokers=False,
+                 **kwargs):
+        """
+        Args:
+            num_preprocess_threads: int
+                The number of threads enqueuing examples. If `auto_tune` is
+                True, it is the number to start tuning with.
+            measure_dequeue_wait: Boolean
+                Whether to measure the time training steps wait on dequeuing
+                training batches. It costs a python call in each step, so it
+                is off by default, and only the fill level of the queue, which
+                is cheap, is fetched.
+            auto_tune: Boolean
+                Whether to tune the number of threads and the capacity of the
+                training queue. It needs `measure_dequeue_wait`.
+            max_preprocess_threads: int
+                The maximal number of threads when tuning.
+            queue_memory_budget: int
+                The maximal number of bytes examples in the training queue
+                could take when tuning. If None, the capacity is only bounded
+                by `max_preprocess_threads`.
+            tune_steps: int
+                The number of training steps to tune in.
+            batch_jokers: Boolean
+                Whether to apply jokers to batches.
+        """
         super(IntegratedSensor, self).__init__(**kwargs)
+        assert measure_dequeue_wait or not auto_tune,\
+            "Auto tuning needs `measure_dequeue_wait`."
         self.num_preprocess_threads = num_preprocess_threads
+        self.measure_dequeue_wait = measure_dequeue_wait
+        self.auto_tune = auto_tune
+        self.max_preprocess_threads = max_preprocess_threads
+        self.queue_memory_budget = queue_memory_budget
+        self.tune_steps = tune_steps
+        self.queue_tuner = None
+        self.batch_jokers = batch_jokers
+
+        self.queue_size = None
+        self.queue_capacity = None
+        self.queue_fraction = None
+        self.dequeue_time = None
+
+        self.num_dequeues = 0
+        self.dequeue_wait_time = 0
+        self.last_queue_size = 0
 
         # Keep two LinkedSystem to hold Jokers that may apply to training and
         # validation data.
-        self.training_jokers = JokerSystem(name="training_joker")
-        self.val_jokers = JokerSystem(name="val_joker")
+        self.training_jokers = JokerSystem(batch_mode=batch_jokers,
+                                           name="training_joker")
+        self.val_jokers = JokerSystem(batch_mode=batch_jokers,
+                                      name="val_joker")
 
     def _setup_training_data(self):
         # TODO(Shuai): Handle the case where the source has no labels.
-        self.training_jokers.setup(self.source.training_datum)
-        augmented_training_datum = self.training_jokers.data
+        if self.batch_jokers:
+            augmented_training_datum = self.source.training_datum
+        else:
+            self.training_jokers.setup(self.source.training_datum)
+            augmented_training_datum = self.training_jokers.data
         min_queue_examples = int(self.source.num_train *
                                  self.min_fraction_of_examples_in_queue)
 
-        batch_list = self._generate_image_and_label_batch(
+        batch_list, queue, capacity = self._generate_image_and_label_batch(
             self.batch_size,
             augmented_training_datum,
             self.source.training_label,
             min_queue_examples,
-            "train_data")
+            "train_data",
+            auto_tune=self.auto_tune)
+        self.queue_capacity = capacity
+        self.queue_size = queue.size()
+        self.queue_fraction = tf.cast(self.queue_size, tf.float32) \
+            / capacity
+        if self.measure_dequeue_wait:
+            with tf.control_dependencies(batch_list):
+                self.dequeue_time = tf.py_func(
+                    time.time, [], tf.float64, name="dequeue_time")
         training_data = batch_list[0]
         training_labels = batch_list[1:]
+        if self.batch_jokers:
+            self.training_jokers.setup(training_data)
+            training_data = self.training_jokers.data
 
         return training_data, training_labels
 
     def _setup_val_data(self):
         # TODO(Shuai): Handle the case where the source has no labels.
-        self.val_jokers.setup(self.source.val_datum)
-        processed_val_datum = self.val_jokers.data
+        if self.batch_jokers:
+            processed_val_datum = self.source.val_datum
+        else:
+            self.val_jokers.setup(self.source.val_datum)
+            processed_val_datum = self.val_jokers.data
         min_queue_examples = int(self.source.num_val *
                                  self.min_fraction_of_examples_in_queue)
 
-        batch_list = self._generate_image_and_label_batch(
+        batch_list, _, _ = self._generate_image_and_label_batch(
             self.val_batch_size,
             processed_val_datum,
             self.source.val_label,
@@ -262,9 +555,72 @@ class IntegratedSensor(ShuffleQueueSensor):
             "val_data")
         val_data = batch_list[0]
         val_labels = batch_list[1:]
+        if self.batch_jokers:
+            self.val_jokers.setup(val_data)
+            val_data = self.val_jokers.data
 
         return val_data, val_labels
 
+    def queue_fetches(self):
+        """
+        Tensors to fetch along with a training step to record statistics of
+        the training queue by `record_queue_stats`.
+        """
+        fetches = [self.queue_size]
+        if self.measure_dequeue_wait:
+            fetches.append(self.dequeue_time)
+        return fetches
+
+    def record_queue_stats(self, values, start_time):
+        """
+        Record values of `queue_fetches` fetched by a step which started
+        running at `start_time`.
+        """
+        self.last_queue_size = values[0]
+        if self.measure_dequeue_wait:
+            # The time includes the overhead of starting the run, which is
+            # small compared with a noticeable wait.
+            wait_time = max(values[1] - start_time, 0)
+            self.dequeue_wait_time += wait_time
+        self.num_dequeues += 1
+        if self.queue_tuner:
+            self.queue_tuner.observe(values[0], wait_time)
+
+    def start_queue_tuner(self, sess):
+        """
+        Start threads enqueuing training examples if `auto_tune` is True. It
+        should be called along with starting queue runners.
+        """
+        if self.queue_tuner:
+            self.queue_tuner.start(sess)
+
+    def teardown(self):
+        """
+        Stop threads of the queue tuner. Queue runners are started globally,
+        so they are stopped along with the session.
+        """
+        if self.queue_tuner:
+            self.queue_tuner.stop()
+
+    @property
+    def queue_stats(self):
+        """
+        A dict holds the size, capacity and fraction full of the training
+        queue recorded last, the number of steps recorded, and how long in
+        seconds in total they have waited on dequeuing. The wait time is None
+        if it is not measured.
+        """
+        capacity = self.queue_tuner.capacity if self.queue_tuner \
+            else self.queue_capacity
+        return {
+            "size": self.last_queue_size,
+            "capacity": capacity,
+            "fraction": self.last_queue_size / capacity if capacity else 0,
+            "dequeues": self.num_dequeues,
+            "wait_time": self.dequeue_wait_time
+            if self.measure_dequeue_wait else None,
+        }
+
     def attach(self, joker, to_val=False):
         """
         Attach a joker to a joker system. If `to_val` is True, attach to
@@ -295,8 +651,13 @@ class IntegratedSensor(ShuffleQueueSensor):
                          tf.expand_dims(datum, 0),
                          collections=[collection])
 
-    def _generate_image_and_label_batch(
-            self, batch_size, image, label, min_queue_examples, name):
+    def _generate_image_and_label_batch(self,
+                                        batch_size,
+                                        image,
+                                        label,
+                                        min_queue_examples,
+                                        name,
+                                        auto_tune=False):
         """Construct a queued batch of images and labels.
 
         Args:
@@ -305,41 +666,468 @@ class IntegratedSensor(ShuffleQueueSensor):
             label: 1-D Tensor of type.int32 or a list of them.
             min_queue_examples: int32, minimum number of samples to retain
             in the queue that provides of batches of examples.
+            auto_tune: Boolean
+                If True, the queue is built with the maximal capacity allowed,
+                and filled by `queue_tuner` instead of a queue runner.
 
         Returns:
             batch_list: a list
                 A list of batched tensors of passed in `image` and `label`. The
                 order how they are passed in is preserved in the list.
+            queue: tf.RandomShuffleQueue
+                The queue batches are dequeued from.
+            capacity: int
+                The capacity of the queue.
         """
         input_list = [image]
         input_list.extend(label) if type(label) is list \
             else input_list.append(label)
-        batch_list = tf.train.shuffle_batch(
-            input_list,
-            batch_size=batch_size,
-            num_threads=self.num_preprocess_threads,
-            capacity=min_queue_examples + 2 * self.num_preprocess_threads * batch_size,
-            min_after_dequeue=min_queue_examples,
-            name=name)
+        num_threads = self.max_preprocess_threads if auto_tune \
+            else self.num_preprocess_threads
+        capacity = min_queue_examples + 2 * num_threads * batch_size
+        if auto_tune and self.queue_memory_budget:
+            example_bytes = sum(
+                t.get_shape().num_elements() * t.dtype.size
+                for t in input_list)
+            capacity = min(capacity,
+                           self.queue_memory_budget // example_bytes)
+            assert capacity >= min_queue_examples + batch_size,\
+                "The memory budget cannot hold `min_queue_examples` and a" \
+                " batch."
+        # The same with `tf.train.shuffle_batch`, except that the queue is
+        # kept, so its size could be monitored.
+        with tf.name_scope(name):
+            queue = tf.RandomShuffleQueue(
+                capacity=capacity,
+                min_after_dequeue=min_queue_examples,
+                dtypes=[t.dtype for t in input_list],
+                shapes=[t.get_shape() for t in input_list],
+                name="random_shuffle_queue")
+            enqueue_op = queue.enqueue(input_list)
+            if auto_tune:
+                self.queue_tuner = QueueAutoTuner(
+                    queue,
+                    enqueue_op,
+                    batch_size,
+                    min_queue_examples,
+                    capacity,
+                    num_threads=self.num_preprocess_threads,
+                    max_threads=self.max_preprocess_threads,
+                    tune_steps=self.tune_steps)
+            else:
+                tf.train.add_queue_runner(tf.train.QueueRunner(
+                    queue, [enqueue_op] * self.num_preprocess_threads))
+            batch_list = queue.dequeue_many(batch_size)
+
+        for i, b in enumerate(batch_list):
+            batch_list[i] = tf.squeeze(b)
+
+        return batch_list, queue, capacity
+
+
+class DatasetSensor(Sensor):
+    """
+    A `Sensor` reading tensors from a `TFSource` through an input pipeline
+    made of stages, in the way of a dataset pipeline::
+
+        read -> map + batch -> prefetch
+
+    * read: examples are read from files of the source by
+      `num_parallel_reads` readers, which interleave examples of different
+      files. It sets `num_readers` of a `ClassificationTFSource`.
+    * map + batch: `num_parallel_calls` threads apply jokers to examples in
+      parallel, and put them into a queue where batches are dequeued from, so
+      mapping and batching are fused in one stage without a queue in
+      between. For training data, the queue keeps at least `shuffle_buffer`
+      examples to shuffle from.
+    * prefetch: `prefetch_batches` batches are assembled ahead of time, so a
+      training step only dequeues a ready batch.
+
+    Unlike `IntegratedSensor`, whose queue runners are started globally and
+    never stopped, the sensor owns threads running its pipeline and those of
+    its source. They are started by `start`, and shut down by `stop`, which
+    closes all queues and joins the threads.
+
+    Data augmentation is done by `Joker`s attached, the same with
+    `IntegratedSensor`. If `batch_jokers` is True, jokers are applied to
+    batches in the prefetch stage instead of to examples in the map stage, see
+    `JokerSystem`.
+    """
+    def __init__(self,
+                 num_parallel_reads=1,
+                 num_parallel_calls=4,
+                 shuffle_buffer=10000,
+                 prefetch_batches=2,
+                 batch_jokers=False,
+                 **kwargs):
+        """
+        Args:
+            num_parallel_reads: int
+                The number of readers reading files of the source in
+                parallel.
+            num_parallel_calls: int
+                The number of threads applying jokers to examples.
+            shuffle_buffer: int
+                The minimal number of training examples to shuffle from. It is
+                capped by the number of training examples. If 0, training
+                examples are not shuffled by the sensor.
+            prefetch_batches: int
+                The number of batches to assemble ahead of time.
+            batch_jokers: Boolean
+                Whether to apply jokers to batches.
+        """
+        super(DatasetSensor, self).__init__(**kwargs)
+        self.num_parallel_reads = num_parallel_reads
+        self.num_parallel_calls = num_parallel_calls
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch_batches = prefetch_batches
+        self.batch_jokers = batch_jokers
+
+        self.training_jokers = JokerSystem(batch_mode=batch_jokers,
+                                           name="training_joker")
+        self.val_jokers = JokerSystem(batch_mode=batch_jokers,
+                                      name="val_joker")
+
+        self._queue_runners = []
+        self._coord = None
+        self._threads = []
+
+    def attach(self, joker, to_val=False):
+        """
+        Attach a joker to a joker system. If `to_val` is True, attach to
+        validation joker system, otherwise to training joker system.
+        """
+        if to_val:
+            self.val_jokers.attach(joker)
+        else:
+            self.training_jokers.attach(joker)
+
+    def _setup(self):
+        if issubclass(type(self.source), sources.ClassificationTFSource):
+            self.source.num_readers = self.num_parallel_reads
+        super(DatasetSensor, self)._setup()
+
+    def _setup_training_data(self):
+        shuffle_buffer = min(self.shuffle_buffer, self.source.num_train)
+        batch_list = self._build_pipeline(self.source.training_datum,
+                                          self.source.training_label,
+                                          self.training_jokers,
+                                          self.batch_size,
+                                          shuffle_buffer,
+                                          "train_data")
+        return batch_list[0], batch_list[1:]
+
+    def _setup_val_data(self):
+        batch_list = self._build_pipeline(self.source.val_datum,
+                                          self.source.val_label,
+                                          self.val_jokers,
+                                          self.val_batch_size,
+                                          0,
+                                          "val_data")
+        return batch_list[0], batch_list[1:]
+
+    def _build_pipeline(self,
+                        datum,
+                        label,
+                        jokers,
+                        batch_size,
+                        shuffle_buffer,
+                        name):
+        """
+        Build the map + batch and prefetch stages on an example, applying
+        `jokers` in the map stage, or in the prefetch stage if
+        `batch_jokers` is True.
+
+        Returns:
+            A list of batched tensors of `datum` and `label`, in order.
+        """
+        if not self.batch_jokers:
+            jokers.setup(datum)
+            datum = jokers.data
+        input_list = [datum]
+        input_list.extend(label) if type(label) is list \
+            else input_list.append(label)
+        dtypes = [t.dtype for t in input_list]
+        shapes = [t.get_shape() for t in input_list]
+
+        with tf.name_scope(name):
+            capacity = shuffle_buffer \
+                + (self.num_parallel_calls + 1) * batch_size
+            if shuffle_buffer:
+                batch_queue = tf.RandomShuffleQueue(
+                    capacity=capacity,
+                    min_after_dequeue=shuffle_buffer,
+                    dtypes=dtypes,
+                    shapes=shapes,
+                    name="batch_queue")
+            else:
+                batch_queue = tf.FIFOQueue(capacity=capacity,
+                                           dtypes=dtypes,
+                                           shapes=shapes,
+                                           name="batch_queue")
+            self._queue_runners.append(tf.train.QueueRunner(
+                batch_queue,
+                [batch_queue.enqueue(input_list)] * self.num_parallel_calls))
+
+            batch = batch_queue.dequeue_many(batch_size)
+            num_prefetch_threads = 1
+            if self.batch_jokers:
+                jokers.setup(batch[0])
+                batch[0] = jokers.data
+                # Augmentation is done in this stage, so it runs in
+                # parallel.
+                num_prefetch_threads = self.num_parallel_calls
+            # Jokers may change the dtype of data in batch mode.
+            prefetch_queue = tf.FIFOQueue(
+                capacity=self.prefetch_batches,
+                dtypes=[t.dtype for t in batch],
+                shapes=[t.get_shape() for t in batch],
+                name="prefetch_queue")
+            self._queue_runners.append(tf.train.QueueRunner(
+                prefetch_queue,
+                [prefetch_queue.enqueue(batch)] * num_prefetch_threads))
+            batch_list = prefetch_queue.dequeue()
 
         for i, b in enumerate(batch_list):
             batch_list[i] = tf.squeeze(b)
 
         return batch_list
 
+    def _post_setup_shared(self):
+        super(DatasetSensor, self)._post_setup_shared()
+        if self.do_summary:
+            # Do image summary on raw images if we have done data augmentation.
+            if not self.training_jokers.is_empty:
+                tf.summary.image(self.training_data.op.name + "_raw",
+                                 tf.expand_dims(self.source.training_datum, 0),
+                                 collections=[TRAIN_SUMMARY_COLLECTION])
+            if not self.val_jokers.is_empty:
+                tf.summary.image(self.val_data.op.name + "_raw",
+                                 tf.expand_dims(self.source.val_datum, 0),
+                                 collections=[VALID_SUMMARY_COLLECTION])
+
+    def start(self, sess):
+        """
+        Start threads of the pipeline and the source in `sess`.
+        """
+        self._coord = tf.train.Coordinator()
+        # Queue runners of the source are in the global collection.
+        self._threads = tf.train.start_queue_runners(sess=sess,
+                                                     coord=self._coord)
+        for qr in self._queue_runners:
+            self._threads.extend(qr.create_threads(sess,
+                                                   coord=self._coord,
+                                                   daemon=True,
+                                                   start=True))
+
+    def stop(self):
+        """
+        Close all queues of the pipeline and the source, and join their
+        threads.
+        """
+        if self._coord is None:
+            return
+        self._coord.request_stop()
+        self._coord.join(self._threads)
+        self._coord = None
+        self._threads = []
+
+    def teardown(self):
+        self.stop()
+
 
 class FeedSensor(Sensor):
     """
     Sense from a `FeedSource` to supply data to a `Kid`.
+
+    Optionally, it could also do data augmentation by attaching `FeedJoker`s,
+    which are applied to batches by a pool of worker processes. See
+    `feed_jokers`.
+
+    Optionally, feed dicts could be prepared ahead of time by background
+    threads, which keep a bounded queue of ready feed dicts, so getting data
+    from the source is off the critical path of training. Call
+    `start_prefetch` to start prefetching, after which `fill_feed_dict` on
+    training data takes feed dicts from the queue. Statistics of the queue are
+    available through `prefetch_stats` to tell whether the computing device is
+    starved.
+
+    An epoch of validation data could be iterated over exactly once by
+    `val_feed_dicts`. If the validation batch size does not divide the number
+    of validation samples, the remainder is fed to a second set of
+    placeholders, `val_remainder_data` and `val_remainder_labels`, of the size
+    of the remainder, so no sample is dropped or counted twice.
+
+    Since batches may be got from the source ahead of time, the state of the
+    source is snapshotted along with each training batch. `get_source_state`
+    returns the state right after the last training batch actually used, which
+    is what should be saved to resume training exactly.
     """
+    def __init__(self,
+                 prefetch_size=0,
+                 num_prefetch_threads=1,
+                 num_augment_processes=2,
+                 **kwargs):
+        """
+        Args:
+            prefetch_size: int
+                The maximal number of prepared feed dicts to keep in the
+                queue. If 0, no prefetching is done.
+            num_prefetch_threads: int
+                The number of threads to fill the queue.
+            num_augment_processes: int
+                The number of processes to apply `FeedJoker`s, if any is
+                attached.
+        """
+        super(FeedSensor, self).__init__(**kwargs)
+        self.prefetch_size = prefetch_size
+        self.num_prefetch_threads = num_prefetch_threads
+        self.num_augment_processes = num_augment_processes
+
+        self.training_jokers = []
+        self.val_jokers = []
+        # If True, only validation data are supplied, so no augmentation
+        # process is started for training data. Set by `Kid` only
+        # evaluating.
+        self.val_only = False
+        self._training_pool = None
+        self._val_pool = None
+
+        # Sources are not thread safe, so all accesses to the source are
+        # serialized.
+        self._source_lock = threading.Lock()
+        self._prefetch_threads = []
+        self._prefetch_queue = None
+        self._prefetch_stop = None
+        self._prefetch_with_val = False
+        # State of the source after the last training batch used.
+        self._source_state = None
+
+        self.num_prefetch_gets = 0
+        self.num_prefetch_stalls = 0
+        self.prefetch_stall_time = 0
+
+    @property
+    def is_prefetching(self):
+        return len(self._prefetch_threads) != 0
+
+    @property
+    def prefetch_stats(self):
+        """
+        A dict holds the current depth and the capacity of the prefetch queue,
+        the number of feed dicts taken from it, and how many times and how long
+        in seconds in total training has waited for an empty queue.
+        """
+        return {
+            "depth": self._prefetch_queue.qsize()
+            if self._prefetch_queue else 0,
+            "capacity": self.prefetch_size,
+            "gets": self.num_prefetch_gets,
+            "stalls": self.num_prefetch_stalls,
+            "stall_time": self.prefetch_stall_time,
+        }
+
+    def attach(self, joker, to_val=False):
+        """
+        Attach a `FeedJoker`. If `to_val` is True, attach to jokers of
+        validation data, otherwise to jokers of training data.
+        """
+        assert issubclass(type(joker), FeedJoker),\
+            "A `FeedSensor` should only contain `FeedJoker`s."
+        if to_val:
+            self.val_jokers.append(joker)
+        else:
+            self.training_jokers.append(joker)
+
+    def _setup(self):
+        super(FeedSensor, self)._setup()
+        if self.val_remainder:
+            placeholders = self._make_placeholder("val_remainder_data",
+                                                  self.val_remainder,
+                                                  self.val_jokers)
+            if issubclass(type(self.source), sources.SupervisedSource):
+                self.val_remainder_data, self.val_remainder_labels \
+                    = placeholders
+            else:
+                self.val_remainder_data = placeholders
+        # The state before any batch is got, since augmentation processes and
+        # prefetching threads get batches ahead of time.
+        self._source_state = self.source.get_state()
+        # Worker processes are started at setup, which is before any session
+        # is created, since forking a process running a session is not safe.
+        if not self.val_only:
+            self._training_pool = self._start_augmentation(
+                self.training_jokers, get_val=False)
+        self._val_pool = self._start_augmentation(self.val_jokers,
+                                                  get_val=True)
+
+    def _start_augmentation(self, jokers, get_val):
+        if not jokers:
+            return None
+
+        batch_size = self.val_batch_size if get_val else self.batch_size
+        pool = AugmentationPool(
+            jokers,
+            lambda: self.source.get_batch(batch_size, get_val),
+            batch_size,
+            self.source.shape,
+            num_processes=self.num_augment_processes,
+            get_state=self.source.get_state)
+        pool.start()
+
+        return pool
+
+    def teardown(self):
+        """
+        Stop prefetching threads and augmentation processes.
+        """
+        self.stop_prefetch()
+        for pool in [self._training_pool, self._val_pool]:
+            if pool:
+                pool.close()
+        self._training_pool = None
+        self._val_pool = None
+
+    def get_source_state(self):
+        """
+        Return the state of the source right after the last training batch
+        returned by `fill_feed_dict`. See `FeedSource.get_state`.
+        """
+        if self._source_state is not None:
+            return self._source_state
+        with self._source_lock:
+            return self.source.get_state()
+
+    def set_source_state(self, state):
+        """
+        Restore the state of the source, dropping batches got ahead of time.
+        """
+        with_val = self._prefetch_with_val
+        was_prefetching = self.is_prefetching
+        self.stop_prefetch()
+        with self._source_lock:
+            self.source.set_state(state)
+            for pool in [self._training_pool, self._val_pool]:
+                if pool:
+                    pool.reset()
+        self._source_state = state
+        if was_prefetching:
+            self.start_prefetch(with_val)
+
     def _setup_training_data(self):
-        return self._make_placeholder("train_data", self.batch_size)
+        return self._make_placeholder("train_data",
+                                      self.batch_size,
+                                      self.training_jokers)
 
     def _setup_val_data(self):
-        return self._make_placeholder("val_data", self.val_batch_size)
+        return self._make_placeholder("val_data",
+                                      self.val_batch_size,
+                                      self.val_jokers)
 
-    def _make_placeholder(self, name, batch_size):
+    def _make_placeholder(self, name, batch_size, jokers):
         data_shape = self.source.shape
+        for j in jokers:
+            data_shape = j.out_shape(data_shape)
         data_shape.insert(0, batch_size)
         data = tf.placeholder(tf.float32, shape=data_shape, name=name)
 
@@ -356,6 +1144,146 @@ class FeedSensor(Sensor):
 
         return data
 
+    def start_prefetch(self, with_val=False):
+        """
+        Start threads to fill the prefetch queue. It does nothing if
+        `prefetch_size` is 0 or prefetching has started.
+
+        Args:
+            with_val: Boolean
+                If True, each prefetched feed dict also holds a batch of
+                validation data, which is needed when doing summary on
+                validation brain.
+        """
+        if self.prefetch_size == 0 or self.is_prefetching:
+            return
+
+        self._prefetch_with_val = with_val
+        self._prefetch_queue = queue.Queue(maxsize=self.prefetch_size)
+        self._prefetch_stop = threading.Event()
+        for i in xrange(0, self.num_prefetch_threads):
+            t = threading.Thread(target=self._prefetch,
+                                 args=(with_val,),
+                                 name="{}_prefetch_{}".format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._prefetch_threads.append(t)
+        log.info("Started {} threads to prefetch data.".format(
+            self.num_prefetch_threads))
+
+    def stop_prefetch(self):
+        """
+        Stop prefetching threads, and drop prefetched feed dicts.
+        """
+        if not self.is_prefetching:
+            return
+
+        self._prefetch_stop.set()
+        for t in self._prefetch_threads:
+            t.join()
+        self._prefetch_threads = []
+        self._prefetch_queue = None
+
+    def _prefetch(self, with_val):
+        """
+        Loop of prefetching threads.
+        """
+        while not self._prefetch_stop.is_set():
+            try:
+                feed_dict, state = self._make_feed_dict(get_val=False,
+                                                        copy=True)
+                if with_val:
+                    feed_dict.update(self._make_feed_dict(get_val=True,
+                                                          copy=True)[0])
+                item = (feed_dict, state)
+            except Exception as e:
+                # Pass the error to the training thread, which would
+                # otherwise wait forever.
+                item = e
+
+            while not self._prefetch_stop.is_set():
+                try:
+                    self._prefetch_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+            if isinstance(item, Exception):
+                return
+
+    def _make_feed_dict(self, get_val, copy=False):
+        """
+        Get a batch from the source and put it in a feed dict.
+
+        Args:
+            copy: Boolean
+                Whether to copy the batch. Sources and augmentation pools may
+                return views of data that are reused, such as the batch buffer
+                of `DataSet`, so batches kept for later use should be
+                copied.
+
+        Returns:
+            (feed_dict, state): the feed dict, and the state of the source
+                right after the batch is got.
+        """
+        batch_size = self.val_batch_size if get_val else self.batch_size
+        pool = self._val_pool if get_val else self._training_pool
+        with self._source_lock:
+            if pool:
+                images_feed, labels_feed = pool.next_batch()
+                state = pool.last_state
+            else:
+                images_feed, labels_feed = self.source.get_batch(batch_size,
+                                                                 get_val)
+                state = self.source.get_state()
+            if copy:
+                images_feed = np.array(images_feed)
+                labels_feed = np.array(labels_feed)
+
+        feed_dict = {
+            self.data(get_val): images_feed,
+            self.labels(get_val): labels_feed,
+        }
+
+        return feed_dict, state
+
+    def val_feed_dicts(self):
+        """
+        Yield feed dicts of an epoch of validation data, see
+        `FeedSource.iter_val_batches`.
+
+        Validation jokers are applied in the calling process, since batches of
+        validation data are taken in order instead of from the augmentation
+        pool.
+
+        Yields:
+            (feed_dict, num): the feed dict and the number of samples in it. A
+                batch smaller than `val_batch_size` is fed to the remainder
+                placeholders.
+        """
+        rng = np.random.RandomState(0)
+        batches = self.source.iter_val_batches(self.val_batch_size)
+        while True:
+            # Hold the lock only when getting a batch, so prefetching of
+            # training data is not blocked during validation.
+            with self._source_lock:
+                try:
+                    images_feed, labels_feed = next(batches)
+                except StopIteration:
+                    return
+            num = images_feed.shape[0]
+            if self.val_jokers:
+                images_feed = np.array(images_feed, dtype=np.float32)
+                for j in self.val_jokers:
+                    images_feed = j.augment(images_feed, rng)
+
+            if num == self.val_batch_size:
+                data, labels = self.val_data, self.val_labels
+            else:
+                data = self.val_remainder_data
+                labels = self.val_remainder_labels
+            yield {data: images_feed, labels: labels_feed}, num
+
     def fill_feed_dict(self, get_val=False):
         """Supply a batch of training examples in form of feed dict.
 
@@ -365,6 +1293,10 @@ class FeedSensor(Sensor):
             ....
         }
 
+        If prefetching has started, feed dicts of training data are taken from
+        the prefetch queue. Note that they also hold validation data if
+        prefetching is started with `with_val` True.
+
         Args:
             get_val: A Boolean. If True, return validation data, otherwise,
                 return training data.
@@ -372,15 +1304,27 @@ class FeedSensor(Sensor):
         Returns:
             feed_dict: The feed dictionary mapping from placeholders to values.
         """
-        # Create the feed_dict for the placeholders filled with the next
-        # `batch size ` examples.
-        batch_size = self.val_batch_size if get_val else self.batch_size
-        images_feed, labels_feed = self.source.get_batch(batch_size,
-                                                         get_val)
-        feed_dict = {
-            self.data(get_val): images_feed,
-            self.labels(get_val): labels_feed,
-        }
+        if get_val or not self.is_prefetching:
+            # Create the feed_dict for the placeholders filled with the next
+            # `batch size ` examples.
+            feed_dict, state = self._make_feed_dict(get_val)
+            if not get_val:
+                self._source_state = state
+            return feed_dict
+
+        self.num_prefetch_gets += 1
+        try:
+            item = self._prefetch_queue.get_nowait()
+        except queue.Empty:
+            self.num_prefetch_stalls += 1
+            start_time = time.time()
+            item = self._prefetch_queue.get()
+            self.prefetch_stall_time += time.time() - start_time
+
+        if isinstance(item, Exception):
+            raise item
+
+        feed_dict, self._source_state = item
         return feed_dict
 
 
@@ -38,13 +38,18 @@ import abc
 import sys
 import inspect
 import os
+import json
 import urllib
 import tarfile
+import hashlib
+import numbers
+import multiprocessing
 
 import numpy as np
 import tensorflow as tf
 
 from .blocks import Block
+from ..utils import glog as log
 
 
 # Basic model parameters as external flags.
@@ -266,6 +271,38 @@ class FeedSource(Source):
                                   " this method to actually supply data.")
         sys.exit()
 
+    def iter_val_batches(self, batch_size):
+        """
+        Iterate over an epoch of validation data, which is `num_val` samples,
+        exactly once in batches of `batch_size`. The last batch holds the
+        remainder, so it may be smaller.
+
+        By default, batches are got by `get_batch`, so which samples are in an
+        epoch depends on the sub-class. Sub-classes that could iterate over
+        validation data in order should override this method.
+        """
+        remaining = self.num_val
+        while remaining > 0:
+            images, labels = self.get_batch(batch_size, True)
+            num = min(remaining, batch_size)
+            yield images[:num], labels[:num]
+            remaining -= num
+
+    def get_state(self):
+        """
+        Return a JSON serializable state of where this source is in supplying
+        data, so it could be saved along with checkpoints. None means the
+        source does not support it.
+        """
+        return None
+
+    def set_state(self, state):
+        """
+        Restore the state returned by `get_state`.
+        """
+        raise NotImplementedError("{} does not support restoring"
+                                  " states.".format(type(self).__name__))
+
 
 class InMemoryFeedSource(StaticSource, FeedSource):
     """
@@ -273,12 +310,56 @@ class InMemoryFeedSource(StaticSource, FeedSource):
 
     This class holds a private member `_data_sets` to hold all data.
     """
+    DATASET_NAMES = ["training", "test", "validation"]
+
+    def __init__(self, shuffle_by_index=False, seed=None, **kwargs):
+        """
+        Args:
+            shuffle_by_index: Boolean
+                Passed to datasets loaded. If True, data are shuffled by a
+                permutation of indices instead of reordering the data in
+                memory. See `datasets.DataSet`.
+            seed: int
+                Seed of shuffling datasets. The training, test, validation
+                datasets are given `seed`, `seed + 1`, `seed + 2`
+                respectively. If None, datasets draw their own seeds. Either
+                way, the order of data could be restored by `set_state`.
+        """
+        super(InMemoryFeedSource, self).__init__(**kwargs)
+        self.shuffle_by_index = shuffle_by_index
+        self.seed = seed
+
     def _setup(self):
         """
         Call `_load` to load datasets into memory.
         """
         # Read the whole dateset into memory.
         self.data_sets = self._load()
+        for i, name in enumerate(InMemoryFeedSource.DATASET_NAMES):
+            d = getattr(self.data_sets, name)
+            if d is None:
+                continue
+            if self.shuffle_by_index:
+                d.shuffle_by_index = True
+            if self.seed is not None:
+                d.seed = self.seed + i
+
+    def get_state(self):
+        """
+        Return cursors of datasets, keyed by dataset names. See
+        `datasets.DataSet.get_state`.
+        """
+        state = {}
+        for name in InMemoryFeedSource.DATASET_NAMES:
+            d = getattr(self.data_sets, name)
+            if d is not None:
+                state[name] = d.get_state()
+
+        return state
+
+    def set_state(self, state):
+        for name, s in state.items():
+            getattr(self.data_sets, name).set_state(s)
 
     def get_batch(self, num, get_val):
         if get_val:
@@ -286,6 +367,23 @@ class InMemoryFeedSource(StaticSource, FeedSource):
         else:
             return self.data_sets.training.next_batch(num)
 
+    def iter_val_batches(self, batch_size):
+        """
+        Iterate over the first `num_val` samples of the test dataset in
+        order. See `FeedSource.iter_val_batches`.
+        """
+        dataset = self.data_sets.test
+        if dataset.num_examples < self.num_val:
+            # Not enough samples to iterate over in order, fall back to get
+            # batches from the shuffled stream.
+            batches = super(InMemoryFeedSource, self).iter_val_batches(
+                batch_size)
+        else:
+            batches = dataset.iter_batches(batch_size, self.num_val)
+
+        for b in batches:
+            yield b
+
     def get_all(self, train):
         """
         Get all samples in the source.
@@ -315,6 +413,170 @@ class InMemoryFeedSource(StaticSource, FeedSource):
         sys.exit()
 
 
+class MemmapFeedSource(InMemoryFeedSource):
+    """
+    An abstract class that keeps data on disk in `.npy` files and maps them
+    into memory, instead of reading the whole dataset into memory.
+
+    It is supposed to be combined with a concrete `InMemoryFeedSource` by
+    multiple inheritance, and put before it, such as::
+
+        class Cifar10MemmapFeedSource(MemmapFeedSource, Cifar10FeedSource):
+            pass
+
+    The first time it is set up, `_load` of the concrete source is called, and
+    the loaded (channel-last) arrays are saved under `memmap_dir`. Afterwards,
+    arrays are opened with `np.load(mmap_mode='r')`, so setup takes almost no
+    time, and multiple processes on the same machine share page cache instead
+    of holding private copies of the data.
+
+    Since mapped data are read only, data are always shuffled by index. See
+    `datasets.DataSet`.
+
+    Options the arrays are loaded with, which are attributes of the source of
+    simple types, such as `num_train`, `center` or `use_zca`, are recorded in
+    a manifest along with the arrays. Arrays saved with other options are
+    never used.
+    """
+    # Attributes of a source that do not change the loaded data.
+    NON_LOAD_OPTIONS = ["name", "do_summary", "summary_policy", "bag",
+                        "var_scope", "is_setup", "url", "work_dir",
+                        "shuffle_by_index", "seed", "memmap_dir"]
+    MANIFEST_NAME = "manifest.json"
+
+    def __init__(self, memmap_dir=None, **kwargs):
+        """
+        Args:
+            memmap_dir: str
+                Folder to hold `.npy` files. If None, a folder named by the
+                class name and a hash of options that change the loaded data
+                will be created under `work_dir`.
+        """
+        kwargs["shuffle_by_index"] = True
+        super(MemmapFeedSource, self).__init__(**kwargs)
+        if memmap_dir is None:
+            options = json.dumps(self._load_options(), sort_keys=True)
+            memmap_dir = os.path.join(
+                self.work_dir,
+                "{}_{}".format(type(self).__name__,
+                               hashlib.sha1(options).hexdigest()[:10]))
+        self.memmap_dir = memmap_dir
+
+    def _load_options(self):
+        """
+        Return attributes that may change the loaded data, keyed by names.
+        """
+        return {k: v for k, v in vars(self).items()
+                if not k.startswith("_") and
+                k not in MemmapFeedSource.NON_LOAD_OPTIONS and
+                (v is None or isinstance(v, (numbers.Number, str)))}
+
+    def _check_manifest(self):
+        """
+        Raise if arrays under `memmap_dir` are saved with other options.
+        """
+        path = os.path.join(self.memmap_dir, MemmapFeedSource.MANIFEST_NAME)
+        if not os.path.exists(path):
+            return
+        with open(path, "r") as f:
+            saved = json.load(f)
+        # Round trip by json, so values compare the same way.
+        options = json.loads(json.dumps(self._load_options()))
+        if saved != options:
+            raise ValueError(
+                "Arrays under {} are saved with options {}, which differ from"
+                " options {} of source {}. Use another `memmap_dir`.".format(
+                    self.memmap_dir, saved, options, self.name))
+
+    def _load(self):
+        from ..datasets.datasets import DataSet, DataSets
+
+        names = ["training", "test", "validation"]
+        if not os.path.exists(self._memmap_path("training", "labels")):
+            data_sets = super(MemmapFeedSource, self)._load()
+            self._save_to_npy(data_sets)
+        self._check_manifest()
+
+        sets = []
+        for name in names:
+            path = self._memmap_path(name, "images")
+            if os.path.exists(path):
+                images = np.load(path, mmap_mode='r')
+                labels = np.load(self._memmap_path(name, "labels"),
+                                 mmap_mode='r')
+                sets.append(DataSet(images, labels, shuffle_by_index=True))
+            else:
+                sets.append(None)
+
+        return DataSets(*sets)
+
+    def _memmap_path(self, name, kind):
+        return os.path.join(self.memmap_dir, "{}_{}.npy".format(name, kind))
+
+    def _save_to_npy(self, data_sets):
+        """
+        Save images and labels of each dataset in `data_sets` as `.npy` files.
+
+        Files are first written to temporary files, then renamed, so processes
+        that set up the same source concurrently never see partial files. The
+        training labels are written last, and their existence marks the
+        conversion has been done.
+        """
+        if not os.path.exists(self.memmap_dir):
+            try:
+                os.makedirs(self.memmap_dir)
+            except OSError:
+                # Another process may have created it.
+                pass
+
+        log.info("Saving {} to {}".format(self.name, self.memmap_dir))
+        manifest_path = os.path.join(self.memmap_dir,
+                                     MemmapFeedSource.MANIFEST_NAME)
+        manifest = json.dumps(self._load_options(), sort_keys=True)
+
+        # The manifest is written before the training labels, which mark the
+        # conversion has been done.
+        tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(manifest)
+        os.rename(tmp_path, manifest_path)
+
+        for name in ["test", "validation", "training"]:
+            dataset = getattr(data_sets, name)
+            if dataset is not None:
+                self._save_dataset_to_npy(name, dataset)
+
+    def _save_dataset_to_npy(self, name, dataset, chunk_size=10000):
+        """
+        Save images and labels of `dataset` the way its batches are, chunk by
+        chunk, so normalization a dataset leaves to batches is saved as well,
+        without loading the whole dataset into memory. Labels are renamed
+        after images.
+        """
+        paths = [self._memmap_path(name, "images"),
+                 self._memmap_path(name, "labels")]
+        tmp_paths = ["{}.{}.tmp".format(p, os.getpid()) for p in paths]
+        outs = None
+        start = 0
+        for batch in dataset.iter_batches(chunk_size):
+            if outs is None:
+                outs = [np.lib.format.open_memmap(
+                    p,
+                    mode="w+",
+                    dtype=b.dtype,
+                    shape=(dataset.num_examples,) + b.shape[1:])
+                    for p, b in zip(tmp_paths, batch)]
+            for out, b in zip(outs, batch):
+                out[start:start + b.shape[0]] = b
+            start += batch[0].shape[0]
+
+        for out in outs:
+            out.flush()
+        del outs
+        for tmp_path, path in zip(tmp_paths, paths):
+            os.rename(tmp_path, path)
+
+
 class TFSource(StaticSource):
     """
     An abstract class that uses Reader Op of tensorflow to supply data.
@@ -392,13 +654,83 @@ class TFSource(StaticSource):
         return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
 
 
+# Arguments of the shard writing in progress. They are put here instead of
+# being passed to worker processes, so forked workers could access the data
+# without pickling it.
+_shard_writing_args = None
+
+
+def _write_shard(shard):
+    """
+    Write examples of `shard`, which is a tuple (filename, start, end), to a
+    tfrecord file. It runs in worker processes of
+    `ClassificationTFSource._write_tfrecords`.
+
+    Returns:
+        The number of examples written.
+    """
+    source, arrays = _shard_writing_args
+    filename, start, end = shard
+    writer = tf.python_io.TFRecordWriter(filename)
+    for index in xrange(start, end):
+        example = source._make_example(arrays, index)
+        writer.write(example.SerializeToString())
+    writer.close()
+
+    return end - start
+
+
 class ClassificationTFSource(TFSource, SupervisedSource):
     """
     An abstract class supplies data using tfrecords for classification problem.
 
     It further makes concrete most of the abstract methods of its super
     classes.
+
+    Data could be converted to several tfrecord files (shards) by a pool of
+    processes, and read by several parallel readers. A manifest file named
+    `name.manifest.json` lists shards and the number of examples in each of
+    them.
+
+    Images are stored as a list of floats by default. Optionally, they could be
+    stored packed in a single bytes feature of a given dtype, which is
+    smaller on disk and much faster to parse. Sub-classes should use
+    `_image_raw_feature` and `_decode_image_raw` to parse images to support
+    both.
     """
+    RECORD_DTYPES = {
+        "uint8": (np.uint8, tf.uint8),
+        "float16": (np.float16, tf.float16),
+        "float32": (np.float32, tf.float32),
+    }
+
+    def __init__(self, num_shards=1, num_readers=1, record_dtype=None,
+                 **kwargs):
+        """
+        Args:
+            num_shards: int
+                The number of tfrecord files to convert data to. When it is
+                larger than 1, shards are written by a pool of processes.
+            num_readers: int
+                The number of readers reading tfrecord files in parallel.
+            record_dtype: str
+                If None, images are stored as lists of floats. Otherwise, it
+                should be one of "uint8", "float16" and "float32", and images
+                are cast to it and stored as raw bytes. Images that could not
+                be cast without loss of range are refused when written, so
+                "uint8" is only meant for integral images in [0, 255], not
+                normalized or whitened ones. The dtype is appended to names of
+                tfrecord files, so files of different encoding could coexist.
+        """
+        super(ClassificationTFSource, self).__init__(**kwargs)
+        self.num_shards = num_shards
+        self.num_readers = num_readers
+        if record_dtype is not None:
+            assert record_dtype in ClassificationTFSource.RECORD_DTYPES,\
+                "record_dtype should be one of {}".format(
+                    ClassificationTFSource.RECORD_DTYPES.keys())
+        self.record_dtype = record_dtype
+
     @property
     def training_datum(self):
         return self._training_datum
@@ -426,30 +758,226 @@ class ClassificationTFSource(TFSource, SupervisedSource):
             labels: numpy array of shape [N] or list
                 corresponding labels
             name: a str
-                The output tfrecord file will be named `name.tfrecords`.
+                The output tfrecord file will be named `name.tfrecords`, or
+                `name-0000i-of-0000n.tfrecords` if there are multiple shards.
         """
         num_examples = labels.shape[0]
         if images.shape[0] != num_examples:
             raise ValueError("Images size %d does not match label size %d." %
                              (images.shape[0], num_examples))
+
+        self._write_tfrecords([images, labels], name)
+
+    def _make_example(self, arrays, index):
+        """
+        Make a `tf.train.Example` of the `index`th example. Sub-classes that
+        store different features should override this method.
+
+        Args:
+            arrays: list
+                Arrays passed to `_write_tfrecords`. Here they are images and
+                labels.
+        """
+        images, labels = arrays
         row = images.shape[1]
         col = images.shape[2]
         depth = images.shape[3]
+        return tf.train.Example(features=tf.train.Features(
+            feature={
+                'height': self._int_feature([row]),
+                'width': self._int_feature([col]),
+                'depth': self._int_feature([depth]),
+                'label': self._int_feature([int(labels[index])]),
+                'image_raw': self._image_feature(images[index])}))
+
+    def _image_feature(self, image):
+        """
+        Make the Feature protobuf of `image` according to `record_dtype`.
+        """
+        if self.record_dtype is None:
+            return self._float_feature(np.reshape(image, -1).tolist())
+
+        np_dtype, _ = ClassificationTFSource.RECORD_DTYPES[self.record_dtype]
+        return self._bytes_feature(
+            [np.ascontiguousarray(image, dtype=np_dtype).tobytes()])
+
+    def _image_raw_feature(self, shape):
+        """
+        Return the feature spec to parse an image of `shape` stored by
+        `_image_feature`.
+        """
+        if self.record_dtype is None:
+            return tf.FixedLenFeature(shape, tf.float32)
+
+        return tf.FixedLenFeature([], tf.string)
+
+    def _decode_image_raw(self, image_raw, shape):
+        """
+        Decode an image parsed with `_image_raw_feature` to a float32 tensor of
+        `shape`.
+        """
+        if self.record_dtype is None:
+            return image_raw
 
-        filename = os.path.join(self.work_dir, name + '.tfrecords')
-        print('Writing', filename)
-        writer = tf.python_io.TFRecordWriter(filename)
-        for index in range(num_examples):
-            image_raw = np.reshape(images[index], -1).tolist()
-            example = tf.train.Example(features=tf.train.Features(
-                feature={
-                    'height': self._int_feature([row]),
-                    'width': self._int_feature([col]),
-                    'depth': self._int_feature([depth]),
-                    'label': self._int_feature([int(labels[index])]),
-                    'image_raw': self._float_feature(image_raw)}))
-            writer.write(example.SerializeToString())
-        writer.close()
+        _, tf_dtype = ClassificationTFSource.RECORD_DTYPES[self.record_dtype]
+        image = tf.reshape(tf.decode_raw(image_raw, tf_dtype), shape)
+        if tf_dtype is not tf.float32:
+            image = tf.cast(image, tf.float32)
+
+        return image
+
+    def _record_name(self, name):
+        """
+        Return the name tfrecord files of data named `name` are actually
+        named, which depends on `record_dtype`.
+        """
+        if self.record_dtype is None:
+            return name
+
+        return name + "_" + self.record_dtype
+
+    def _write_tfrecords(self, arrays, name):
+        """
+        Write examples made by `_make_example` from `arrays` to `num_shards`
+        tfrecord files, and write a manifest of them.
+
+        Args:
+            arrays: list of numpy array
+                Arrays whose first dimension is the example index.
+            name: str
+                See `_convert_to_tf`.
+        """
+        global _shard_writing_args
+
+        # Images are always the first array.
+        self._check_record_range(arrays[0])
+        name = self._record_name(name)
+        num_examples = arrays[0].shape[0]
+        shards = []
+        for i in xrange(0, self.num_shards):
+            if self.num_shards == 1:
+                filename = name + '.tfrecords'
+            else:
+                filename = '%s-%05d-of-%05d.tfrecords' % (name,
+                                                          i,
+                                                          self.num_shards)
+            shards.append((os.path.join(self.work_dir, filename),
+                           num_examples * i // self.num_shards,
+                           num_examples * (i + 1) // self.num_shards))
+
+        log.info('Writing {} examples to {} shards of {}'.format(
+            num_examples, self.num_shards, name))
+        _shard_writing_args = (self, arrays)
+        try:
+            if self.num_shards == 1:
+                counts = [_write_shard(shards[0])]
+            else:
+                pool = multiprocessing.Pool(
+                    min(self.num_shards, multiprocessing.cpu_count()))
+                try:
+                    counts = pool.map(_write_shard, shards)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            _shard_writing_args = None
+
+        manifest = {
+            "num_examples": num_examples,
+            "record_dtype": self.record_dtype,
+            "shards": [{"filename": os.path.basename(shard[0]),
+                        "num_examples": count}
+                       for shard, count in zip(shards, counts)]
+        }
+        # The manifest is written last, so its existence marks a finished
+        # conversion.
+        with open(self._manifest_path(name), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def _check_record_range(self, images):
+        """
+        Raise if `images` could not be cast to `record_dtype` as they are.
+        """
+        if self.record_dtype is None or self.record_dtype == "float32":
+            return
+        np_dtype, _ = ClassificationTFSource.RECORD_DTYPES[self.record_dtype]
+        if images.dtype == np_dtype:
+            return
+
+        if np.issubdtype(np_dtype, np.integer):
+            info = np.iinfo(np_dtype)
+            if not (images == np.round(images)).all():
+                raise ValueError(
+                    "Images are not integral, so they could not be stored as"
+                    " {}. Store them as float16 or float32 instead.".format(
+                        self.record_dtype))
+        else:
+            info = np.finfo(np_dtype)
+        low, high = images.min(), images.max()
+        if not (np.isfinite(low) and np.isfinite(high)) or \
+           low < info.min or high > info.max:
+            raise ValueError(
+                "Images range in [{}, {}], out of range of {}, [{}, {}]."
+                " Store them as a wider dtype instead.".format(
+                    low, high, self.record_dtype, info.min, info.max))
+
+    def _manifest_path(self, record_name):
+        return os.path.join(self.work_dir, record_name + '.manifest.json')
+
+    def _tfrecords_exist(self, name):
+        """
+        Whether data named `name` has been converted to tfrecords.
+        """
+        name = self._record_name(name)
+        return os.path.exists(self._manifest_path(name)) or \
+            os.path.exists(os.path.join(self.work_dir, name + '.tfrecords'))
+
+    def _tfrecord_filenames(self, name):
+        """
+        Return the list of tfrecord files of data named `name`. Files
+        converted before manifests exist are supported as well.
+        """
+        name = self._record_name(name)
+        manifest_path = self._manifest_path(name)
+        if not os.path.exists(manifest_path):
+            return [os.path.join(self.work_dir, name + '.tfrecords')]
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return [os.path.join(self.work_dir, shard["filename"])
+                for shard in manifest["shards"]]
+
+    def _read_serialized_example(self, filenames, shuffle=True):
+        """
+        Read tfrecord files and return a tensor of a serialized example.
+
+        If `num_readers` is larger than 1, that many readers read from the
+        files in parallel, and fill a queue that the example is dequeued from.
+
+        Args:
+            filenames: list of str
+                tfrecord files to read.
+            shuffle: Boolean
+                Whether to shuffle the order files are read.
+        """
+        with tf.name_scope('input'):
+            filename_queue = tf.train.string_input_producer(filenames,
+                                                            shuffle=shuffle)
+            if self.num_readers == 1:
+                _, serialized_example = tf.TFRecordReader().read(
+                    filename_queue)
+                return serialized_example
+
+            examples_queue = tf.FIFOQueue(capacity=256 * self.num_readers,
+                                          dtypes=[tf.string])
+            enqueue_ops = []
+            for _ in xrange(0, self.num_readers):
+                _, value = tf.TFRecordReader().read(filename_queue)
+                enqueue_ops.append(examples_queue.enqueue([value]))
+            tf.train.queue_runner.add_queue_runner(
+                tf.train.queue_runner.QueueRunner(examples_queue, enqueue_ops))
+
+            return examples_queue.dequeue()
 
 
 # TODO:
@@ -0,0 +1,131 @@
+"""
+This module holds `SummaryPolicy`, which controls what tensorboard summaries
+blocks gather: on which layers, of which kinds, and every how many steps.
+
+Summaries of a `ProcessingLayer` are of the following kinds:
+
+* "activation": histogram of outputs of a layer.
+* "sparsity": scalar of the fraction of zeros in outputs of a layer.
+* "variable": summaries of variables of a layer, and their moving averages
+  if any.
+* "loss": scalar of losses.
+* "eval": scalar of evaluation metrics.
+
+Besides the train or validation summary collection, each summary is also
+added to the collection of its kind, named by `kind_collection`, so they
+could be gathered at different frequencies, see `summary_steps` of `Kid`.
+"""
+from __future__ import absolute_import, division, print_function
+
+import re
+import inspect
+
+
+ACTIVATION_SUMMARY = "activation"
+SPARSITY_SUMMARY = "sparsity"
+VARIABLE_SUMMARY = "variable"
+LOSS_SUMMARY = "loss"
+EVAL_SUMMARY = "eval"
+SUMMARY_KINDS = [ACTIVATION_SUMMARY,
+                 SPARSITY_SUMMARY,
+                 VARIABLE_SUMMARY,
+                 LOSS_SUMMARY,
+                 EVAL_SUMMARY]
+
+
+def kind_collection(kind):
+    """
+    Return the name of the graph collection holding summaries of `kind`.
+    """
+    return "{}_summary".format(kind)
+
+
+class SummaryPolicy(object):
+    """
+    A policy deciding which summaries are gathered.
+
+    Set it as `summary_policy` of a `Brain` (or any system), and it applies to
+    all blocks the brain holds. For example, to keep cheap scalar summaries of
+    a large network, while only gathering histograms of the first and last
+    layers every 1000 steps::
+
+        policy = SummaryPolicy(
+            kinds=["sparsity", "loss", "eval"],
+            layers={"activation": ["conv1$", "ip.*"]},
+            steps={"activation": 1000})
+    """
+    def __init__(self,
+                 kinds=None,
+                 layers=None,
+                 exclude_layers=None,
+                 steps=None):
+        """
+        Args:
+            kinds: list of str
+                Kinds of summaries to gather, see the module docstring. If
+                None, all kinds are gathered.
+            layers: list of str, or dict
+                Regular expressions matched (by `re.match`) against names of
+                layers to gather summaries of. If None, all layers
+                match. Patterns for some kinds only could be given by a dict
+                from kinds to lists of patterns, where kinds not given match
+                all layers.
+            exclude_layers: list of str, or dict
+                The same with `layers`, but names of layers matched are
+                excluded. If a dict, kinds not given exclude no layer.
+            steps: dict
+                Every how many steps summaries of each kind are gathered. It
+                is merged into `summary_steps` of the `Kid` training the
+                brain holding this policy, and entries given there take
+                priority.
+        """
+        if kinds is not None:
+            for k in kinds:
+                if k not in SUMMARY_KINDS:
+                    raise ValueError("Unknown summary kind {}. It should be"
+                                     " one of {}.".format(k, SUMMARY_KINDS))
+
+        self.kinds = kinds
+        self.layers = layers
+        self.exclude_layers = exclude_layers
+        self.steps = steps if steps else {}
+
+    def allows(self, layer_name, kind):
+        """
+        Whether summaries of `kind` should be gathered on layer `layer_name`.
+        """
+        if self.kinds is not None and kind not in self.kinds:
+            return False
+
+        included = self._patterns(self.layers, kind)
+        if included is not None and \
+           not self._match_any(included, layer_name):
+            return False
+
+        excluded = self._patterns(self.exclude_layers, kind)
+        if excluded is not None and self._match_any(excluded, layer_name):
+            return False
+
+        return True
+
+    def step_collections(self):
+        """
+        Return `steps` keyed by names of collections of kinds, in the form
+        of `summary_steps` of `Kid`.
+        """
+        return {kind_collection(k): s for k, s in self.steps.items()}
+
+    def _patterns(self, patterns, kind):
+        if type(patterns) is dict:
+            return patterns.get(kind, None)
+        return patterns
+
+    def _match_any(self, patterns, name):
+        for p in patterns:
+            if re.match(p, name):
+                return True
+        return False
+
+
+__all__ = [name for name, x in locals().items() if
+           not inspect.ismodule(x) and not inspect.isabstract(x)]
@@ -130,6 +130,8 @@ class LinkedSystem(System):
         for l in self.blocks:
             log.info("Setting up block {}.".format(l.name))
             l.do_summary = self.do_summary
+            if self.summary_policy is not None:
+                l.summary_policy = self.summary_policy
             l.setup(data)
             log.info("Connected: {} -> {}".format(data.name,
                                                   l.data.name))
@@ -176,6 +178,8 @@ class GraphSystem(LinkedSystem):
         for i, l in enumerate(self.blocks):
             log.info("Setting up block {}.".format(l.name))
             l.do_summary = self.do_summary
+            if self.summary_policy is not None:
+                l.summary_policy = self.summary_policy
             inputs = None
             if l.inputs:
                 # Find inputs in the system to current block.
@@ -14,10 +14,12 @@ import tensorflow as tf
 
 from ..core.sources import (
     InMemoryFeedSource,
+    MemmapFeedSource,
     SupervisedSource,
     ClassificationTFSource
 )
 from .datasets import DataSet, DataSets
+from .preprocessing import GCNZCAWhitener, python_batch_chunks
 
 
 class Cifar10Source(SupervisedSource):
@@ -32,12 +34,30 @@ class Cifar10Source(SupervisedSource):
         """
         Args:
             use_zca: Boolean
-                Use ZCA whitened data or not. If this is specified, the ZCA
-                whitened data has to be in `work_dir` already.
+                Use global contrast normalized, then ZCA whitened data or
+                not. Whitened data are computed from the python version of
+                CIFAR10 in `work_dir` the first time, and cached afterwards.
         """
         super(Cifar10Source, self).__init__(**kwargs)
         self.use_zca = use_zca
 
+    def _get_zca_whitened(self):
+        """
+        Return global contrast normalized, then ZCA whitened training and test
+        images, each of which is a memory mapped array of shape [N, H, W, C].
+        """
+        train_filenames = [os.path.join(self.work_dir, 'cifar-10-batches-py',
+                                        'data_batch_%d' % i)
+                           for i in xrange(1, 6)]
+        test_filenames = [os.path.join(self.work_dir, 'cifar-10-batches-py',
+                                       'test_batch')]
+        return GCNZCAWhitener().whiten(
+            self.work_dir,
+            "cifar10",
+            lambda: python_batch_chunks(train_filenames),
+            lambda: python_batch_chunks(test_filenames),
+            [3, 32, 32])
+
     def _load_cifar10_python(self, filenames):
         """
         Load python version of Cifar10 dataset.
@@ -88,31 +108,31 @@ class Cifar10FeedSource(Cifar10Source, InMemoryFeedSource):
         test_dataset = self._load_cifar10_python(test_filenames)
 
         if self.use_zca:
-            sample_num = len(train_filenames) * 10000
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "train.npy"))
-            imgs = imgs.reshape([sample_num, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+            train_imgs, test_imgs = self._get_zca_whitened()
             training_dataset = DataSet(
-                imgs[0:self.num_train, ...],
+                train_imgs[0:self.num_train, ...],
                 training_dataset.labels[0:self.num_train])
-
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "test.npy"))
-            imgs = imgs.reshape([10000, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
-            test_dataset = DataSet(imgs[0:self.num_val, ...],
+            test_dataset = DataSet(test_imgs[0:self.num_val, ...],
                                    test_dataset.labels[0:self.num_val])
 
         return DataSets(training_dataset, test_dataset)
 
 
+class Cifar10MemmapFeedSource(MemmapFeedSource, Cifar10FeedSource):
+    """
+    A `Cifar10FeedSource` that converts data to `.npy` files once, and maps
+    them into memory afterwards. See `MemmapFeedSource`.
+    """
+    pass
+
+
 class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
     """
     A concrete `Source` for Cifar10 dataset.
     """
+    TRAINING_TF_FILENAME = "cifar10_training"
+    TEST_TF_FILENAME = "cifar10_test"
+
     def _setup(self):
         """
         Construct input for CIFAR evaluation using the Reader ops.
@@ -126,36 +146,23 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
         self._maybe_convert_to_tf()
 
         # Read and set up data tensors.
-        filename = os.path.join(self.work_dir, 'cifar10_training.tfrecords')
-        with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(Cifar10TFSource.TRAINING_TF_FILENAME))
         self._training_datum, self._training_label \
-            = self._get_sample_tensors_from_tfrecords(filename_queue)
+            = self._get_sample_tensors_from_tfrecords(serialized_example)
 
-        filename = os.path.join(self.work_dir, 'cifar10_test.tfrecords')
-        with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(Cifar10TFSource.TEST_TF_FILENAME))
         self._val_datum, self._val_label \
-            = self._get_sample_tensors_from_tfrecords(filename_queue)
+            = self._get_sample_tensors_from_tfrecords(serialized_example)
 
     def _maybe_convert_to_tf(self):
         """
         If tfrecords data are not available, convert it from the ZCA whitened
         data and downloaded labels.
-
-        TODO: write the data pre-processing code so I won't need to rely on
-        pylearn2.
         """
-        TRAINING_TF_FILENAME = "cifar10_training"
-        if not os.path.exists(
-                os.path.join(self.work_dir,
-                             TRAINING_TF_FILENAME + ".tfrecords")):
-            # Read the numpy data in and convert it to TFRecord.
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "train.npy"))
-            imgs = imgs.reshape([Cifar10Source.SAMPLE_NUM, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+        if not self._tfrecords_exist(Cifar10TFSource.TRAINING_TF_FILENAME):
+            imgs, _ = self._get_zca_whitened()
 
             # Load training set into memory.
             train_filenames = [os.path.join(self.work_dir,
@@ -163,50 +170,48 @@ class Cifar10TFSource(Cifar10Source, ClassificationTFSource):
                                             'data_batch_%d' % i)
                                for i in xrange(1, 6)]
             training_labels = self._load_cifar10_python(train_filenames).labels
-            self._convert_to_tf(imgs, training_labels, TRAINING_TF_FILENAME)
-
-        TEST_TF_FILENAME = "cifar10_test"
-        if not os.path.exists(
-                os.path.join(self.work_dir, TEST_TF_FILENAME + ".tfrecords")):
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "test.npy"))
-            imgs = imgs.reshape([10000, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+            self._convert_to_tf(imgs,
+                                training_labels,
+                                Cifar10TFSource.TRAINING_TF_FILENAME)
+
+        if not self._tfrecords_exist(Cifar10TFSource.TEST_TF_FILENAME):
+            _, imgs = self._get_zca_whitened()
             test_filenames = [os.path.join(self.work_dir,
                                            'cifar-10-batches-py',
                                            'test_batch')]
             test_labels = self._load_cifar10_python(test_filenames).labels
-            self._convert_to_tf(imgs, test_labels, TEST_TF_FILENAME)
+            self._convert_to_tf(imgs,
+                                test_labels,
+                                Cifar10TFSource.TEST_TF_FILENAME)
 
-    def _get_sample_tensors_from_tfrecords(self, filename_queue):
+    def _get_sample_tensors_from_tfrecords(self, serialized_example):
         """
-        Read from tfrecord file and return data tensors.
+        Parse a serialized example read from tfrecord files and return data
+        tensors.
 
         Args:
-            filename_queue: tf.train.string_input_producer
-                A file name queue that gives string tensor for tfrecord names.
+            serialized_example: tf.Tensor
+                A string tensor returned by `_read_serialized_example`.
 
         Returns:
             (image, label): tuple of (rank-4 tf.float32 tensor and rank-1
                             tf.int32 tensor)
                 individual sample that may be later put into a batch.
         """
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
         features = tf.parse_single_example(
             serialized_example,
             # Defaults are not specified since both keys are required.
             features={
-                'image_raw': tf.FixedLenFeature(
-                    [Cifar10Source.IMAGE_SIZE, Cifar10Source.IMAGE_SIZE, 3],
-                    tf.float32),
+                'image_raw': self._image_raw_feature(
+                    [Cifar10Source.IMAGE_SIZE, Cifar10Source.IMAGE_SIZE, 3]),
                 'label': tf.FixedLenFeature([], tf.int64),
             })
 
         # Convert label from a scalar uint8 tensor to an int32 scalar.
         label = tf.cast(features['label'], tf.int32)
-        image = features["image_raw"]
+        image = self._decode_image_raw(
+            features["image_raw"],
+            [Cifar10Source.IMAGE_SIZE, Cifar10Source.IMAGE_SIZE, 3])
 
         return image, label
 
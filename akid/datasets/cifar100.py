@@ -11,6 +11,7 @@ import tensorflow as tf
 
 from ..core.sources import ClassificationTFSource
 from .datasets import DataSet
+from .preprocessing import GCNZCAWhitener, python_batch_chunks
 
 
 SUPER_CLASS_NUM = 20
@@ -143,12 +144,30 @@ NEW_LABEL_ORDER_LIST = [
 ]
 
 
+def _get_zca_whitened(work_dir):
+    """
+    Return global contrast normalized, then ZCA whitened training and test
+    images of CIFAR100 in `work_dir`, each of which is a memory mapped array of
+    shape [N, H, W, C].
+    """
+    train_filenames = [os.path.join(work_dir, 'cifar-100-python', 'train')]
+    test_filenames = [os.path.join(work_dir, 'cifar-100-python', 'test')]
+    return GCNZCAWhitener().whiten(
+        work_dir,
+        "cifar100",
+        lambda: python_batch_chunks(train_filenames),
+        lambda: python_batch_chunks(test_filenames),
+        [3, 32, 32])
+
+
 class Cifar100TFSource(ClassificationTFSource):
     """
     A concrete `Source` for Cifar100 dataset. This class provides global
     contrast normalized, then ZCA whitened images using tfrecords.
     """
     SAMPLE_NUM = 50000
+    TRAINING_TF_FILENAME = "cifar100_training"
+    TEST_TF_FILENAME = "cifar100_test"
 
     def _load_cifar100_python(self, filenames):
         """
@@ -182,36 +201,23 @@ class Cifar100TFSource(ClassificationTFSource):
 
     def _read_from_tfrecord(self):
         # Read and set up data tensors.
-        filename = os.path.join(self.work_dir, 'cifar100_training.tfrecords')
-        with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(Cifar100TFSource.TRAINING_TF_FILENAME))
         self._training_datum, self._training_label \
-            = self._get_sample_tensors_from_tfrecords(filename_queue)
+            = self._get_sample_tensors_from_tfrecords(serialized_example)
 
-        filename = os.path.join(self.work_dir, 'cifar100_test.tfrecords')
-        with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(Cifar100TFSource.TEST_TF_FILENAME))
         self._val_datum, self._val_label \
-            = self._get_sample_tensors_from_tfrecords(filename_queue)
+            = self._get_sample_tensors_from_tfrecords(serialized_example)
 
     def _maybe_convert_to_tf(self):
         """
         If tfrecords data are not available, convert it from the ZCA whitened
         data and downloaded labels.
-
-        TODO: write the data pre-processing code so I won't need to rely on
-        pylearn2.
         """
-        TRAINING_TF_FILENAME = "cifar100_training"
-        if not os.path.exists(
-                os.path.join(self.work_dir,
-                             TRAINING_TF_FILENAME + ".tfrecords")):
-            # Read the numpy data in and convert it to TFRecord.
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "train.npy"))
-            imgs = imgs.reshape([Cifar100TFSource.SAMPLE_NUM, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+        if not self._tfrecords_exist(Cifar100TFSource.TRAINING_TF_FILENAME):
+            imgs, _ = _get_zca_whitened(self.work_dir)
 
             # Load training set into memory.
             train_filenames = [os.path.join(self.work_dir,
@@ -219,50 +225,45 @@ class Cifar100TFSource(ClassificationTFSource):
                                             "train")]
             training_labels = self._load_cifar100_python(
                 train_filenames).labels
-            self._convert_to_tf(imgs, training_labels, TRAINING_TF_FILENAME)
-
-        TEST_TF_FILENAME = "cifar100_test"
-        if not os.path.exists(
-                os.path.join(self.work_dir, TEST_TF_FILENAME + ".tfrecords")):
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "test.npy"))
-            imgs = imgs.reshape([10000, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+            self._convert_to_tf(imgs,
+                                training_labels,
+                                Cifar100TFSource.TRAINING_TF_FILENAME)
+
+        if not self._tfrecords_exist(Cifar100TFSource.TEST_TF_FILENAME):
+            _, imgs = _get_zca_whitened(self.work_dir)
             test_filenames = [os.path.join(self.work_dir,
                                            'cifar-100-python',
                                            'test')]
             test_labels = self._load_cifar100_python(test_filenames).labels
-            self._convert_to_tf(imgs, test_labels, TEST_TF_FILENAME)
+            self._convert_to_tf(imgs,
+                                test_labels,
+                                Cifar100TFSource.TEST_TF_FILENAME)
 
-    def _get_sample_tensors_from_tfrecords(self, filename_queue):
+    def _get_sample_tensors_from_tfrecords(self, serialized_example):
         """
-        Read from tfrecord file and return data tensors.
+        Parse a serialized example read from tfrecord files and return data
+        tensors.
 
         Args:
-            filename_queue: tf.train.string_input_producer
-                A file name queue that gives string tensor for tfrecord names.
+            serialized_example: tf.Tensor
+                A string tensor returned by `_read_serialized_example`.
 
         Returns:
             (image, label): tuple of (rank-4 tf.float32 tensor and rank-1
                             tf.int32 tensor)
                 individual sample that may be later put into a batch.
         """
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
         features = tf.parse_single_example(
             serialized_example,
             # Defaults are not specified since both keys are required.
             features={
-                'image_raw': tf.FixedLenFeature(
-                    [32, 32, 3],
-                    tf.float32),
+                'image_raw': self._image_raw_feature([32, 32, 3]),
                 'label': tf.FixedLenFeature([], tf.int64),
             })
 
         # Convert label from a scalar uint8 tensor to an int32 scalar.
         label = tf.cast(features['label'], tf.int32)
-        image = features["image_raw"]
+        image = self._decode_image_raw(features["image_raw"], [32, 32, 3])
 
         return image, label
 
@@ -346,8 +347,8 @@ class HCifar100TFSource(ClassificationTFSource):
     +------------------------------+------------------------------+
     """
     SAMPLE_NUM = 50000
-    TRAINING_TF_FILENAME = "hierarchical_cifar100_training.tfrecords"
-    TEST_TF_FILENAME = "hierarchical_cifar100_test.tfrecords"
+    TRAINING_TF_FILENAME = "hierarchical_cifar100_training"
+    TEST_TF_FILENAME = "hierarchical_cifar100_test"
 
     def __init__(self, **kwargs):
         super(HCifar100TFSource, self).__init__(**kwargs)
@@ -392,38 +393,23 @@ class HCifar100TFSource(ClassificationTFSource):
 
     def _read_from_tfrecord(self):
         # Read and set up data tensors.
-        filename = os.path.join(self.work_dir,
-                                HCifar100TFSource.TRAINING_TF_FILENAME)
-        with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(HCifar100TFSource.TRAINING_TF_FILENAME))
         self._training_datum, self._training_label \
-            = self._get_sample_tensors_from_tfrecords(filename_queue)
+            = self._get_sample_tensors_from_tfrecords(serialized_example)
 
-        filename = os.path.join(self.work_dir,
-                                HCifar100TFSource.TEST_TF_FILENAME)
-        with tf.name_scope('input'):
-            filename_queue = tf.train.string_input_producer([filename])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(HCifar100TFSource.TEST_TF_FILENAME))
         self._val_datum, self._val_label \
-            = self._get_sample_tensors_from_tfrecords(filename_queue)
+            = self._get_sample_tensors_from_tfrecords(serialized_example)
 
     def _maybe_convert_to_tf(self):
         """
         If tfrecords data are not available, convert it from the ZCA whitened
         data and downloaded labels.
-
-        TODO: write the data pre-processing code so I won't need to rely on
-        pylearn2.
         """
-        if not os.path.exists(
-                os.path.join(
-                    self.work_dir,
-                    HCifar100TFSource.TRAINING_TF_FILENAME)):
-            # Read the numpy data in and convert it to TFRecord.
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "train.npy"))
-            imgs = imgs.reshape([Cifar100TFSource.SAMPLE_NUM, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+        if not self._tfrecords_exist(HCifar100TFSource.TRAINING_TF_FILENAME):
+            imgs, _ = _get_zca_whitened(self.work_dir)
 
             # Load training set into memory.
             train_filenames = [os.path.join(self.work_dir,
@@ -437,15 +423,8 @@ class HCifar100TFSource(ClassificationTFSource):
                                 training_coarse_labels,
                                 HCifar100TFSource.TRAINING_TF_FILENAME)
 
-        if not os.path.exists(
-                os.path.join(
-                    self.work_dir,
-                    HCifar100TFSource.TEST_TF_FILENAME)):
-            imgs = np.load(os.path.join(self.work_dir,
-                                        "pylearn2_gcn_whitened",
-                                        "test.npy"))
-            imgs = imgs.reshape([10000, 3, 32, 32])
-            imgs = np.einsum("nchw->nhwc", imgs)
+        if not self._tfrecords_exist(HCifar100TFSource.TEST_TF_FILENAME):
+            _, imgs = _get_zca_whitened(self.work_dir)
             test_filenames = [os.path.join(self.work_dir,
                                            'cifar-100-python',
                                            'test')]
@@ -482,30 +461,27 @@ class HCifar100TFSource(ClassificationTFSource):
 
         expanded_fine_labels = self._expand_fine_labels(fine_labels)
 
+        self._write_tfrecords(
+            [images, fine_labels, coarse_labels, expanded_fine_labels], name)
+
+    def _make_example(self, arrays, index):
+        images, fine_labels, coarse_labels, expanded_fine_labels = arrays
         row = images.shape[1]
         col = images.shape[2]
         depth = images.shape[3]
-
-        filename = os.path.join(self.work_dir, name)
-        print('Writing', filename)
-        writer = tf.python_io.TFRecordWriter(filename)
-        for index in range(num_examples):
-            image_raw = np.reshape(images[index], -1).tolist()
-            expanded_fine_label = expanded_fine_labels[index].tolist()
-            example = tf.train.Example(features=tf.train.Features(
-                feature={
-                    'height': self._int_feature([row]),
-                    'width': self._int_feature([col]),
-                    'depth': self._int_feature([depth]),
-                    'coarse_label': self._int_feature(
-                        [int(coarse_labels[index])]),
-                    'expanded_fine_label': self._int_feature(
-                        expanded_fine_label),
-                    'fine_label': self._int_feature(
-                        [int(fine_labels[index])]),
-                    'image_raw': self._float_feature(image_raw)}))
-            writer.write(example.SerializeToString())
-        writer.close()
+        expanded_fine_label = expanded_fine_labels[index].tolist()
+        return tf.train.Example(features=tf.train.Features(
+            feature={
+                'height': self._int_feature([row]),
+                'width': self._int_feature([col]),
+                'depth': self._int_feature([depth]),
+                'coarse_label': self._int_feature(
+                    [int(coarse_labels[index])]),
+                'expanded_fine_label': self._int_feature(
+                    expanded_fine_label),
+                'fine_label': self._int_feature(
+                    [int(fine_labels[index])]),
+                'image_raw': self._image_feature(images[index])}))
 
     def _expand_fine_labels(self, labels):
         """
@@ -533,28 +509,25 @@ class HCifar100TFSource(ClassificationTFSource):
 
         return fine_label_vectors
 
-    def _get_sample_tensors_from_tfrecords(self, filename_queue):
+    def _get_sample_tensors_from_tfrecords(self, serialized_example):
         """
-        Read from tfrecord file and return data tensors.
+        Parse a serialized example read from tfrecord files and return data
+        tensors.
 
         Args:
-            filename_queue: tf.train.string_input_producer
-                A file name queue that gives string tensor for tfrecord names.
+            serialized_example: tf.Tensor
+                A string tensor returned by `_read_serialized_example`.
 
         Returns:
             A tuple of a tensor and a list. The tensor is the image, the list
             contains tensors of coarse label, fine label and expanded fine
             labels respectively.
         """
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
         features = tf.parse_single_example(
             serialized_example,
             # Defaults are not specified since both keys are required.
             features={
-                'image_raw': tf.FixedLenFeature(
-                    [32, 32, 3],
-                    tf.float32),
+                'image_raw': self._image_raw_feature([32, 32, 3]),
                 'coarse_label': tf.FixedLenFeature([], tf.int64),
                 'fine_label': tf.FixedLenFeature([], tf.int64),
                 'expanded_fine_label': tf.FixedLenFeature(
@@ -567,6 +540,6 @@ class HCifar100TFSource(ClassificationTFSource):
         fine_label = tf.cast(features['fine_label'], tf.int32)
         expanded_fine_label = tf.cast(
             features['expanded_fine_label'], tf.int32)
-        image = features["image_raw"]
+        image = self._decode_image_raw(features["image_raw"], [32, 32, 3])
 
         return image, [coarse_label, fine_label, expanded_fine_label]
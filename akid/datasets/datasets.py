@@ -3,6 +3,8 @@ This module holds classes to model datasets.
 """
 import numpy
 
+from .idx import dense_to_one_hot
+
 
 PIXEL_DEPTH = 255
 
@@ -14,7 +16,40 @@ class DataSet(object):
                  labels,
                  center=False,
                  scale=False,
-                 fake_data=False):
+                 fake_data=False,
+                 shuffle_by_index=False,
+                 seed=None,
+                 one_hot_classes=None):
+        """
+        Args:
+            center, scale: Boolean
+                Subtract half of the pixel depth from images, and divide them
+                by the pixel depth respectively. If `images` is a
+                `numpy.memmap`, they are applied to each batch instead, so
+                the mapped array is not copied into memory; `images` then
+                holds the raw data.
+            shuffle_by_index: Boolean
+                If True, the arrays passed in are never reordered. Instead a
+                permutation of indices is drawn at each epoch boundary, and
+                batches are gathered through it into a preallocated batch
+                buffer. Epoch rollover then costs a permutation of `N` ints
+                instead of a full copy of the data. Note that the arrays
+                returned by `next_batch` are views of the buffer, so they are
+                overwritten by the next call.
+            seed: int
+                Seed of shuffling. The permutation of each epoch is derived
+                from the seed and the epoch number alone, so the order of data
+                is reproducible, and could be restored from the state returned
+                by `get_state`. If None, a seed is drawn from the global numpy
+                random state.
+            one_hot_classes: int
+                If given, labels of batches are converted to one-hot vectors
+                of this many classes. Labels are kept dense, so the one-hot
+                matrix of the whole dataset is never stored.
+
+        Arrays that are memory mapped are always shuffled by index, since
+        reordering them would load them into memory.
+        """
         if fake_data:
             self._num_examples = 10000
         else:
@@ -22,17 +57,37 @@ class DataSet(object):
                 "images.shape: %s labels.shape: %s" % (images.shape,
                                                        labels.shape))
             self._num_examples = images.shape[0]
-            if center:
-                images = images - (PIXEL_DEPTH / 2.0)
-            if scale:
-                images = images.astype(numpy.float32)
-                images = images / PIXEL_DEPTH
+            if isinstance(images, numpy.memmap):
+                shuffle_by_index = True
+            else:
+                images = self._normalize(images, center, scale)
+                center = scale = False
 
+        # Normalization left to batches.
+        self._center = center
+        self._scale = scale
+        self.one_hot_classes = one_hot_classes
         self._images = images
         self._labels = labels
         self._epochs_completed = 0
         self._index_in_epoch = 0
 
+        self.shuffle_by_index = shuffle_by_index
+        # Permutation of the current epoch when shuffling by index. None means
+        # the identity, which is the order of the first epoch.
+        self._perm = None
+        self._images_buffer = None
+        self._labels_buffer = None
+
+        if seed is None:
+            seed = numpy.random.randint(2**31 - 1)
+        self.seed = seed
+        # When not shuffling by index, the data are reordered in place. The
+        # order records the original index of the sample at each position, so
+        # the data could be reordered to any epoch when restoring a state. None
+        # means the identity.
+        self._order = None
+
     @property
     def images(self):
         return self._images
@@ -62,16 +117,138 @@ class DataSet(object):
             # Finished epoch
             self._epochs_completed += 1
             # Shuffle the data
-            perm = numpy.arange(self._num_examples)
-            numpy.random.shuffle(perm)
-            self._images = self._images[perm]
-            self._labels = self._labels[perm]
+            self._shuffle()
             # Start next epoch
             start = 0
             self._index_in_epoch = batch_size
             assert batch_size <= self._num_examples
         end = self._index_in_epoch
-        return self._images[start:end], self._labels[start:end]
+
+        if self._perm is None:
+            return self._process(self._images[start:end],
+                                 self._labels[start:end])
+
+        return self._process(*self._gather(self._perm[start:end]))
+
+    def iter_batches(self, batch_size, num=None):
+        """
+        Iterate over the first `num` samples in order exactly once, in batches
+        of `batch_size`, where the last batch may be smaller. The cursor used
+        by `next_batch` is not touched.
+
+        Args:
+            num: int
+                The number of samples to iterate over. If None, all samples.
+        """
+        if num is None:
+            num = self._num_examples
+        for start in xrange(0, num, batch_size):
+            end = min(start + batch_size, num)
+            yield self._process(self._images[start:end],
+                                self._labels[start:end])
+
+    def _normalize(self, images, center, scale):
+        if center:
+            images = images - (PIXEL_DEPTH / 2.0)
+        if scale:
+            images = images.astype(numpy.float32)
+            images = images / PIXEL_DEPTH
+        return images
+
+    def _process(self, images, labels):
+        """
+        Apply normalization and label conversion left to batches.
+        """
+        images = self._normalize(images, self._center, self._scale)
+        if self.one_hot_classes:
+            labels = dense_to_one_hot(labels, self.one_hot_classes)
+        return images, labels
+
+    def get_state(self):
+        """
+        Return the cursor of this dataset, which is a JSON serializable dict.
+        """
+        return {
+            "seed": self.seed,
+            "epochs_completed": self._epochs_completed,
+            "index_in_epoch": self._index_in_epoch,
+        }
+
+    def set_state(self, state):
+        """
+        Restore the cursor returned by `get_state`, so later batches are the
+        same with those would have been got after the state was taken.
+        """
+        self.seed = state["seed"]
+        self._epochs_completed = state["epochs_completed"]
+        self._index_in_epoch = state["index_in_epoch"]
+        if self._epochs_completed == 0:
+            perm = None
+        else:
+            perm = self._epoch_permutation(self._epochs_completed)
+
+        if self.shuffle_by_index:
+            self._perm = perm
+            return
+
+        # Compose permutations of all epochs so far, which is the order of
+        # data to restore.
+        order = numpy.arange(self._num_examples)
+        for epoch in xrange(1, self._epochs_completed + 1):
+            order = order[self._epoch_permutation(epoch)]
+        # Map the order back to positions of the current data.
+        positions = order
+        if self._order is not None:
+            inverse = numpy.empty_like(self._order)
+            inverse[self._order] = numpy.arange(self._num_examples)
+            positions = inverse[order]
+        self._images = self._images[positions]
+        self._labels = self._labels[positions]
+        self._order = order
+
+    def _epoch_permutation(self, epoch):
+        """
+        Return the permutation of `epoch`, which only depends on the seed and
+        the epoch.
+        """
+        rng = numpy.random.RandomState([self.seed, epoch])
+        return rng.permutation(self._num_examples)
+
+    def _shuffle(self):
+        perm = self._epoch_permutation(self._epochs_completed)
+        if self.shuffle_by_index:
+            self._perm = perm
+        else:
+            self._images = self._images[perm]
+            self._labels = self._labels[perm]
+            self._order = perm if self._order is None else self._order[perm]
+
+    def _gather(self, indices):
+        """
+        Gather samples at `indices` into the batch buffers, which are
+        (re)allocated only when a larger batch than ever before is asked.
+
+        Returns:
+            A tuple of views of the image buffer and the label buffer.
+        """
+        batch_size = indices.shape[0]
+        if self._images_buffer is None \
+           or self._images_buffer.shape[0] < batch_size:
+            self._images_buffer = numpy.empty(
+                (batch_size,) + self._images.shape[1:],
+                dtype=self._images.dtype)
+            self._labels_buffer = numpy.empty(
+                (batch_size,) + self._labels.shape[1:],
+                dtype=self._labels.dtype)
+
+        images = self._images_buffer[:batch_size]
+        labels = self._labels_buffer[:batch_size]
+        # Indices are known to be valid. With mode "raise", numpy would gather
+        # into a temporary array first, and then copy it to `out`.
+        numpy.take(self._images, indices, axis=0, out=images, mode="clip")
+        numpy.take(self._labels, indices, axis=0, out=labels, mode="clip")
+
+        return images, labels
 
 
 class DataSets(object):
@@ -0,0 +1,106 @@
+"""
+This module reads files in the IDX format, the format MNIST is distributed
+in, see http://yann.lecun.com/exdb/mnist/.
+
+Instead of reading the whole decompressed file into memory, a gzipped IDX file
+is decompressed once, chunk by chunk, to a raw file next to it, which is then
+mapped into memory. So arrays far larger than memory could be read.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import gzip
+import shutil
+
+import numpy as np
+
+from ..utils import glog as log
+
+
+# Map from the type code in the magic number to the big endian dtype of data.
+IDX_DTYPES = {
+    0x08: np.dtype(np.uint8),
+    0x09: np.dtype(np.int8),
+    0x0B: np.dtype('>i2'),
+    0x0C: np.dtype('>i4'),
+    0x0D: np.dtype('>f4'),
+    0x0E: np.dtype('>f8'),
+}
+
+
+def maybe_decompress(filename, cache_dir=None, chunk_size=1 << 20):
+    """
+    Decompress gzipped `filename` to a raw file if it has not been done, and
+    return the path of the raw file. Files not ending with `.gz` are returned
+    as they are.
+
+    Args:
+        cache_dir: str
+            Folder to put the raw file in. By default, the folder of
+            `filename`.
+        chunk_size: int
+            The number of bytes decompressed at a time.
+    """
+    if not filename.endswith(".gz"):
+        return filename
+
+    if cache_dir is None:
+        cache_dir = os.path.dirname(filename)
+    raw_path = os.path.join(cache_dir, os.path.basename(filename)[:-3])
+    if os.path.exists(raw_path):
+        return raw_path
+
+    log.info("Decompressing {} to {} ...".format(filename, raw_path))
+    # Write to a temporary file, then rename, so partial files are never
+    # taken as decompressed ones.
+    tmp_path = "{}.{}.tmp".format(raw_path, os.getpid())
+    with gzip.open(filename, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, chunk_size)
+    os.rename(tmp_path, raw_path)
+
+    return raw_path
+
+
+def read_idx(filename, cache_dir=None):
+    """
+    Read an IDX file, which could be gzipped.
+
+    Args:
+        filename: str
+            Path of the IDX file.
+        cache_dir: str
+            See `maybe_decompress`.
+
+    Returns:
+        A read only `numpy.memmap` with the shape and dtype given in the
+        header of the file.
+    """
+    raw_path = maybe_decompress(filename, cache_dir)
+    with open(raw_path, "rb") as f:
+        magic = bytearray(f.read(4))
+        if magic[0] != 0 or magic[1] != 0 or magic[2] not in IDX_DTYPES:
+            raise ValueError("Invalid magic number {} in IDX file: {}".format(
+                list(magic), filename))
+        ndim = magic[3]
+        shape = tuple(
+            int(d) for d in np.frombuffer(f.read(4 * ndim), dtype='>u4'))
+
+    return np.memmap(raw_path,
+                     dtype=IDX_DTYPES[magic[2]],
+                     mode='r',
+                     offset=4 + 4 * ndim,
+                     shape=shape)
+
+
+def dense_to_one_hot(labels_dense, num_classes=10, dtype=np.uint8):
+    """
+    Convert class labels from scalars to one-hot vectors of `dtype`.
+
+    It is cheap enough to be called on each batch, so the one-hot matrix of
+    the whole dataset never needs to be stored.
+    """
+    labels_dense = np.asarray(labels_dense).ravel()
+    labels_one_hot = np.zeros((labels_dense.shape[0], num_classes),
+                              dtype=dtype)
+    labels_one_hot[np.arange(labels_dense.shape[0]), labels_dense] = 1
+    return labels_one_hot
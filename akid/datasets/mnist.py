@@ -1,13 +1,17 @@
 import os
 import urllib
-import gzip
 import zipfile
 
 import numpy as np
 
 from ..utils import glog as log
-from ..core.sources import InMemoryFeedSource, SupervisedSource
+from ..core.sources import (
+    InMemoryFeedSource,
+    MemmapFeedSource,
+    SupervisedSource
+)
 from .datasets import DataSet, DataSets
+from .idx import read_idx
 
 
 class MNISTFeedSource(InMemoryFeedSource, SupervisedSource):
@@ -50,13 +54,13 @@ class MNISTFeedSource(InMemoryFeedSource, SupervisedSource):
         train_images = self._extract_images(local_file)
 
         local_file = self._maybe_download(TRAIN_LABELS, self.work_dir)
-        train_labels = self._extract_labels(local_file, one_hot=one_hot)
+        train_labels = self._extract_labels(local_file)
 
         local_file = self._maybe_download(TEST_IMAGES, self.work_dir)
         test_images = self._extract_images(local_file)
 
         local_file = self._maybe_download(TEST_LABELS, self.work_dir)
-        test_labels = self._extract_labels(local_file, one_hot=one_hot)
+        test_labels = self._extract_labels(local_file)
 
         VALIDATION_SIZE = self.validation_rate * self.num_train
         validation_images = train_images[:VALIDATION_SIZE]
@@ -64,67 +68,59 @@ class MNISTFeedSource(InMemoryFeedSource, SupervisedSource):
         train_images = train_images[VALIDATION_SIZE:]
         train_labels = train_labels[VALIDATION_SIZE:]
 
+        # Images are memory mapped, so they are normalized, and labels are
+        # converted to one-hot vectors, batch by batch.
+        one_hot_classes = 10 if one_hot else None
         training_dataset = DataSet(train_images,
                                    train_labels,
                                    center=self.center,
-                                   scale=self.scale)
+                                   scale=self.scale,
+                                   one_hot_classes=one_hot_classes)
         validation_dataset = DataSet(validation_images,
                                      validation_labels,
                                      center=self.center,
-                                     scale=self.scale)
+                                     scale=self.scale,
+                                     one_hot_classes=one_hot_classes)
         test_dataset = DataSet(test_images,
                                test_labels,
                                center=self.center,
-                               scale=self.scale)
+                               scale=self.scale,
+                               one_hot_classes=one_hot_classes)
 
         return DataSets(training_dataset, test_dataset, validation_dataset)
 
-    def _read32(self, bytestream):
-        dt = np.dtype(np.uint32).newbyteorder('>')
-        return np.frombuffer(bytestream.read(4), dtype=dt)
-
-    def _dense_to_one_hot(self, labels_dense, num_classes=10):
-        """Convert class labels from scalars to one-hot vectors."""
-        num_labels = labels_dense.shape[0]
-        index_offset = np.arange(num_labels) * num_classes
-        labels_one_hot = np.zeros((num_labels, num_classes))
-        labels_one_hot.flat[index_offset + labels_dense.ravel()] = 1
-        return labels_one_hot
-
     def _extract_images(self, filename):
         """
         Extract the images into a 4D uint8 np array [index, y, x, depth].
+
+        The array is memory mapped from the decompressed file, see
+        `read_idx`.
+        """
+        log.info('Extracting {}'.format(filename))
+        data = read_idx(filename)
+        if data.ndim != 3 or data.dtype != np.uint8:
+            raise ValueError(
+                'Invalid MNIST image file: %s' % filename)
+        return data.reshape(data.shape + (1,))
+
+    def _extract_labels(self, filename):
         """
-        log.info('Extracting', filename)
-        with gzip.open(filename) as bytestream:
-            magic = self._read32(bytestream)
-            if magic != 2051:
-                raise ValueError(
-                    'Invalid magic number %d in MNIST image file: %s' %
-                    (magic, filename))
-            num_images = self._read32(bytestream)
-            rows = self._read32(bytestream)
-            cols = self._read32(bytestream)
-            buf = bytestream.read(rows * cols * num_images)
-            data = np.frombuffer(buf, dtype=np.uint8)
-            data = data.reshape(num_images, rows, cols, 1)
-            return data
-
-    def _extract_labels(self, filename, one_hot=False):
-        """Extract the labels into a 1D uint8 numpy array [index]."""
-        print('Extracting', filename)
-        with gzip.open(filename) as bytestream:
-            magic = self._read32(bytestream)
-            if magic != 2049:
-                raise ValueError(
-                    'Invalid magic number %d in MNIST label file: %s' %
-                    (magic, filename))
-            num_items = self._read32(bytestream)
-            buf = bytestream.read(num_items)
-            labels = np.frombuffer(buf, dtype=np.uint8)
-            if one_hot:
-                return self._dense_to_one_hot(labels)
-            return labels
+        Extract the labels into a 1D uint8 numpy array [index].
+        """
+        log.info('Extracting {}'.format(filename))
+        labels = read_idx(filename)
+        if labels.ndim != 1 or labels.dtype != np.uint8:
+            raise ValueError(
+                'Invalid MNIST label file: %s' % filename)
+        return labels
+
+
+class MNISTMemmapFeedSource(MemmapFeedSource, MNISTFeedSource):
+    """
+    A `MNISTFeedSource` that converts data to `.npy` files once, and maps them
+    into memory afterwards. See `MemmapFeedSource`.
+    """
+    pass
 
 
 class RotatedMNISTFeedSource(InMemoryFeedSource, SupervisedSource):
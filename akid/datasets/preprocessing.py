@@ -0,0 +1,267 @@
+"""
+This module holds dataset level pre-processing, which is done once before
+training, such as global contrast normalization and ZCA whitening (the common
+pre-processing done on CIFAR dataset, starting from the Maxout paper).
+
+Pre-processing is done in chunks of samples, so memory used is bounded no
+matter how large the dataset is, and results are cached on disk keyed by the
+dataset and the parameters of the pre-processing, so later runs only need to
+map the cached arrays into memory.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import cPickle as pickle
+
+import numpy as np
+
+from ..utils import glog as log
+
+
+def python_batch_chunks(filenames):
+    """
+    Yield the data array of each python pickled batch file, such as those of
+    CIFAR10 and CIFAR100.
+    """
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            yield pickle.load(f)["data"]
+
+
+def global_contrast_normalize(X,
+                              scale=1.,
+                              subtract_mean=True,
+                              use_std=True,
+                              sqrt_bias=10.,
+                              min_divisor=1e-8):
+    """
+    Normalize each sample (row) of `X` to have zero mean and certain norm. It
+    follows `global_contrast_normalize` of pylearn2.
+
+    Args:
+        X: numpy.array of shape [N, D]
+        scale: float
+            Samples are normalized to have this norm or standard deviation.
+        subtract_mean: Boolean
+            Remove the mean of each sample or not.
+        use_std: Boolean
+            Normalize by standard deviation if True, otherwise by vector norm.
+        sqrt_bias: float
+            Added to the variance or squared norm before taking square root.
+        min_divisor: float
+            Samples whose normalizer is smaller than this are left as they are.
+
+    Returns:
+        A new float64 array of normalized samples.
+    """
+    X = X.astype(np.float64)
+    if subtract_mean:
+        X -= X.mean(axis=1)[:, np.newaxis]
+    if use_std:
+        normalizers = np.sqrt(sqrt_bias + X.var(axis=1, ddof=1)) / scale
+    else:
+        normalizers = np.sqrt(sqrt_bias + (X ** 2).sum(axis=1)) / scale
+    normalizers[normalizers < min_divisor] = 1.
+    X /= normalizers[:, np.newaxis]
+
+    return X
+
+
+class ZCA(object):
+    """
+    ZCA whitening, which is fit in a streaming way over chunks of samples. It
+    follows `ZCA` of pylearn2.
+    """
+    def __init__(self, filter_bias=0.1):
+        """
+        Args:
+            filter_bias: float
+                Added to the diagonal of the covariance matrix to avoid
+                amplifying noise in directions of tiny variance.
+        """
+        self.filter_bias = filter_bias
+        self.mean = None
+        self.P = None
+
+    def fit(self, chunks):
+        """
+        Args:
+            chunks: iterable of numpy.array of shape [N_i, D]
+                Chunks of training samples.
+        """
+        num = 0
+        sum_x = None
+        sum_xx = None
+        for X in chunks:
+            if sum_x is None:
+                sum_x = np.zeros(X.shape[1])
+                sum_xx = np.zeros([X.shape[1], X.shape[1]])
+            num += X.shape[0]
+            sum_x += X.sum(axis=0)
+            sum_xx += np.dot(X.T, X)
+
+        self.mean = sum_x / num
+        cov = sum_xx / num - np.outer(self.mean, self.mean)
+        cov += self.filter_bias * np.identity(cov.shape[0])
+        eigs, eigv = np.linalg.eigh(cov)
+        self.P = np.dot(eigv / np.sqrt(eigs), eigv.T)
+
+    def transform(self, X):
+        return np.dot(X - self.mean, self.P)
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, P=self.P)
+
+    def load(self, path):
+        with np.load(path) as f:
+            self.mean = f["mean"]
+            self.P = f["P"]
+
+
+class GCNZCAWhitener(object):
+    """
+    Global contrast normalize then ZCA whiten a dataset, and cache the
+    results.
+
+    The ZCA matrix and the whitened arrays are saved under a folder named by
+    the dataset and the parameters used, so different datasets or parameters
+    do not overwrite each other. Whitened arrays are saved as raw float32
+    files in the layout of [N, H, W, C], along with a manifest holding the
+    dataset name, the number of samples and the sample shape, which is
+    written last, and checked when the cache is mapped.
+    """
+    MANIFEST_NAME = "manifest.json"
+
+    def __init__(self,
+                 scale=55.,
+                 sqrt_bias=0.,
+                 use_std=False,
+                 filter_bias=0.1,
+                 chunk_size=5000):
+        """
+        The defaults are the same with pylearn2's script to make GCN and
+        whitened CIFAR, which is used by the Maxout paper.
+
+        Args:
+            scale, sqrt_bias, use_std: See `global_contrast_normalize`.
+            filter_bias: See `ZCA`.
+            chunk_size: int
+                The maximal number of samples processed at a time.
+        """
+        self.scale = scale
+        self.sqrt_bias = sqrt_bias
+        self.use_std = use_std
+        self.filter_bias = filter_bias
+        self.chunk_size = chunk_size
+
+    def cache_name(self):
+        return "gcn_zca_scale{}_bias{}_std{}_filter{}".format(
+            self.scale, self.sqrt_bias, int(self.use_std), self.filter_bias)
+
+    def whiten(self, work_dir, name, train_chunks, test_chunks, shape):
+        """
+        Return whitened training and test data, computing them if they are
+        not cached yet.
+
+        Args:
+            work_dir: str
+                The folder to put the cache folder in.
+            name: str
+                The name of the dataset, which identifies it in the cache.
+            train_chunks, test_chunks: callable
+                Called without arguments to get an iterable of chunks of raw
+                samples, each of which is an array of shape [N_i, D]. Training
+                chunks are iterated twice, once to fit ZCA, and once to
+                transform.
+            shape: list
+                The shape [C, H, W] a raw sample is reshaped to.
+
+        Returns:
+            (train, test): read only memory mapped arrays of shape [N, H, W,
+                C].
+        """
+        cache_dir = os.path.join(work_dir,
+                                 "{}_{}".format(name, self.cache_name()))
+        train_path = os.path.join(cache_dir, "train.bin")
+        test_path = os.path.join(cache_dir, "test.bin")
+        zca_path = os.path.join(cache_dir, "zca.npz")
+        manifest_path = os.path.join(cache_dir, GCNZCAWhitener.MANIFEST_NAME)
+
+        if not os.path.exists(manifest_path):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            zca = ZCA(filter_bias=self.filter_bias)
+            if os.path.exists(zca_path):
+                zca.load(zca_path)
+            else:
+                log.info("Fitting ZCA ...")
+                zca.fit(self._gcn(train_chunks()))
+                zca.save(zca_path)
+
+            manifest = {"name": name, "shape": list(shape)}
+            for chunks, path, key in [(test_chunks, test_path, "num_test"),
+                                      (train_chunks, train_path, "num_train")]:
+                log.info("Whitening data to {} ...".format(path))
+                manifest[key] = self._transform_to_file(zca,
+                                                        chunks,
+                                                        path,
+                                                        shape)
+            # The manifest marks the cache is complete.
+            tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, manifest_path)
+
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest["name"] != name or manifest["shape"] != list(shape):
+            raise ValueError(
+                "Whitened data under {} are of dataset {} of shape {}, not"
+                " {} of shape {}.".format(cache_dir,
+                                          manifest["name"],
+                                          manifest["shape"],
+                                          name,
+                                          shape))
+        c, h, w = shape
+        return np.memmap(train_path,
+                         dtype=np.float32,
+                         mode='r',
+                         shape=(manifest["num_train"], h, w, c)),\
+            np.memmap(test_path,
+                      dtype=np.float32,
+                      mode='r',
+                      shape=(manifest["num_test"], h, w, c))
+
+    def _split(self, chunks):
+        for X in chunks:
+            for i in xrange(0, X.shape[0], self.chunk_size):
+                yield X[i:i+self.chunk_size]
+
+    def _gcn(self, chunks):
+        for X in self._split(chunks):
+            yield global_contrast_normalize(X,
+                                            scale=self.scale,
+                                            use_std=self.use_std,
+                                            sqrt_bias=self.sqrt_bias)
+
+    def _transform_to_file(self, zca, chunks, path, shape):
+        """
+        Whiten chunks and append them to a raw float32 file one by one, so raw
+        data need not be read again to count samples before writing.
+
+        Returns:
+            The number of samples written.
+        """
+        c, h, w = shape
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        num = 0
+        with open(tmp_path, "wb") as f:
+            for X in self._gcn(chunks()):
+                X = zca.transform(X).reshape([-1, c, h, w])
+                np.einsum("nchw->nhwc", X).astype(np.float32).tofile(f)
+                num += X.shape[0]
+        os.rename(tmp_path, path)
+
+        return num
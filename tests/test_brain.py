@@ -1,7 +1,9 @@
 import tensorflow as tf
 
 from akid.utils.test import AKidTestCase, TestFactory, main
-from akid import Brain, FeedSensor, MomentumKongFu, Kid
+from akid import Brain, FeedSensor, MomentumKongFu, Kid, SummaryPolicy
+from akid.core.common import TRAIN_SUMMARY_COLLECTION
+from akid.core.summaries import kind_collection
 from akid.layers import (
     ConvolutionLayer,
     PoolingLayer,
@@ -116,5 +118,26 @@ class TestBrain(AKidTestCase):
             print(W_norm)
             assert W_norm <= 1
 
+    def test_summary_policy(self):
+        brain = TestFactory.get_test_brain()
+        brain.summary_policy = SummaryPolicy(
+            kinds=["sparsity", "loss", "eval"],
+            layers={"sparsity": ["conv"]},
+            steps={"sparsity": 50})
+        source = TestFactory.get_test_feed_source()
+        kid = TestFactory.get_test_kid(source, brain)
+        kid.setup()
+
+        summary_ops = kid.graph.get_collection(TRAIN_SUMMARY_COLLECTION)
+        assert len(summary_ops) > 0
+        for op in summary_ops:
+            assert op.op.type != "HistogramSummary"
+        sparsity_ops = kid.graph.get_collection(kind_collection("sparsity"))
+        assert len(sparsity_ops) > 0
+        for op in sparsity_ops:
+            assert "conv" in op.op.name
+        assert 50 in kid.periodic_summary_ops
+        kid.sensor.teardown()
+
 if __name__ == "__main__":
     main()
@@ -1,3 +1,6 @@
+import socket
+import multiprocessing
+
 from akid import (
     Kid,
     FeedSensor,
@@ -10,6 +13,66 @@ from akid.models import LeNet
 from akid.utils.test import AKidTestCase, TestFactory, main
 
 
+def _free_port():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _get_test_kid(engine, log_dir):
+    return Kid(
+        FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                   name='data'),
+        TestFactory.get_test_brain(),
+        MomentumKongFu(),
+        engine=engine,
+        log_dir=log_dir,
+        max_steps=900)
+
+
+def _assert_grads_are_batch_mean(kid):
+    """
+    Assert gradients reduced by the engine of `kid` equal gradients of the
+    mean loss over the whole batch.
+    """
+    import numpy as np
+    import tensorflow as tf
+    grads_and_vars = [(g, v) for g, v in kid.engine.grads if g is not None]
+    grads = [g for g, _ in grads_and_vars]
+    with kid.graph.as_default():
+        expected = tf.gradients(kid.engine.loss(),
+                                [v for _, v in grads_and_vars])
+    kid.init()
+    values = kid.sess.run(grads + expected,
+                          feed_dict=kid.sensor.fill_feed_dict())
+    for g, e in zip(values[:len(grads)], values[len(grads):]):
+        assert np.allclose(g, e, rtol=1e-4, atol=1e-6)
+
+
+def _run_ps_task(engine_name, cluster, job_name, task_index):
+    """
+    Train as a task of a cluster in its own process.
+    """
+    kid = Kid(
+        FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                   name='data'),
+        TestFactory.get_test_brain(),
+        MomentumKongFu(),
+        engine={"name": engine_name,
+                "cluster": cluster,
+                "job_name": job_name,
+                "task_index": task_index},
+        log_dir="log_test_{}_{}_{}".format(engine_name, job_name, task_index),
+        max_steps=300)
+    kid.setup()
+    loss = kid.practice()
+    if kid.engine.is_chief:
+        assert loss < 0.2
+    kid.sensor.teardown()
+
+
 class TestEngine(AKidTestCase):
     def test_data_parallel(self):
         brain = LeNet(name="LeNet")
@@ -31,6 +94,72 @@ class TestEngine(AKidTestCase):
         loss = kid.practice()
         assert loss < 3
 
+    def test_bucketed_reduce(self):
+        # Weights and biases of the test brain take a bucket each with the
+        # tiny bucket size, and share one with the large one.
+        for method in ["central", "tree", "ring"]:
+            for bucket_size in [1, 2**16]:
+                kid = _get_test_kid(
+                    {"name": "data_parallel",
+                     "num_gpu": 2,
+                     "reduce_method": method,
+                     "bucket_size": bucket_size},
+                    "log_test_{}_reduce_{}".format(method, bucket_size))
+                kid.setup()
+                _assert_grads_are_batch_mean(kid)
+                kid.sensor.teardown()
+
+    def test_cpu_data_parallel(self):
+        kid = _get_test_kid({"name": "cpu_data_parallel", "num_cpu": 2},
+                            "log_test_cpu_data_parallel")
+        kid.setup()
+        for t in kid.engine.train_towers:
+            assert "cpu" in t.data.device.lower()
+        _assert_grads_are_batch_mean(kid)
+        kid.sensor.teardown()
+
+    def test_uneven_split(self):
+        kid = _get_test_kid({"name": "data_parallel",
+                             "num_gpu": 2,
+                             "split_ratios": [3, 1]},
+                            "log_test_uneven_split")
+        kid.setup()
+        sizes = [t.data.get_shape().as_list()[0]
+                 for t in kid.engine.train_towers]
+        assert sum(sizes) == kid.sensor.batch_size
+        assert sizes[0] > sizes[1]
+        # The weighted average of towers is the gradient of the whole batch.
+        _assert_grads_are_batch_mean(kid)
+        kid.sensor.teardown()
+
+        engine = kid.engine
+        engine.split_ratios = [1, 2]
+        assert engine._split_sizes(10) == [3, 7]
+        for ratios in [[1, 2], [3, 1], [1, 1]]:
+            engine.split_ratios = ratios
+            for batch_size in [2, 7, 10, 99, 100]:
+                assert sum(engine._split_sizes(batch_size)) == batch_size
+
+    def test_ps_engines(self):
+        for name in ["ps_async", "ps_sync"]:
+            cluster = {"ps": ["localhost:{}".format(_free_port())],
+                       "worker": ["localhost:{}".format(_free_port())
+                                  for _ in xrange(0, 2)]}
+            ps = multiprocessing.Process(target=_run_ps_task,
+                                         args=(name, cluster, "ps", 0))
+            workers = [multiprocessing.Process(
+                target=_run_ps_task,
+                args=(name, cluster, "worker", i)) for i in xrange(0, 2)]
+            ps.start()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join(timeout=600)
+            # Parameter servers serve till they are killed.
+            ps.terminate()
+            for w in workers:
+                assert w.exitcode == 0
+
 
 if __name__ == "__main__":
     main()
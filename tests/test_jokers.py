@@ -1,3 +1,6 @@
+import numpy as np
+import tensorflow as tf
+
 from akid.utils.test import AKidTestCase, TestFactory, main
 from akid import (
     IntegratedSensor,
@@ -5,6 +8,12 @@ from akid import (
     Kid,
     GradientDescentKongFu
 )
+from akid.core.jokers import (
+    JokerSystem,
+    CropJoker,
+    FlipJoker,
+    WhitenJoker
+)
 from akid.models.brains import AlexNet
 from akid import LearningRateScheme
 
@@ -41,6 +50,31 @@ class TestJoker(AKidTestCase):
         loss = kid.practice()
         assert loss < 3
 
+    def test_batch_mode(self):
+        batch = np.random.uniform(0, 255, [16, 32, 32, 3]).astype(np.float32)
+        with tf.Graph().as_default():
+            data = tf.constant(batch)
+            jokers = JokerSystem(batch_mode=True, name="jokers")
+            jokers.attach(CropJoker(height=24, width=24, name="crop"))
+            jokers.attach(FlipJoker(name="flip"))
+            jokers.setup(data)
+            whiten = WhitenJoker(name="whiten")
+            whiten.setup(data)
+            expected = [tf.image.per_image_standardization(d)
+                        for d in tf.unpack(data)]
+            with tf.Session() as sess:
+                cropped, whitened, expected = sess.run(
+                    [jokers.data, whiten.data, expected])
+
+        assert cropped.shape == (16, 24, 24, 3)
+        # Each sample is a window of the original or of its flip.
+        for i in xrange(16):
+            windows = [batch[i, h:h+24, w:w+24, :]
+                       for h in xrange(9) for w in xrange(9)]
+            windows.extend([w[:, ::-1, :] for w in windows])
+            assert any(np.allclose(cropped[i], w) for w in windows)
+        assert np.allclose(whitened, np.stack(expected), atol=1e-4)
+
 
 if __name__ == "__main__":
     main()
@@ -3,12 +3,24 @@ import os
 from akid import (
     Kid,
     FeedSensor,
-    MomentumKongFu
+    MomentumKongFu,
+    run_evaluator
 )
 
 from akid.utils.test import AKidTestCase, TestFactory, main
 
 
+def _get_test_evaluator():
+    return Kid(
+        FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                   name='data'),
+        TestFactory.get_test_brain(),
+        MomentumKongFu(),
+        log_dir="log_test_run_evaluator",
+        log_to_file=False,
+        max_steps=900)
+
+
 class TestKid(AKidTestCase):
     def test_core(self):
         brain = TestFactory.get_test_brain()
@@ -32,6 +44,311 @@ class TestKid(AKidTestCase):
         loss = kid.validate()
         assert loss < 0.2
 
+    def test_val_remainder(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        # 5000 validation samples do not divide into batches of 300.
+        kid = Kid(
+            FeedSensor(source_in=source, val_batch_size=300, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900)
+        kid.setup()
+        assert kid.sensor.val_remainder == 200
+        assert kid.engine.val_remainder_brain is not None
+        # Accumulators are only set up if validation is accumulated on
+        # device.
+        import tensorflow as tf
+        with kid.graph.as_default():
+            for v in tf.local_variables():
+                assert "val_accumulators" not in v.op.name
+
+        loss = kid.practice()
+        assert loss < 0.2
+
+    def test_accumulate_val_on_device(self):
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, val_batch_size=300, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900,
+            accumulate_val_on_device=True)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+        evals = list(kid.evals)
+
+        # The results should be the same with those accumulated in python.
+        kid.accumulate_val_on_device = False
+        assert abs(kid.validate() - loss) < 1e-4
+        for a, b in zip(kid.evals, evals):
+            assert abs(a - b) < 1e-4
+
+    def test_async_saver(self):
+        import tensorflow as tf
+        brain = TestFactory.get_test_brain()
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            brain,
+            MomentumKongFu(),
+            max_steps=900,
+            val_log_step=100,
+            async_chk_point=True,
+            keep_last_chk_points=2,
+            keep_best_chk_points=1)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 0.2
+
+        checkpoint = tf.train.get_checkpoint_state(kid.model_dir)
+        assert len(checkpoint.all_model_checkpoint_paths) <= 3
+        assert checkpoint.model_checkpoint_path.endswith("-900")
+
+        kid.restore_from_ckpt()
+        loss = kid.validate()
+        assert loss < 0.2
+
+    def test_async_saver_failed_snapshot(self):
+        import tempfile
+        import tensorflow as tf
+        from akid.core.savers import AsyncSaver
+        save_path = os.path.join(tempfile.mkdtemp(), "model")
+        with tf.Graph().as_default():
+            v = tf.Variable(tf.zeros([2]), name="v")
+            saver = AsyncSaver([v], max_in_flight=1)
+            with tf.Session() as sess:
+                # Snapshotting uninitialized variables fails.
+                for _ in xrange(2):
+                    with self.assertRaises(tf.errors.FailedPreconditionError):
+                        saver.save(sess, save_path, 0)
+                # The slot in flight is released by the failed snapshots, so
+                # saving does not block.
+                sess.run(tf.global_variables_initializer())
+                saver.save(sess, save_path, 1)
+            saver.close()
+        assert tf.train.checkpoint_exists(save_path + "-1")
+
+    def test_resume_data_order(self):
+        import glob
+        import shutil
+        import numpy as np
+
+        def get_kid(log_dir, max_steps):
+            source = TestFactory.get_test_feed_source()
+            source.seed = 1
+            # Batches prefetched ahead of the checkpoint should not be
+            # counted as consumed.
+            return Kid(
+                FeedSensor(source_in=source, prefetch_size=4, name='data'),
+                TestFactory.get_test_brain(),
+                MomentumKongFu(),
+                log_dir=log_dir,
+                max_steps=max_steps,
+                val_log_step=100,
+                keep_last_chk_points=2)
+
+        def record_batches(kid):
+            batches = []
+            forward_backward = kid.forward_backward
+
+            def recorded_forward_backward():
+                forward_backward()
+                batches.append(kid.feed_dict[kid.sensor.data()])
+            kid.forward_backward = recorded_forward_backward
+            return batches
+
+        shutil.rmtree("log_test_resume_data_order", ignore_errors=True)
+        shutil.rmtree("log_test_resume_data_order_uninterrupted",
+                      ignore_errors=True)
+
+        # An uninterrupted run.
+        kid = get_kid("log_test_resume_data_order_uninterrupted", 200)
+        kid.setup()
+        expected = record_batches(kid)
+        kid.practice()
+        kid.teardown()
+
+        # The same run, stopped at step 100 ...
+        kid = get_kid("log_test_resume_data_order", 100)
+        kid.setup()
+        kid.practice()
+        kid.teardown()
+        assert len(glob.glob(kid.model_dir + "/*.source_state.json")) == 2
+
+        # ... and resumed from the checkpoint of the step.
+        resumed_kid = get_kid("log_test_resume_data_order", 200)
+        resumed_kid.setup()
+        batches = record_batches(resumed_kid)
+        resumed_kid.practice(continue_from_chk_point=True)
+        # Source states of checkpoints pruned are deleted with them.
+        assert len(glob.glob(
+            resumed_kid.model_dir + "/*.source_state.json")) == 2
+        resumed_kid.teardown()
+
+        # Logging the initial loss takes no batch away from training, so the
+        # resumed run trains on the same batches with the uninterrupted one.
+        assert len(batches) == 101
+        for a, b in zip(batches, expected[100:]):
+            assert np.array_equal(a, b)
+
+    def test_val_in_background(self):
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            log_dir="log_test_val_in_background",
+            max_steps=900,
+            val_in_background=True)
+        kid.setup()
+        assert kid.practice() is None
+
+        # Evaluate the checkpoints saved by the above kid.
+        evaluator = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            log_dir="log_test_val_in_background",
+            log_to_file=False,
+            max_steps=900,
+            evaluate_only=True)
+        evaluator.setup()
+        evaluator.evaluate(poll_interval=1, timeout=0)
+        assert evaluator.step == 900
+        assert evaluator.loss_value < 0.2
+        # The evaluator never trains, so it does not prefetch training data.
+        assert not evaluator.sensor.is_prefetching
+        evaluator.teardown()
+
+    def test_run_evaluator(self):
+        import glob
+        import shutil
+        import tensorflow as tf
+        shutil.rmtree("log_test_run_evaluator", ignore_errors=True)
+        # The evaluator is forked before the training kid has a session.
+        evaluator = run_evaluator(_get_test_evaluator,
+                                  poll_interval=1,
+                                  timeout=600)
+        kid = Kid(
+            FeedSensor(source_in=TestFactory.get_test_feed_source(),
+                       name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            log_dir="log_test_run_evaluator",
+            max_steps=900,
+            val_in_background=True)
+        kid.setup()
+        assert kid.practice() is None
+        kid.sensor.teardown()
+        evaluator.join(timeout=600)
+        assert evaluator.exitcode == 0
+
+        def val_loss_steps(summary_dir):
+            steps = set()
+            for path in glob.glob(summary_dir + "/events.out.tfevents.*"):
+                for event in tf.train.summary_iterator(path):
+                    for value in event.summary.value:
+                        if value.tag == "Validation Loss":
+                            steps.add(event.step)
+            return steps
+
+        # Events of the evaluator are kept apart from those of the trainer.
+        assert 900 in val_loss_steps(kid.log_dir + "/eval")
+        assert not val_loss_steps(kid.log_dir)
+
+    def test_profile(self):
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            log_dir="log_test_profile",
+            max_steps=900,
+            profile=True,
+            trace_step=300)
+        kid.setup()
+        loss = kid.practice()
+        assert loss < 0.2
+
+        stats = kid.profiler.stats()
+        for phase in ["feed", "run", "hooks", "val", "ckpt", "summary"]:
+            assert phase in stats
+        assert stats["run"]["count"] == 900
+        assert stats["run"]["p50"] <= stats["run"]["p99"]
+        assert os.path.exists(kid.log_dir + "/traces/timeline_300.json")
+        kid.sensor.teardown()
+
+    def test_summary_steps(self):
+        import glob
+        import tensorflow as tf
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(),
+            log_dir="log_test_summary_steps",
+            train_log_step=20,
+            summary_steps={"histogram": 50, "scalar": 10},
+            max_steps=200)
+        kid.setup()
+
+        # Count runs of the graph made by logging.
+        runs = [0]
+        run = kid.sess.run
+
+        def counted_run(*args, **kwargs):
+            runs[0] += 1
+            return run(*args, **kwargs)
+        kid.sess.run = counted_run
+        log_runs = [0]
+        on_train_log_step = kid.on_train_log_step
+
+        def counted_on_train_log_step():
+            num_runs = runs[0]
+            on_train_log_step()
+            log_runs[0] += runs[0] - num_runs
+        kid.on_train_log_step = counted_on_train_log_step
+
+        kid.practice()
+        assert log_runs[0] == 0
+
+        histogram_steps = set()
+        scalar_steps = set()
+        for path in glob.glob(kid.log_dir + "/events.out.tfevents.*"):
+            for event in tf.train.summary_iterator(path):
+                for value in event.summary.value:
+                    if value.HasField("histo"):
+                        histogram_steps.add(event.step)
+                    elif value.HasField("simple_value"):
+                        scalar_steps.add(event.step)
+        # Summaries of every kind are collected at the initial step.
+        assert histogram_steps == {0, 50, 100, 150, 200}
+        assert 10 in scalar_steps
+        for step in scalar_steps:
+            assert step % 10 == 0
+        kid.sensor.teardown()
+
+    def test_accum_grads(self):
+        source = TestFactory.get_test_feed_source()
+        kid = Kid(
+            FeedSensor(source_in=source, name='data'),
+            TestFactory.get_test_brain(),
+            MomentumKongFu(accum_steps=3),
+            log_dir="log_test_accum_grads",
+            max_steps=300)
+        kid.setup()
+        loss = kid.practice()
+        assert loss < 0.2
+
+        # Global step only increases once every `accum_steps` batches.
+        assert kid.sess.run(kid.global_step_tensor) == kid.step
+        kid.sensor.teardown()
+
     def test_log_to_file_flag(self):
         brain = TestFactory.get_test_brain()
         source = TestFactory.get_test_feed_source()
@@ -0,0 +1,111 @@
+import tempfile
+
+import numpy as np
+
+from akid.utils.test import AKidTestCase, main
+from akid.datasets.preprocessing import (
+    global_contrast_normalize,
+    ZCA,
+    GCNZCAWhitener
+)
+
+
+class TestPreprocessing(AKidTestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Correlated samples, so whitening is not trivial.
+        self.X = np.dot(rng.randn(300, 12), rng.randn(12, 12)) + 3.
+
+    def test_global_contrast_normalize(self):
+        X = global_contrast_normalize(self.X,
+                                      scale=55.,
+                                      use_std=False,
+                                      sqrt_bias=0.)
+        assert np.allclose(X.mean(axis=1), 0)
+        assert np.allclose(np.sqrt((X ** 2).sum(axis=1)), 55.)
+        # The input is not modified.
+        assert not np.allclose(self.X.mean(axis=1), 0)
+
+    def test_zca_fit(self):
+        zca = ZCA(filter_bias=0.1)
+        zca.fit([self.X[:70], self.X[70:200], self.X[200:]])
+
+        mean = self.X.mean(axis=0)
+        cov = np.cov(self.X, rowvar=False, bias=True) + 0.1 * np.identity(12)
+        eigs, eigv = np.linalg.eigh(cov)
+        P = np.dot(eigv / np.sqrt(eigs), eigv.T)
+        assert np.allclose(zca.mean, mean)
+        assert np.allclose(zca.P, P)
+
+    def test_zca_whitened_covariance(self):
+        zca = ZCA(filter_bias=0.)
+        zca.fit([self.X[:100], self.X[100:]])
+        X = zca.transform(self.X)
+        assert np.allclose(X.mean(axis=0), 0)
+        assert np.allclose(np.cov(X, rowvar=False, bias=True),
+                           np.identity(12),
+                           atol=1e-6)
+
+    def test_whitener_cache(self):
+        work_dir = tempfile.mkdtemp()
+        calls = [0]
+
+        def chunks(X):
+            def get():
+                calls[0] += 1
+                return [X[:100], X[100:]]
+            return get
+
+        whitener = GCNZCAWhitener(chunk_size=30)
+        train, test = whitener.whiten(work_dir,
+                                      "toy",
+                                      chunks(self.X[:250]),
+                                      chunks(self.X[250:]),
+                                      [3, 2, 2])
+        assert train.shape == (250, 2, 2, 3)
+        assert test.shape == (50, 2, 2, 3)
+        # Raw data are read once to fit, and once to transform each split.
+        assert calls[0] == 3
+
+        # A second whitener with the same parameters maps the cache without
+        # reading raw data.
+        cached_train, cached_test = GCNZCAWhitener(chunk_size=30).whiten(
+            work_dir,
+            "toy",
+            chunks(self.X[:250]),
+            chunks(self.X[250:]),
+            [3, 2, 2])
+        assert calls[0] == 3
+        assert type(cached_train) is np.memmap
+        assert (cached_train == train).all()
+        assert (cached_test == test).all()
+
+        # Other datasets or parameters do not share the cache.
+        other_train, _ = GCNZCAWhitener(chunk_size=30).whiten(
+            work_dir,
+            "other_toy",
+            chunks(self.X[:200]),
+            chunks(self.X[200:]),
+            [3, 2, 2])
+        assert calls[0] == 6
+        assert other_train.shape == (200, 2, 2, 3)
+        GCNZCAWhitener(scale=1., chunk_size=30).whiten(
+            work_dir,
+            "toy",
+            chunks(self.X[:250]),
+            chunks(self.X[250:]),
+            [3, 2, 2])
+        assert calls[0] == 9
+
+        # The manifest refuses a cache of another shape.
+        self.assertRaises(ValueError,
+                          GCNZCAWhitener(chunk_size=30).whiten,
+                          work_dir,
+                          "toy",
+                          chunks(self.X[:250]),
+                          chunks(self.X[250:]),
+                          [12, 1, 1])
+
+
+if __name__ == "__main__":
+    main()
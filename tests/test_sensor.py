@@ -1,6 +1,10 @@
+import numpy as np
+import tensorflow as tf
+
 from akid.utils.test import AKidTestCase, TestFactory, main
 from akid import (
     IntegratedSensor,
+    DatasetSensor,
     FeedSensor,
     Kid,
     GradientDescentKongFu,
@@ -12,11 +16,29 @@ from akid.core.jokers import (
     FlipJoker,
     LightJoker
 )
+from akid.core.feed_jokers import (
+    FeedCropJoker,
+    FeedWhitenJoker,
+)
 
+from akid.core.sources import ClassificationTFSource
 from akid.models.brains import AlexNet
 from akid import LearningRateScheme
 
 
+class _Uint8TFSource(ClassificationTFSource):
+    """
+    A source of random uint8 images held in memory.
+    """
+    def _setup(self):
+        images = np.random.randint(0, 256, [self.num_train, 4, 4, 3])
+        image, label = tf.train.slice_input_producer(
+            [images.astype(np.uint8), np.arange(self.num_train,
+                                                dtype=np.int32)])
+        self._training_datum = self._val_datum = image
+        self._training_label = self._val_label = label
+
+
 class TestFeedSensor(AKidTestCase):
     def setUp(self):
         super(TestFeedSensor, self).setUp()
@@ -62,6 +84,60 @@ class TestFeedSensor(AKidTestCase):
         kid.practice()
 
 
+    def test_prefetch(self):
+        source = TestFactory.get_test_feed_source()
+        sensor = FeedSensor(source_in=source,
+                            batch_size=128,
+                            val_batch_size=100,
+                            prefetch_size=8,
+                            num_prefetch_threads=2,
+                            name="data")
+        kid = Kid(
+            sensor,
+            self.brain,
+            MomentumKongFu(),
+            max_steps=900,
+            summary_on_val=True)
+        kid.setup()
+        loss = kid.practice()
+
+        assert sensor.is_prefetching
+        assert sensor.prefetch_stats["gets"] > 0
+        assert loss < 0.2
+
+        sensor.stop_prefetch()
+        assert not sensor.is_prefetching
+
+    def test_augmentation(self):
+        source = TestFactory.get_test_feed_source()
+        sensor = FeedSensor(source_in=source,
+                            batch_size=128,
+                            val_batch_size=100,
+                            num_augment_processes=2,
+                            name="data")
+        sensor.attach(FeedCropJoker(height=24, width=24,
+                                    center=True, name="crop"),
+                      to_val=True)
+        sensor.attach(FeedWhitenJoker(name="per_image_whitening"),
+                      to_val=True)
+        sensor.attach(FeedCropJoker(height=24, width=24, name="crop"))
+        sensor.attach(FeedWhitenJoker(name="per_image_whitening"))
+
+        kid = Kid(
+            sensor,
+            self.brain,
+            MomentumKongFu(),
+            max_steps=900)
+        kid.setup()
+        assert sensor.data().get_shape().as_list() == [128, 24, 24, 1]
+        assert sensor.data(get_val=True).get_shape().as_list() \
+            == [100, 24, 24, 1]
+
+        loss = kid.practice()
+        sensor.teardown()
+        assert loss < 0.2
+
+
 class TestIntegratedSensor(AKidTestCase):
     def setUp(self):
         super(TestIntegratedSensor, self).setUp()
@@ -118,5 +194,124 @@ class TestIntegratedSensor(AKidTestCase):
 
         kid.practice()
 
+    def test_queue_stats(self):
+        self.sensor.measure_dequeue_wait = True
+        kid = Kid(
+            self.sensor,
+            self.brain,
+            GradientDescentKongFu(
+                lr_scheme={"name": LearningRateScheme.exp_decay,
+                           "base_lr": 0.1,
+                           "decay_rate": 0.1,
+                           "num_batches_per_epoch": 391,
+                           "decay_epoch_num": 350}),
+            max_steps=200)
+        kid.setup()
+        kid.practice()
+
+        stats = self.sensor.queue_stats
+        assert stats["dequeues"] == 200
+        assert stats["capacity"] > 0
+        assert 0 <= stats["fraction"] <= 1
+        assert stats["wait_time"] >= 0
+
+    def test_auto_tune(self):
+        self.sensor.measure_dequeue_wait = True
+        self.sensor.auto_tune = True
+        self.sensor.tune_steps = 200
+        kid = Kid(
+            self.sensor,
+            self.brain,
+            GradientDescentKongFu(
+                lr_scheme={"name": LearningRateScheme.exp_decay,
+                           "base_lr": 0.1,
+                           "decay_rate": 0.1,
+                           "num_batches_per_epoch": 391,
+                           "decay_epoch_num": 350}),
+            max_steps=300)
+        kid.setup()
+        kid.practice()
+
+        tuner = self.sensor.queue_tuner
+        assert not tuner.is_tuning
+        assert 1 <= tuner.num_threads <= tuner.max_threads
+        assert tuner.capacity <= tuner.max_capacity
+
+        threads = tuner._threads
+        kid.teardown()
+        for t in threads:
+            assert not t.is_alive()
+
+
+class TestDatasetSensor(AKidTestCase):
+    def setUp(self):
+        super(TestDatasetSensor, self).setUp()
+        self.brain = AlexNet(name="AlexNet")
+        source = TestFactory.get_test_tf_source()
+
+        sensor = DatasetSensor(source_in=source,
+                               batch_size=128,
+                               val_batch_size=100,
+                               num_parallel_reads=2,
+                               name='data')
+        sensor.attach(CropJoker(height=24, width=24,
+                                center=True, name="crop"),
+                      to_val=True)
+        sensor.attach(WhitenJoker(name="per_image_whitening"), to_val=True)
+
+        sensor.attach(CropJoker(height=24, width=24, name="crop"))
+        sensor.attach(FlipJoker(name="left_right_flip"))
+        sensor.attach(LightJoker(name="brightness_contrast"))
+        sensor.attach(WhitenJoker(name="per_image_whitening"))
+
+        self.sensor = sensor
+
+    def test_core(self):
+        kid = Kid(
+            self.sensor,
+            self.brain,
+            GradientDescentKongFu(
+                lr_scheme={"name": LearningRateScheme.exp_decay,
+                           "base_lr": 0.1,
+                           "decay_rate": 0.1,
+                           "num_batches_per_epoch": 391,
+                           "decay_epoch_num": 350}),
+            max_steps=1000)
+        kid.setup()
+
+        loss = kid.practice()
+        assert loss < 3.4
+
+        threads = self.sensor._threads
+        self.sensor.teardown()
+        for t in threads:
+            assert not t.is_alive()
+
+    def test_batch_jokers_dtype(self):
+        with tf.Graph().as_default():
+            sensor = DatasetSensor(
+                source_in=_Uint8TFSource(name="uint8",
+                                         url=None,
+                                         num_train=64,
+                                         num_val=64),
+                batch_size=16,
+                val_batch_size=16,
+                shuffle_buffer=32,
+                batch_jokers=True,
+                name='data')
+            # Whitening turns uint8 batches into float32 ones.
+            sensor.attach(WhitenJoker(name="per_image_whitening"))
+            sensor.attach(WhitenJoker(name="per_image_whitening"),
+                          to_val=True)
+            sensor.setup()
+            assert sensor.data().dtype == tf.float32
+            with tf.Session() as sess:
+                sensor.start(sess)
+                data = sess.run(sensor.data())
+                sensor.teardown()
+        assert data.shape == (16, 4, 4, 3)
+        assert np.allclose(data.mean(axis=(1, 2, 3)), 0, atol=1e-5)
+        assert np.allclose(data.std(axis=(1, 2, 3)), 1, atol=1e-3)
+
 if __name__ == "__main__":
     main()
@@ -8,10 +8,196 @@ from akid.utils.test import AKidTestCase, main
 from akid.datasets import Cifar10FeedSource, Cifar10TFSource
 from akid.datasets import Cifar100TFSource
 from akid.datasets import MNISTFeedSource, RotatedMNISTFeedSource
+from akid.datasets import MNISTMemmapFeedSource
 from akid import LearningRateScheme
+from akid.core.sources import (
+    InMemoryFeedSource,
+    MemmapFeedSource,
+    SupervisedSource,
+    ClassificationTFSource
+)
+
+
+class _ToyFeedSource(InMemoryFeedSource, SupervisedSource):
+    """
+    A small source whose data are shifted by `offset`.
+    """
+    def __init__(self, offset=0, **kwargs):
+        super(_ToyFeedSource, self).__init__(**kwargs)
+        self.offset = offset
+
+    @property
+    def shape(self):
+        return [2, 2, 1]
+
+    @property
+    def label_shape(self):
+        return [1]
+
+    def _load(self):
+        from akid.datasets.datasets import DataSet, DataSets
+        num = self.num_train + self.num_val
+        images = np.arange(num * 4, dtype=np.float32).reshape([num, 2, 2, 1])
+        images += self.offset
+        labels = np.arange(num)
+        return DataSets(
+            DataSet(images[:self.num_train], labels[:self.num_train]),
+            DataSet(images[self.num_train:], labels[self.num_train:]))
+
+
+class _ToyMemmapFeedSource(MemmapFeedSource, _ToyFeedSource):
+    pass
+
+
+class _ToyTFSource(ClassificationTFSource):
+    """
+    A source converting `images` and `labels` in memory to tfrecords, and
+    reading them in order.
+    """
+    RECORD_NAME = "toy"
+
+    def __init__(self, images, labels, **kwargs):
+        super(_ToyTFSource, self).__init__(**kwargs)
+        self.images = images
+        self.labels = labels
+
+    def _setup(self):
+        if not self._tfrecords_exist(_ToyTFSource.RECORD_NAME):
+            self._convert_to_tf(self.images,
+                                self.labels,
+                                _ToyTFSource.RECORD_NAME)
+        shape = list(self.images.shape[1:])
+        serialized_example = self._read_serialized_example(
+            self._tfrecord_filenames(_ToyTFSource.RECORD_NAME),
+            shuffle=False)
+        features = tf.parse_single_example(
+            serialized_example,
+            features={
+                'image_raw': self._image_raw_feature(shape),
+                'label': tf.FixedLenFeature([], tf.int64),
+            })
+        self._training_datum = self._decode_image_raw(features["image_raw"],
+                                                      shape)
+        self._training_label = tf.cast(features['label'], tf.int32)
+        self._val_datum = self._training_datum
+        self._val_label = self._training_label
+
+
+def _read_toy_records(num, **kwargs):
+    """
+    Set up a `_ToyTFSource` in a new graph, and return it along with
+    images of `num` examples read from it, ordered by labels.
+    """
+    with tf.Graph().as_default():
+        source = _ToyTFSource(name="toy", url=None, **kwargs)
+        source.setup()
+        with tf.Session() as sess:
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+            read = [sess.run([source.training_datum, source.training_label])
+                    for _ in xrange(0, num)]
+            coord.request_stop()
+            coord.join(threads)
+
+    read.sort(key=lambda r: r[1])
+    return source, np.array([r[0] for r in read]), [r[1] for r in read]
 
 
 class TestSource(AKidTestCase):
+    def test_shuffle_by_index(self):
+        from akid.datasets.datasets import DataSet
+        images = np.arange(100 * 4, dtype=np.float32).reshape([100, 2, 2, 1])
+        labels = np.arange(100)
+        dataset = DataSet(images, labels, shuffle_by_index=True)
+        # Go through several epochs, and check images and labels are still
+        # paired.
+        for _ in xrange(0, 20):
+            imgs, lbls = dataset.next_batch(32)
+            assert (imgs[:, 0, 0, 0] == lbls * 4).all()
+        # The original data should not be touched.
+        assert (dataset.images == images).all()
+        assert (dataset.labels == labels).all()
+
+    def test_dataset_state(self):
+        from akid.datasets.datasets import DataSet
+        images = np.arange(100, dtype=np.float32).reshape([100, 1, 1, 1])
+        labels = np.arange(100)
+        for shuffle_by_index in [False, True]:
+            dataset = DataSet(images, labels,
+                              shuffle_by_index=shuffle_by_index,
+                              seed=1)
+            for _ in xrange(0, 10):
+                dataset.next_batch(32)
+            state = dataset.get_state()
+            batches = [dataset.next_batch(32)[1].copy()
+                       for _ in xrange(0, 10)]
+            # A dataset restored from the state should give the same batches.
+            restored = DataSet(images, labels,
+                               shuffle_by_index=shuffle_by_index)
+            restored.next_batch(32)
+            restored.set_state(state)
+            for b in batches:
+                assert (restored.next_batch(32)[1] == b).all()
+
+    def test_read_idx(self):
+        import gzip
+        import os
+        import struct
+        import tempfile
+        from akid.datasets.idx import read_idx
+        images = np.random.randint(0, 256, [10, 28, 28]).astype(np.uint8)
+        work_dir = tempfile.mkdtemp()
+        filename = os.path.join(work_dir, "images-idx3-ubyte.gz")
+        with gzip.open(filename, "wb") as f:
+            f.write(struct.pack(">BBBB", 0, 0, 0x08, 3))
+            f.write(struct.pack(">III", *images.shape))
+            f.write(images.tobytes())
+        data = read_idx(filename)
+        assert data.shape == images.shape
+        assert (data == images).all()
+        # The second read should map the decompressed file directly.
+        assert os.path.exists(filename[:-3])
+        assert (read_idx(filename) == images).all()
+
+    def test_memmap_dataset(self):
+        import tempfile
+        from akid.datasets.datasets import DataSet
+        images = np.lib.format.open_memmap(tempfile.mktemp(suffix=".npy"),
+                                           mode="w+",
+                                           dtype=np.uint8,
+                                           shape=(50, 2, 2, 1))
+        images[:] = np.arange(50 * 4).reshape([50, 2, 2, 1])
+        labels = np.arange(50) % 10
+        dataset = DataSet(images,
+                          labels,
+                          scale=True,
+                          one_hot_classes=10,
+                          seed=1)
+        # Normalization and one-hot conversion are left to batches.
+        assert type(dataset.images) is np.memmap
+        assert dataset.labels.ndim == 1
+        assert dataset.shuffle_by_index
+        for _ in xrange(0, 5):
+            imgs, lbls = dataset.next_batch(20)
+            assert imgs.dtype == np.float32
+            assert lbls.shape == (20, 10)
+            assert (lbls.argmax(axis=1)
+                    == (imgs[:, 0, 0, 0] * 255 / 4).round() % 10).all()
+        assert type(dataset.images) is np.memmap
+
+    def test_mnist_feed_source_memmap(self):
+        source = MNISTFeedSource(
+            name="MNIST_feed",
+            url='http://yann.lecun.com/exdb/mnist/',
+            num_train=50000,
+            num_val=5000,
+            scale=True)
+        source.setup()
+        assert type(source.get_all(train=True).images) is np.memmap
+        imgs, _ = source.get_batch(100, False)
+        assert imgs.dtype == np.float32
+        assert imgs.max() <= 1
+
     def test_mnist_feed_source(self):
         source = MNISTFeedSource(
             name="MNIST_feed",
@@ -33,6 +219,115 @@ class TestSource(AKidTestCase):
         print("The class label is {}.".format(labels[0]))
         plt.show()
 
+    def test_mnist_memmap_feed_source(self):
+        # The first source converts data to npy files, and the second one maps
+        # them.
+        for _ in xrange(0, 2):
+            source = MNISTMemmapFeedSource(
+                name="MNIST_memmap_feed",
+                url='http://yann.lecun.com/exdb/mnist/',
+                num_train=50000,
+                num_val=5000,
+                scale=True)
+            source.setup()
+            assert type(source.get_all(train=True).images) is np.memmap
+
+            imgs, labels = source.get_batch(100, False)
+            assert imgs.shape == (100, 28, 28, 1)
+            assert imgs.max() <= 1
+
+    def test_memmap_cache_options(self):
+        import tempfile
+        work_dir = tempfile.mkdtemp()
+
+        def get_source(offset, memmap_dir=None):
+            source = _ToyMemmapFeedSource(offset=offset,
+                                          memmap_dir=memmap_dir,
+                                          name="toy_memmap",
+                                          url=None,
+                                          work_dir=work_dir,
+                                          num_train=10,
+                                          num_val=5)
+            source.setup()
+            return source
+
+        # Sources loading different data should not share a cache.
+        plain = get_source(0)
+        shifted = get_source(1)
+        assert plain.memmap_dir != shifted.memmap_dir
+        assert plain.get_all(train=True).images.min() == 0
+        assert shifted.get_all(train=True).images.min() == 1
+        # The same options hit the same cache.
+        assert get_source(1).memmap_dir == shifted.memmap_dir
+
+        # A cache saved with other options is refused.
+        self.assertRaises(ValueError, get_source, 1, plain.memmap_dir)
+
+    def test_record_dtype(self):
+        import tempfile
+        labels = np.arange(20)
+        integral = np.random.randint(0, 256, [20, 4, 4, 3]).astype(np.float32)
+        whitened = np.random.randn(20, 4, 4, 3).astype(np.float32)
+        for record_dtype, images in [("uint8", integral),
+                                     ("float16", whitened)]:
+            _, read, read_labels = _read_toy_records(
+                20,
+                images=images,
+                labels=labels,
+                record_dtype=record_dtype,
+                work_dir=tempfile.mkdtemp(),
+                num_train=20,
+                num_val=20)
+            assert read_labels == list(labels)
+            expected = images.astype(record_dtype).astype(np.float32)
+            assert (read == expected).all()
+
+        # Whitened images do not fit in uint8.
+        self.assertRaises(ValueError,
+                          _read_toy_records,
+                          1,
+                          images=whitened,
+                          labels=labels,
+                          record_dtype="uint8",
+                          work_dir=tempfile.mkdtemp(),
+                          num_train=20,
+                          num_val=20)
+
+    def test_sharded_tfrecords(self):
+        import os
+        import json
+        import glob
+        import tempfile
+        work_dir = tempfile.mkdtemp()
+        images = np.arange(50 * 4, dtype=np.float32).reshape([50, 2, 2, 1])
+        labels = np.arange(50)
+        kwargs = {"labels": labels,
+                  "num_shards": 3,
+                  "num_readers": 2,
+                  "work_dir": work_dir,
+                  "num_train": 50,
+                  "num_val": 50}
+        # Readers cycle over shards, so read more than an epoch.
+        source, read, read_labels = _read_toy_records(200,
+                                                      images=images,
+                                                      **kwargs)
+        shards = glob.glob(os.path.join(work_dir, "toy-*-of-00003.tfrecords"))
+        assert len(shards) == 3
+        with open(source._manifest_path("toy")) as f:
+            manifest = json.load(f)
+        assert len(manifest["shards"]) == 3
+        assert sum(s["num_examples"] for s in manifest["shards"]) == 50
+        # Every record is read, with its own image.
+        assert set(read_labels) == set(labels)
+        assert (read == images[read_labels]).all()
+
+        # The existing manifest skips conversion, so other images passed are
+        # not written.
+        _, read, read_labels = _read_toy_records(200,
+                                                 images=images + 1,
+                                                 **kwargs)
+        assert (read == images[read_labels]).all()
+
     def test_rotated_mnist_feed_source(self):
         source = RotatedMNISTFeedSource(
             name="Rotated_MNIST_feed",